@@ -0,0 +1,370 @@
+"""
+    Benchmark of the main API endpoints under concurrent load, on a generated dataset.
+
+    Usage: ``python benchmarks/api_benchmark.py [--movies N] [--streams M] [--entries K] [--users U]
+    [--threads T] [--duration S] [--scenarios search,movie_detail,...] [--output results.json]
+    [--compare baseline.json]``
+
+    Populates the database with a deterministic dataset of N movies, M streams with K entries each,
+    and U users, and then runs each scenario for S seconds from T threads, each with its own Flask test
+    client, so the numbers reflect the app and the database rather than a web server. The scenarios are:
+
+    * ``search``: Searching for movies by a word of their title.
+    * ``movie_detail``: Getting a movie.
+    * ``entry_polling``: Polling the entries of a stream, sending the ETag of the previous response.
+    * ``login``: Logging in. Requires scrypt to be installed to be meaningful.
+    * ``entry_creation``: Adding entries to streams.
+
+    Reports the throughput, the 50th, 95th and 99th percentile latencies and the number of SQL
+    statements per request of each scenario, and stores them with the commit benchmarked as JSON with
+    ``--output``. Pass the results of another commit with ``--compare`` to see the changes.
+
+    Uses a temporary SQLite database, unless BENCHMARK_DATABASE_URI is set, in which case that database
+    will be wiped and used instead. Use PostgreSQL for realistic numbers, SQLite serializes all writes.
+"""
+from __future__ import print_function
+
+from collections import OrderedDict
+from datetime import datetime
+from common import create_benchmark_app
+from threading import Thread, local
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import time
+
+SCENARIOS = ['search', 'movie_detail', 'entry_polling', 'login', 'entry_creation']
+PASSWORD = 'benchmark'
+
+
+def generate_titles(number_of_movies, rng):
+    """ Generate deterministic, random titles of 1-5 pronounceable words. """
+    syllables = [c + v for c in 'bdfgklmnprstv' for v in 'aeiou']
+    vocabulary = [''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) for _ in range(5000)]
+    for _ in range(number_of_movies):
+        yield ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(1, 5))).title()
+
+
+def populate(number_of_movies, number_of_streams, entries_per_stream, number_of_users, chunk_size=10000, seed=1):
+    """ Insert the dataset using bulk inserts, bypassing the ORM. The same arguments always give the
+    same data. Every user has the password ``PASSWORD``.
+
+    :returns: The titles of the movies, by id.
+    """
+    from marvin import db
+    from marvin.counters import reconcile_counters
+    from marvin.models import Entry, Movie, MovieTitleTrigram, Stream, User
+    from marvin.search import get_trigrams
+    from marvin.security import generate_pw_hash
+
+    db.drop_all()
+    db.create_all()
+    rng = random.Random(seed)
+    # Hashing is slow on purpose, so share one hash between all the users
+    password_hash = generate_pw_hash(PASSWORD)
+    for offset in range(0, number_of_users, chunk_size):
+        db.session.execute(User.__table__.insert(), [{
+            'id': user_id,
+            'username': 'user%d' % user_id,
+            'email': 'user%d@example.com' % user_id,
+            'password_hash': password_hash,
+            'number_of_published_streams': 0,
+        } for user_id in range(offset + 1, min(offset + chunk_size, number_of_users) + 1)])
+
+    titles = dict(enumerate(generate_titles(number_of_movies, rng), 1))
+    for offset in range(0, number_of_movies, chunk_size):
+        movie_ids = range(offset + 1, min(offset + chunk_size, number_of_movies) + 1)
+        db.session.execute(Movie.__table__.insert(), [{
+            'id': movie_id,
+            'title': titles[movie_id],
+            'external_id': 'imdb:tt%07d' % movie_id,
+            'category': 'movie',
+            'year': rng.randint(1950, 2014),
+            'number_of_streams': 0,
+            'imdb_rating': round(rng.random()*10, 1),
+            'number_of_imdb_votes': rng.randint(0, 100000),
+            'metascore': rng.randint(0, 100),
+            'relevancy': rng.random()*300,
+        } for movie_id in movie_ids])
+        db.session.execute(MovieTitleTrigram.__table__.insert(), [{
+            'trigram': trigram,
+            'movie_id': movie_id,
+        } for movie_id in movie_ids for trigram in get_trigrams(titles[movie_id])])
+
+    for offset in range(0, number_of_streams, chunk_size):
+        stream_ids = range(offset + 1, min(offset + chunk_size, number_of_streams) + 1)
+        db.session.execute(Stream.__table__.insert(), [{
+            'id': stream_id,
+            'name': 'Stream %d' % stream_id,
+            'description': '',
+            'movie_id': rng.randint(1, number_of_movies),
+            'creator_id': 1 + stream_id % number_of_users,
+            'public': rng.random() < 0.8,
+            'entries_version': 0,
+            'number_of_entries': 0,
+        } for stream_id in stream_ids])
+        if entries_per_stream:
+            db.session.execute(Entry.__table__.insert(), [{
+                'stream_id': stream_id,
+                'entry_point_in_ms': i*60*1000,
+                'title': 'Entry %d' % i,
+                'content_type': 'text',
+                'content': {'text': '<p>Benchmark</p>'},
+            } for stream_id in stream_ids for i in range(entries_per_stream)])
+    db.session.commit()
+    reconcile_counters()
+    return titles
+
+
+class Scenario(object):
+    """ Makes one kind of request, with random arguments from the dataset.
+
+    :param dataset: What the requests need to know about the dataset, see :func:`describe_dataset`.
+    :param make_request: Function taking the dataset, a test client, a random generator and a dict
+        kept per thread, making a request with the client and returning the response.
+    :param expected_statuses: The status codes of successful responses.
+    """
+
+    def __init__(self, dataset, make_request, expected_statuses=(200,)):
+        self.dataset = dataset
+        self.make_request = make_request
+        self.expected_statuses = expected_statuses
+
+
+    def request(self, client, rng, state):
+        """ Make a request with `client`, and return the response. `state` is kept per thread. """
+        return self.make_request(self.dataset, client, rng, state)
+
+
+def search(dataset, client, rng, state): # pylint: disable=unused-argument
+    title = rng.choice(dataset['titles'])
+    return client.get('/movies', query_string={'q': rng.choice(title.split())})
+
+
+def get_movie(dataset, client, rng, state): # pylint: disable=unused-argument
+    return client.get('/movies/%d' % rng.randint(1, dataset['movies']))
+
+
+def poll_entries(dataset, client, rng, state):
+    stream_id = rng.choice(dataset['public_stream_ids'])
+    etags = state.setdefault('etags', {})
+    headers = {'If-None-Match': etags[stream_id]} if stream_id in etags else {}
+    response = client.get('/streams/%d/entries' % stream_id, headers=headers)
+    if 'ETag' in response.headers:
+        etags[stream_id] = response.headers['ETag']
+    return response
+
+
+def login(dataset, client, rng, state): # pylint: disable=unused-argument
+    return client.post('/login', data={
+        'identifier': 'user%d' % rng.randint(1, dataset['users']),
+        'password': PASSWORD,
+    })
+
+
+def create_entry(dataset, client, rng, state): # pylint: disable=unused-argument
+    stream_id = rng.choice(dataset['own_stream_ids'])
+    return client.post('/streams/%d/createEntry' % stream_id, headers=dataset['auth_header'], data={
+        'title': 'Benchmark',
+        'entry_point_in_ms': rng.randint(0, 2*3600*1000),
+        'content_type': 'text',
+        'content': '{"text": "<p>Benchmark</p>"}',
+    })
+
+
+#: The request function of each scenario, and the status codes of its successful responses
+SCENARIO_REQUESTS = {
+    'search': (search, (200,)),
+    'movie_detail': (get_movie, (200,)),
+    'entry_polling': (poll_entries, (200, 304)),
+    'login': (login, (200,)),
+    'entry_creation': (create_entry, (201,)),
+}
+
+
+def describe_dataset(args, titles):
+    """ Collect what the scenarios need to know about the populated dataset. """
+    from marvin.models import Stream
+
+    user = Stream.query.get(1).creator
+    return {
+        'movies': args.movies,
+        'users': args.users,
+        'titles': list(titles.values()),
+        'public_stream_ids': [stream_id for (stream_id,) in Stream.query.filter(Stream.public).values(Stream.id)],
+        'own_stream_ids': [stream_id for (stream_id,) in
+            Stream.query.filter(Stream.creator_id == user.id).values(Stream.id)],
+        'auth_header': {'Authorization': 'Token %s' % user.get_auth_token()},
+    }
+
+
+def percentile(values, percent):
+    """ The value below which `percent` percent of the sorted `values` fall. """
+    if not values:
+        return float('nan')
+    index = min(int(round(percent/100.0*(len(values) - 1))), len(values) - 1)
+    return sorted(values)[index]
+
+
+def run_scenario(app, scenario, threads, duration, seed=1):
+    """ Run `scenario` from `threads` threads for `duration` seconds, and summarize the results. """
+    from marvin import db
+    from sqlalchemy import event
+
+    with app.app_context():
+        engine = db.engine
+    counter = local()
+    def count_query(*args): # pylint: disable=unused-argument
+        counter.queries = getattr(counter, 'queries', 0) + 1
+    event.listen(engine, 'before_cursor_execute', count_query)
+
+    latencies = []
+    query_counts = []
+    errors = []
+    deadline = time.time() + duration
+
+    def run(thread_number):
+        client = app.test_client()
+        rng = random.Random(seed*1000 + thread_number)
+        state = {}
+        while time.time() < deadline:
+            counter.queries = 0
+            start = time.time()
+            response = scenario.request(client, rng, state)
+            latency = (time.time() - start)*1000
+            # list.append is atomic, so no need for a lock
+            if response.status_code in scenario.expected_statuses:
+                latencies.append(latency)
+                query_counts.append(counter.queries)
+            else:
+                errors.append(response.status_code)
+
+    workers = [Thread(target=run, args=(thread_number,)) for thread_number in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    event.remove(engine, 'before_cursor_execute', count_query)
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'error_statuses': sorted(set(errors)),
+        'throughput_per_s': len(latencies)/elapsed,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'queries_per_request': sum(query_counts)/float(len(query_counts)) if query_counts else float('nan'),
+    }
+
+
+def get_commit():
+    """ The commit being benchmarked, with a + if there are uncommitted changes, or None if unknown. """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'])
+        return commit + ('+' if dirty.strip() else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    header = '%16s %10s %8s %12s %10s %10s %10s %10s' % ('scenario', 'requests', 'errors', 'req/s',
+        'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'queries')
+    print(header)
+    for name, result in results['scenarios'].items():
+        print('%16s %10d %8d %12.1f %10.2f %10.2f %10.2f %10.1f' % (name, result['requests'], result['errors'],
+            result['throughput_per_s'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['queries_per_request']))
+    if baseline is None:
+        return
+    print('\nCompared to %s:' % (baseline.get('commit') or 'the baseline'))
+    print('%16s %12s %10s %10s' % ('scenario', 'req/s', 'p95', 'queries'))
+    for name, result in results['scenarios'].items():
+        old = baseline['scenarios'].get(name)
+        if old is None:
+            continue
+        print('%16s %+11.1f%% %+9.1f%% %+10.1f' % (name,
+            _change(old['throughput_per_s'], result['throughput_per_s']),
+            _change(old['p95_ms'], result['p95_ms']),
+            result['queries_per_request'] - old['queries_per_request']))
+
+
+def _change(old, new):
+    return (new - old)/old*100 if old else float('nan')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the API endpoints under concurrent load.')
+    parser.add_argument('--movies', type=int, default=10000, help='Number of movies to generate')
+    parser.add_argument('--streams', type=int, default=2000, help='Number of streams to generate')
+    parser.add_argument('--entries', type=int, default=50, help='Number of entries to generate per stream')
+    parser.add_argument('--users', type=int, default=500, help='Number of users to generate')
+    parser.add_argument('--threads', type=int, default=4, help='Number of threads making requests')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run each scenario for')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma-separated scenarios to run')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the dataset and the requests')
+    parser.add_argument('--output', help='Store the results as JSON in this file')
+    parser.add_argument('--compare', help='Compare with the results stored in this file')
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    for name in args.scenarios:
+        if name not in SCENARIO_REQUESTS:
+            parser.error('Unknown scenario %s, choose from %s' % (name, ', '.join(SCENARIOS)))
+    return args
+
+
+def main():
+    args = parse_args()
+    app = create_benchmark_app('api_benchmark',
+        # Keep the logs of every request and statement from skewing the results
+        INSTRUMENTATION_ENABLED=False,
+        SLOW_QUERY_THRESHOLD_IN_MS=None,
+    )
+    from marvin import db
+
+    with app.test_request_context():
+        print('Populating %s...' % db.engine.dialect.name)
+        titles = populate(args.movies, args.streams, args.entries, args.users, seed=args.seed)
+        dataset = describe_dataset(args, titles)
+        dialect = db.engine.dialect.name
+        db.session.remove()
+
+    results = {
+        'commit': get_commit(),
+        'datetime': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'database': dialect,
+        'dataset': {
+            'movies': args.movies,
+            'streams': args.streams,
+            'entries_per_stream': args.entries,
+            'users': args.users,
+            'seed': args.seed,
+        },
+        'threads': args.threads,
+        'duration_in_s': args.duration,
+        'scenarios': OrderedDict(),
+    }
+    for name in args.scenarios:
+        print('Running %s...' % name)
+        make_request, expected_statuses = SCENARIO_REQUESTS[name]
+        scenario = Scenario(dataset, make_request, expected_statuses)
+        results['scenarios'][name] = run_scenario(app, scenario, args.threads, args.duration, seed=args.seed)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_fh:
+            baseline = json.load(baseline_fh)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as output_fh:
+            json.dump(results, output_fh, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""
+    Helpers shared by the benchmarks, imported as ``from common import ...`` since the directory of
+    the benchmark being run is on the path.
+"""
+from os import environ, path
+
+import tempfile
+
+
+def create_benchmark_app(name, **config):
+    """ Create an app connected to a fresh database, which is also used by the celery tasks.
+
+    Uses a temporary SQLite database, unless BENCHMARK_DATABASE_URI is set, in which case that
+    database is used instead. The benchmarks wipe it before populating it. The settings are written
+    to a config file, since :mod:`marvin.tasks` creates an app from it when imported, so import that
+    after calling this.
+
+    :param name: Name of the benchmark, used to name the temporary database.
+    :param config: Settings to use in addition to the ones every benchmark needs.
+    """
+    directory = tempfile.mkdtemp()
+    settings = {
+        'SQLALCHEMY_DATABASE_URI': environ.get('BENCHMARK_DATABASE_URI',
+            'sqlite:///%s' % path.join(directory, '%s.sqlite' % name)),
+        'TESTING': True,
+        'SECRET_KEY': 'benchmark',
+        'CELERY_BROKER_URL': 'memory://',
+    }
+    settings.update(config)
+    config_file = path.join(directory, 'benchmark_config.py')
+    with open(config_file, 'w') as config_fh:
+        config_fh.write(''.join('%s = %r\n' % setting for setting in sorted(settings.items())))
+    environ['MARVIN_CONFIG_FILE'] = config_file
+    from marvin import create_app
+    return create_app()
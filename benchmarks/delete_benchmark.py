@@ -0,0 +1,105 @@
+"""
+    Benchmark of deleting every stream and entry, comparing deleting them one at a time through the
+    ORM, like the ``delete_streams_and_entries`` command used to, with the chunked, set-based deletes.
+
+    Usage: ``python benchmarks/delete_benchmark.py [number_of_streams ...]``
+
+    Runs with 1k, 10k and 100k streams by default, with 20 entries each, spread over a tenth as many
+    movies. Uses a temporary SQLite database, unless BENCHMARK_DATABASE_URI is set, in which case that
+    database will be wiped and used instead.
+"""
+from __future__ import print_function
+
+from common import create_benchmark_app
+from marvin import db
+from marvin.counters import reconcile_counters
+from marvin.maintenance import delete_streams
+from marvin.models import Entry, Movie, Stream, User
+
+import random
+import sys
+import time
+
+ENTRIES_PER_STREAM = 20
+
+
+def populate(number_of_streams, chunk_size=10000, seed=1):
+    """ Insert users, movies, streams and entries using bulk inserts, bypassing the ORM. """
+    db.drop_all()
+    db.create_all()
+    rng = random.Random(seed)
+    number_of_movies = max(number_of_streams // 10, 1)
+    db.session.execute(User.__table__.insert(), [{
+        'id': 1,
+        'username': 'benchmark',
+        'email': 'benchmark@example.com',
+        'password_hash': 'scrypt:1024:8:1$NaCl$benchmark',
+        'number_of_published_streams': 0,
+    }])
+    db.session.execute(Movie.__table__.insert(), [{
+        'id': movie_id,
+        'title': 'Movie %d' % movie_id,
+        'external_id': 'imdb:tt%07d' % movie_id,
+        'category': 'movie',
+        'number_of_streams': 0,
+        'imdb_rating': 0.0,
+        'number_of_imdb_votes': 0,
+        'metascore': 0,
+        'relevancy': 0,
+    } for movie_id in range(1, number_of_movies + 1)])
+    for offset in range(0, number_of_streams, chunk_size):
+        stream_ids = range(offset + 1, min(offset + chunk_size, number_of_streams) + 1)
+        db.session.execute(Stream.__table__.insert(), [{
+            'id': stream_id,
+            'name': 'Stream %d' % stream_id,
+            'description': '',
+            'movie_id': rng.randint(1, number_of_movies),
+            'creator_id': 1,
+            'public': rng.random() < 0.5,
+            'entries_version': 0,
+            'number_of_entries': ENTRIES_PER_STREAM,
+        } for stream_id in stream_ids])
+        db.session.execute(Entry.__table__.insert(), [{
+            'stream_id': stream_id,
+            'entry_point_in_ms': i*60*1000,
+            'title': 'Entry %d' % i,
+            'content_type': 'text',
+            'content': '{"text": "Benchmark"}',
+        } for stream_id in stream_ids for i in range(ENTRIES_PER_STREAM)])
+    db.session.commit()
+    reconcile_counters()
+
+
+def orm_delete():
+    """ Delete everything like the command used to, loading every row into the session. """
+    for stream in Stream.query.all():
+        db.session.delete(stream)
+    for entry in Entry.query.all():
+        db.session.delete(entry)
+    db.session.commit()
+    reconcile_counters()
+
+
+def time_delete(number_of_streams, delete):
+    """ Seconds to delete everything with `delete`, on freshly populated data. """
+    populate(number_of_streams)
+    start = time.time()
+    delete()
+    duration = time.time() - start
+    assert Stream.query.count() == 0 and Entry.query.count() == 0
+    return duration
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    app = create_benchmark_app('delete_benchmark')
+    print('%10s %10s %12s %12s' % ('streams', 'entries', 'orm (s)', 'chunked (s)'))
+    with app.test_request_context():
+        for size in sizes:
+            orm_time = time_delete(size, orm_delete)
+            chunked_time = time_delete(size, lambda: delete_streams(chunk_size=1000))
+            print('%10d %10d %12.2f %12.2f' % (size, size*ENTRIES_PER_STREAM, orm_time, chunked_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+    Benchmark of login throughput, and of how a storm of logins affects other endpoints.
+
+    Usage: ``python benchmarks/login_storm_benchmark.py [concurrent_logins] [duration_in_s]``
+
+    Serves the app from a threaded server, and runs a number of threads logging in as fast as they
+    can while a single thread keeps requesting a movie. Runs once with passwords hashed in the request
+    thread (``PASSWORD_HASHING_POOL_SIZE = 0``) and once with the hashing process pool, reporting
+    logins per second and the latency percentiles of the movie requests. Requires scrypt to be
+    installed to be meaningful.
+"""
+from __future__ import print_function
+
+from marvin import create_app, db
+from marvin.models import Movie, User
+
+from threading import Event, Thread
+from werkzeug.serving import make_server
+
+import os
+import requests
+import sys
+import tempfile
+import time
+
+
+def percentile(values, percent):
+    """ The value below which `percent` percent of the sorted `values` fall. """
+    if not values:
+        return float('nan')
+    index = min(int(round(percent/100.0*(len(values) - 1))), len(values) - 1)
+    return sorted(values)[index]
+
+
+def run_storm(pool_size, concurrent_logins, duration):
+    """ Serve the app with the given pool size, and return (logins per second, movie latencies). """
+    database = os.path.join(tempfile.mkdtemp(), 'login_benchmark.sqlite')
+    app = create_app(
+        SQLALCHEMY_DATABASE_URI='sqlite:///%s' % database,
+        TESTING=True,
+        SECRET_KEY='benchmark',
+        CELERY_BROKER_URL='memory://',
+        PASSWORD_HASHING_POOL_SIZE=pool_size,
+    )
+    with app.test_request_context():
+        db.create_all()
+        movie = Movie(title='Avatar', external_id='imdb:tt0499549')
+        db.session.add_all([movie, User(username='bob', email='bob@example.com', password='bobspw')])
+        db.session.commit()
+        movie_id = movie.id
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+    Thread(target=server.serve_forever).start()
+
+    stop = Event()
+    logins = []
+    latencies = []
+
+    def login_forever():
+        session = requests.Session()
+        while not stop.is_set():
+            response = session.post(base_url + '/login', data={'identifier': 'bob', 'password': 'bobspw'})
+            if response.status_code == 200:
+                logins.append(1)
+
+    def probe_forever():
+        session = requests.Session()
+        while not stop.is_set():
+            start = time.time()
+            session.get('%s/movies/%d' % (base_url, movie_id))
+            latencies.append((time.time() - start)*1000)
+            time.sleep(0.01)
+
+    threads = [Thread(target=login_forever) for _ in range(concurrent_logins)] + [Thread(target=probe_forever)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+    return len(logins)/float(duration), latencies
+
+
+def main():
+    concurrent_logins = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print('%12s %12s %14s %14s' % ('hashing', 'logins/s', 'movie p50 (ms)', 'movie p99 (ms)'))
+    for label, pool_size in [('inline', 0), ('pool', None)]:
+        logins_per_second, latencies = run_storm(pool_size, concurrent_logins, duration)
+        print('%12s %12.1f %14.2f %14.2f' % (label, logins_per_second, percentile(latencies, 50),
+            percentile(latencies, 99)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+    Benchmark of refreshing movie metadata from OMDb, with and without concurrent requests.
+
+    Usage: ``python benchmarks/omdb_refresh_benchmark.py [number_of_movies] [latency_in_ms]``
+
+    Runs against a local fake OMDb answering every request after the given latency (default 100ms),
+    refreshing the metadata for all movies once with a single request in flight at a time, and once
+    with 16. Uses a temporary SQLite database, unless BENCHMARK_DATABASE_URI is set, in which case that
+    database will be wiped and used instead.
+"""
+from __future__ import print_function
+
+from common import create_benchmark_app
+
+import sys
+import time
+
+
+def main():
+    number_of_movies = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 100)/1000.0
+    app = create_benchmark_app('omdb_refresh_benchmark')
+
+    from marvin import db
+    from marvin.models import Movie
+    from marvin.tasks import update_meta
+    from marvin.tests.fake_omdb import FakeOMDb
+
+    omdb_movies = dict(('tt%07d' % i, {
+        'Poster': 'http://example.com/%d.jpg' % i,
+        'Runtime': '%d min' % (80 + i % 60),
+        'Metascore': str(i % 100),
+        'imdbRating': '%.1f' % (i % 100 / 10.0),
+        'imdbVotes': '{:,}'.format(i*37),
+        'Response': 'True',
+    }) for i in range(number_of_movies))
+    omdb = FakeOMDb(omdb_movies, latency=latency)
+    app.config['OMDB_URL'] = omdb.start()
+    app.config['OMDB_REQUESTS_PER_SECOND'] = 10000
+
+    with app.test_request_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add_all([Movie(title='Movie %d' % i, external_id='imdb:tt%07d' % i, year=2000 + i % 15)
+            for i in range(number_of_movies)])
+        db.session.commit()
+
+    print('%12s %12s %12s' % ('concurrency', 'seconds', 'movies/s'))
+    for concurrency in (1, 16):
+        app.config['OMDB_CONCURRENCY'] = concurrency
+        with app.test_request_context():
+            start = time.time()
+            update_meta.run()
+            duration = time.time() - start
+        print('%12d %12.2f %12.1f' % (concurrency, duration, number_of_movies/duration))
+    omdb.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+    Benchmark of recalculating the relevancy of every movie in the catalogue.
+
+    Usage: ``python benchmarks/relevancy_benchmark.py [number_of_movies]``
+
+    Runs with 1M movies by default, comparing loading every movie through the ORM and calling
+    ``Movie.update_relevancy`` with the chunked recompute scoring one movie at a time, scored with
+    NumPy, and done in SQL where the database supports it. The ORM approach is only timed for the
+    first 50k movies and extrapolated, since it takes forever. Uses a temporary SQLite database,
+    unless BENCHMARK_DATABASE_URI is set, in which case that database will be wiped and used instead.
+"""
+from __future__ import print_function
+
+from common import create_benchmark_app
+from marvin import db
+from marvin.models import Movie
+from marvin.relevancy import numpy, recompute_relevancy
+
+import random
+import sys
+import time
+
+ORM_SAMPLE_SIZE = 50000
+
+
+def insert_movies(number_of_movies, chunk_size=10000, seed=1):
+    """ Insert movies with deterministic, random metadata, bypassing the ORM. """
+    rand = random.Random(seed)
+    movie_table = Movie.__table__
+    for offset in range(0, number_of_movies, chunk_size):
+        db.session.execute(movie_table.insert(), [{
+            'title': 'Movie %d' % i,
+            'external_id': 'imdb:tt%08d' % i,
+            'category': 'movie',
+            'year': rand.choice([None, rand.randint(1900, 2014)]),
+            'imdb_rating': round(rand.uniform(0, 10), 1),
+            'metascore': rand.randint(0, 100),
+            'number_of_imdb_votes': rand.randint(0, 100000),
+            'number_of_streams': 0,
+            'relevancy': 0,
+        } for i in range(offset, min(offset + chunk_size, number_of_movies))])
+    db.session.commit()
+
+
+def time_orm(number_of_movies):
+    """ Seconds to update all movies one by one through the ORM, extrapolated from a sample. """
+    sample_size = min(number_of_movies, ORM_SAMPLE_SIZE)
+    start = time.time()
+    for movie in Movie.query.order_by(Movie.id).limit(sample_size):
+        movie.update_relevancy()
+    db.session.commit()
+    return (time.time() - start)*number_of_movies/sample_size
+
+
+def main():
+    number_of_movies = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    app = create_benchmark_app('relevancy_benchmark')
+    with app.test_request_context():
+        db.drop_all()
+        db.create_all()
+        print('Inserting %d movies...' % number_of_movies)
+        insert_movies(number_of_movies)
+
+        methods = ['python']
+        if numpy is not None:
+            methods.append('numpy')
+        if db.engine.dialect.name in ('postgresql', 'mysql'):
+            methods.append('sql')
+
+        print('%10s %12s %12s' % ('method', 'seconds', 'movies/s'))
+        duration = time_orm(number_of_movies)
+        print('%10s %12.2f %12.0f   (extrapolated from %d movies)' % ('orm', duration, number_of_movies/duration,
+            min(number_of_movies, ORM_SAMPLE_SIZE)))
+        for method in methods:
+            start = time.time()
+            recompute_relevancy(only_stale=False, method=method)
+            duration = time.time() - start
+            print('%10s %12.2f %12.0f' % (method, duration, number_of_movies/duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+    Benchmark of movie title search, comparing the plain ILIKE scan with the search index.
+
+    Usage: ``python benchmarks/search_benchmark.py [number_of_movies ...]``
+
+    Runs with 10k, 100k and 1M movies by default. Uses a temporary SQLite database, unless
+    BENCHMARK_DATABASE_URI is set, in which case that database will be wiped and used instead.
+"""
+from __future__ import print_function
+
+from common import create_benchmark_app
+from marvin import db
+from marvin.models import Movie, MovieTitleTrigram
+from marvin.search import get_trigrams, search_movies
+
+import random
+import sys
+import timeit
+
+QUERIES = ['ab', 'kar', 'mo ti', 'rakan', 'lo fe ra']
+REPETITIONS = 20
+
+
+def generate_titles(number_of_movies, seed=1):
+    """ Generate deterministic, random titles of 1-5 pronounceable words. """
+    rng = random.Random(seed)
+    syllables = [c + v for c in 'bdfgklmnprstv' for v in 'aeiou']
+    vocabulary = [''.join(rng.choice(syllables) for _ in range(rng.randint(1, 4))) for _ in range(5000)]
+    for _ in range(number_of_movies):
+        yield ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(1, 5))).title()
+
+
+def populate(number_of_movies, chunk_size=10000):
+    """ Insert movies and their trigrams using bulk inserts, bypassing the ORM. """
+    db.drop_all()
+    db.create_all()
+    movie_table = Movie.__table__
+    trigram_table = MovieTitleTrigram.__table__
+    rng = random.Random(2)
+    movies = []
+    trigrams = []
+    for movie_id, title in enumerate(generate_titles(number_of_movies), 1):
+        movies.append({
+            'id': movie_id,
+            'title': title,
+            'external_id': 'imdb:tt%07d' % movie_id,
+            'category': 'movie',
+            'number_of_streams': 0,
+            'imdb_rating': 0.0,
+            'number_of_imdb_votes': 0,
+            'metascore': 0,
+            'relevancy': rng.random()*300,
+        })
+        trigrams.extend({'trigram': trigram, 'movie_id': movie_id} for trigram in get_trigrams(title))
+        if len(movies) == chunk_size:
+            db.session.execute(movie_table.insert(), movies)
+            db.session.execute(trigram_table.insert(), trigrams)
+            movies, trigrams = [], []
+    if movies:
+        db.session.execute(movie_table.insert(), movies)
+        db.session.execute(trigram_table.insert(), trigrams)
+    db.session.commit()
+
+
+def ilike_search(search_query, limit=15):
+    """ The search as it was done before the index existed. """
+    return (Movie.query
+        .filter(Movie.title.ilike('%' + '%'.join(search_query.split()) + '%'))
+        .order_by(Movie.relevancy.desc())
+        .limit(limit)
+        .all())
+
+
+def time_per_query(search):
+    """ Average time in ms to run all the benchmark queries through `search`. """
+    total = timeit.timeit(lambda: [search(query) for query in QUERIES], number=REPETITIONS)
+    return total / (REPETITIONS * len(QUERIES)) * 1000
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+    app = create_benchmark_app('search_benchmark')
+    print('%10s %12s %12s' % ('movies', 'ilike (ms)', 'index (ms)'))
+    with app.test_request_context():
+        for size in sizes:
+            populate(size)
+            ilike_time = time_per_query(ilike_search)
+            index_time = time_per_query(lambda query: search_movies(query).all())
+            print('%10d %12.3f %12.3f' % (size, ilike_time, index_time))
+
+
+if __name__ == '__main__':
+    main()
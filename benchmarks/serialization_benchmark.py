@@ -0,0 +1,59 @@
+"""
+    Microbenchmark of the per-object cost of serializing models to JSON.
+
+    Usage: ``python benchmarks/serialization_benchmark.py [number_of_objects]``
+
+    Compares building the hypermedia links with Flask's ``url_for`` on every call with the cached
+    URL templates of :func:`marvin.utils.external_url`. The objects are never added to a database,
+    so this only measures the serialization itself.
+"""
+from __future__ import print_function
+
+from marvin import create_app
+from marvin.models import Movie, Stream, Entry, User
+
+from flask import url_for
+from mock import patch
+
+import sys
+import timeit
+
+
+def url_for_external(endpoint, **values):
+    """ How links were built before external_url. """
+    return url_for(endpoint, _external=True, **values)
+
+
+def create_objects():
+    """ Create a movie with a stream with an entry, with ids set as if they were loaded from the db. """
+    user = User(id=1, username='bob', email='bob@example.com', password_hash='x')
+    movie = Movie(id=1, title='Avatar', external_id='imdb:tt0499549')
+    stream = Stream(id=1, movie=movie, creator=user, name='CinemaSins', movie_id=1, public=True)
+    entry = Entry(id=1, stream=stream, stream_id=1, entry_point_in_ms=1000, title='Title', content_type='text',
+        content={'text': 'Massive TVs!'})
+    return {
+        'Movie': lambda: movie.to_json(include_streams=False),
+        'Stream': stream.to_json,
+        'Entry': entry.to_json,
+    }
+
+
+def time_per_object(serialize, number):
+    """ Average time in microseconds to serialize an object. """
+    return timeit.timeit(serialize, number=number) / number * 10**6
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    app = create_app(TESTING=True, SECRET_KEY='benchmark', CELERY_BROKER_URL='memory://')
+    print('%10s %16s %16s' % ('model', 'url_for (us)', 'templates (us)'))
+    with app.test_request_context():
+        for model, serialize in sorted(create_objects().items()):
+            with patch('marvin.models.external_url', url_for_external):
+                before = time_per_object(serialize, number)
+            after = time_per_object(serialize, number)
+            print('%10s %16.2f %16.2f' % (model, before, after))
+
+
+if __name__ == '__main__':
+    main()
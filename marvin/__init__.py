@@ -6,7 +6,7 @@
 """
 
 # pylint: disable=invalid-name,superfluous-parens
-from . import utils
+from . import instrumentation, profiling, utils
 from .security import before_request_authentication
 
 from celery import Celery
@@ -49,7 +49,10 @@ def create_app(config_file=None, **extra_config):
     _connect_utilities(app)
 
     # Import modules that connect to signals
+    from . import counters as _
     from . import permissions as _
+    from . import search as _
+    from . import slowqueries as _
 
     return app
 
@@ -94,9 +97,11 @@ def _connect_blueprints(app):
     # Import views (must be done down here to avoid circular imports)
     from .views import stats
     from .views import promo
+    from .views import metrics
 
     app.register_blueprint(stats.mod)
     app.register_blueprint(promo.mod)
+    app.register_blueprint(metrics.mod)
 
 
 def _connect_api_endpoints():
@@ -108,13 +113,16 @@ def _connect_api_endpoints():
 
     api.add_resource(movies.AllMoviesView, '/movies')
     api.add_resource(movies.MovieDetailView, '/movies/<int:movie_id>')
+    api.add_resource(movies.SearchStatusView, '/movies/search')
     api.add_resource(streams.CreateStreamView, '/movies/<int:movie_id>/createStream')
     api.add_resource(streams.StreamDetailView, '/streams/<int:stream_id>')
     api.add_resource(streams.StreamEntryView, '/streams/<int:stream_id>/entries')
+    api.add_resource(streams.StreamFeedView, '/streams/<int:stream_id>/feed')
     api.add_resource(streams.PublishStreamView, '/streams/<int:stream_id>/publish')
     api.add_resource(streams.UnpublishStreamView, '/streams/<int:stream_id>/unpublish')
     api.add_resource(entries.CreateEntryView, '/streams/<int:stream_id>/createEntry')
     api.add_resource(entries.EntryDetailView, '/entries/<int:entry_id>')
+    api.add_resource(entries.MovieEntryWindowView, '/movies/<int:movie_id>/entries')
     api.add_resource(users.CreateUserView, '/users')
     api.add_resource(users.UserDetailView, '/users/<int:user_id>')
     api.add_resource(users.LoginView, '/login')
@@ -124,7 +132,9 @@ def _connect_utilities(app):
     # Error handler
     app.register_error_handler(500, utils.error_handler)
 
-    # Connect before and after request handlers
+    # Connect before and after request handlers, instrumentation and profiling first to include everything else
+    instrumentation.init_app(app)
+    profiling.init_app(app)
     app.before_request(before_request_authentication)
     app.teardown_appcontext(utils.teardown_appcontext)
 
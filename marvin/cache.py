@@ -0,0 +1,223 @@
+"""
+    marvin.cache
+    ~~~~~~~~~~~~
+
+    Simple key/value caches with expiry, used to avoid repeating expensive work across requests.
+
+    Caches are created per app and name through :func:`get_cache`. The backend is selected by the
+    ``CACHE_BACKEND`` setting:
+
+    * ``local``: A bounded, in-process LRU cache. Each process has it's own.
+    * ``redis``: Shared by all processes connected to the Redis server at ``CACHE_REDIS_URL``. Values
+      are pickled. Requires the redis package to be installed.
+
+    A :class:`DiskCache` is also available for data that should survive restarts.
+
+"""
+
+from collections import OrderedDict
+from flask import current_app
+from hashlib import sha1
+from threading import Lock
+from time import time
+
+import os
+import pickle
+import tempfile
+
+
+def get_cache(name, max_size=1000):
+    """ Get the cache with the given name for the current app, creating it if necessary.
+
+    :param name: Name of the cache. Caches with different names never share keys.
+    :param max_size: Maximum number of items kept in the cache, for backends where it's
+        relevant. Only used when the cache is created.
+    """
+    caches = current_app.extensions.setdefault('marvin_caches', {})
+    cache = caches.get(name)
+    if cache is None:
+        backend = current_app.config['CACHE_BACKEND']
+        if backend == 'local':
+            cache = LocalCache(max_size)
+        elif backend == 'redis':
+            cache = RedisCache(current_app.config['CACHE_REDIS_URL'], prefix='marvin:%s:' % name)
+        else:
+            raise ValueError("Unknown CACHE_BACKEND '%s'" % backend)
+        cache = caches.setdefault(name, cache)
+    return cache
+
+
+class LocalCache(object):
+    """ A thread-safe, in-process cache that evicts the least recently used items when full.
+
+    :param max_size: Maximum number of items to keep.
+    :param clock: Function returning the current time in seconds, mostly here for testing.
+    """
+
+    def __init__(self, max_size=1000, clock=time):
+        self.max_size = max_size
+        self.clock = clock
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+
+    def get(self, key):
+        """ Get the value stored for `key`, or None if it's missing or has expired. """
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires <= self.clock():
+                return None
+            # Reinsert to mark as recently used
+            self._items[key] = item
+            return value
+
+
+    def set(self, key, value, ttl=None):
+        """ Store `value` for `key`, for `ttl` seconds or until evicted. """
+        expires = self.clock() + ttl if ttl is not None else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, expires)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+    def add(self, key, value, ttl=None):
+        """ Store `value` for `key` unless it already has an unexpired value. Returns whether it was stored. """
+        now = self.clock()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and (item[1] is None or item[1] > now):
+                return False
+            self._items.pop(key, None)
+            self._items[key] = (value, now + ttl if ttl is not None else None)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+            return True
+
+
+    def delete(self, key):
+        """ Remove `key` from the cache, if present. """
+        with self._lock:
+            self._items.pop(key, None)
+
+
+    def clear(self):
+        """ Remove everything from the cache. """
+        with self._lock:
+            self._items.clear()
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+class RedisCache(object):
+    """ A cache stored in Redis, shared by all processes using the same server and prefix. """
+
+    def __init__(self, url, prefix=''):
+        # Import here so that redis is only required when actually used
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+
+
+    def get(self, key):
+        """ Get the value stored for `key`, or None if it's missing or has expired. """
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+
+    def set(self, key, value, ttl=None):
+        """ Store `value` for `key`, for `ttl` seconds or until evicted by Redis. """
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if ttl is None:
+            self.client.set(self.prefix + key, data)
+        else:
+            self.client.setex(self.prefix + key, max(int(ttl), 1), data)
+
+
+    def add(self, key, value, ttl=None):
+        """ Store `value` for `key` unless it already has a value. Returns whether it was stored. """
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = max(int(ttl), 1) if ttl is not None else None
+        return bool(self.client.set(self.prefix + key, data, ex=expires, nx=True))
+
+
+    def delete(self, key):
+        """ Remove `key` from the cache, if present. """
+        self.client.delete(self.prefix + key)
+
+
+    def clear(self):
+        """ Remove everything with this cache's prefix. """
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class DiskCache(object):
+    """ A cache storing each value pickled in a file in `directory`, which is created if necessary.
+
+    Safe to share between threads and processes, since files are replaced atomically. Expired files
+    are only removed when read, or by :meth:`clear`.
+
+    :param directory: Where to store the files.
+    :param clock: Function returning the current time in seconds, mostly here for testing.
+    """
+
+    def __init__(self, directory, clock=time):
+        self.directory = directory
+        self.clock = clock
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+
+    def get(self, key):
+        """ Get the value stored for `key`, or None if it's missing or has expired. """
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                value, expires = pickle.load(cache_file)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires is not None and expires <= self.clock():
+            self._remove(path)
+            return None
+        return value
+
+
+    def set(self, key, value, ttl=None):
+        """ Store `value` for `key`, for `ttl` seconds or until deleted. """
+        expires = self.clock() + ttl if ttl is not None else None
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as temp_file:
+            pickle.dump((value, expires), temp_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, self._get_path(key))
+
+
+    def delete(self, key):
+        """ Remove `key` from the cache, if present. """
+        self._remove(self._get_path(key))
+
+
+    def clear(self):
+        """ Remove everything from the cache. """
+        for filename in os.listdir(self.directory):
+            self._remove(os.path.join(self.directory, filename))
+
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, sha1(key.encode('utf-8')).hexdigest() + '.cache')
+
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
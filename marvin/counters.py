@@ -0,0 +1,209 @@
+"""
+    marvin.counters
+    ~~~~~~~~~~~~~~~
+
+    Keeps the denormalized counts on our models up to date.
+
+    Counts like the number of published streams of a movie are read a lot more often than they
+    change, so they're stored on the parent row instead of being counted for every request. Each
+    count is described by a :class:`Counter`, and is updated when the rows it counts are inserted,
+    updated or deleted, in the same transaction, with ``UPDATE ... SET n = n + 1``. Incrementing in
+    the database instead of in Python means concurrent changes can't overwrite each other, and the
+    views don't have to remember to adjust the counts by hand.
+
+    Changes made without the ORM, like bulk deletes, bypass the events, and must update the counts
+    themselves, see :func:`discount_rows`. Anything that leaves the counts off can be fixed with
+    :func:`reconcile_counters`, which recounts them all, and is available as the ``reconcile_counters``
+    management command.
+
+"""
+from . import db
+from .models import Entry, Movie, Stream, User
+
+from logging import getLogger
+from sqlalchemy import bindparam, event, func, select
+from sqlalchemy.orm import Session, class_mapper, object_session
+from sqlalchemy.orm.attributes import get_history
+
+_logger = getLogger('marvin.counters')
+
+#: Key of the counts changed in the current flush, which must be reloaded by objects in the session
+_CHANGED_KEY = 'marvin_changed_counts'
+
+
+class Counter(object):
+    """ A count of the child rows referring to a parent row, kept in a column of the parent. """
+
+    def __init__(self, name, parent, column, child, foreign_key, condition=None):
+        """ Describe a new count.
+
+        :param name: Name of the count, used when reporting on it.
+        :param parent: The model with the count.
+        :param column: Name of the column on `parent` holding the count.
+        :param child: The model being counted.
+        :param foreign_key: Name of the column on `child` referring to the parent.
+        :param condition: Name of a boolean column on `child`, if only rows where it's true should be counted.
+        """
+        self.name = name
+        self.parent = parent
+        self.column = column
+        self.child = child
+        self.foreign_key = foreign_key
+        self.condition = condition
+
+
+    def get_parent_id(self, values):
+        """ The ID of the parent a child row with the given values is counted for, or None if it isn't counted. """
+        if self.condition is not None and not values.get(self.condition):
+            return None
+        return values.get(self.foreign_key)
+
+
+    def get_attributes(self):
+        """ The attributes of the child that decide whether and where it's counted. """
+        if self.condition is None:
+            return (self.foreign_key,)
+        return (self.foreign_key, self.condition)
+
+
+COUNTERS = [
+    Counter('streams per movie', Movie, 'number_of_streams', Stream, 'movie_id', condition='public'),
+    Counter('published streams per user', User, 'number_of_published_streams', Stream, 'creator_id',
+        condition='public'),
+    Counter('entries per stream', Stream, 'number_of_entries', Entry, 'stream_id'),
+]
+
+
+def reconcile_counters():
+    """ Recount every count in :data:`COUNTERS`, fixing the ones that are off.
+
+    Each count is fixed with a single ``UPDATE`` comparing the stored counts to the actual ones, so
+    only the rows that are off are written.
+
+    :returns: A dict of the name of each count to the number of rows that had to be fixed.
+    """
+    # Count the pending changes too
+    db.session.flush()
+    fixed = {}
+    for counter in COUNTERS:
+        parent_table = counter.parent.__table__
+        child_table = counter.child.__table__
+        actual_count = select([func.count()]).select_from(child_table).where(
+            child_table.c[counter.foreign_key] == parent_table.c.id)
+        if counter.condition is not None:
+            actual_count = actual_count.where(child_table.c[counter.condition])
+        actual_count = actual_count.as_scalar()
+        stored_count = parent_table.c[counter.column]
+        update = parent_table.update().where(stored_count != actual_count).values({
+            counter.column: actual_count,
+        })
+        fixed[counter.name] = db.session.execute(update).rowcount
+        if fixed[counter.name]:
+            _logger.warning("Fixed the %s of %d rows", counter.name, fixed[counter.name])
+    db.session.commit()
+    return fixed
+
+
+def discount_rows(child, condition):
+    """ Take the rows of `child` matching `condition` out of the counts they're in. Call before deleting
+    them without the ORM.
+
+    Makes one ``GROUP BY`` query for each count of `child`, and updates the parents in bulk.
+    """
+    child_table = child.__table__
+    for counter in COUNTERS:
+        if counter.child is not child:
+            continue
+        foreign_key = child_table.c[counter.foreign_key]
+        query = select([foreign_key, func.count()]).where(condition).group_by(foreign_key)
+        if counter.condition is not None:
+            query = query.where(child_table.c[counter.condition])
+        # The bind params can't share names with the columns
+        rows = [{'parent_id_': parent_id, 'count_': count} for parent_id, count in db.session.execute(query)]
+        if not rows:
+            continue
+        parent_table = counter.parent.__table__
+        count = parent_table.c[counter.column]
+        db.session.execute(parent_table.update()
+            .where(parent_table.c.id == bindparam('parent_id_'))
+            .values({counter.column: count - bindparam('count_')}), rows)
+
+
+def _get_old_values(obj, attributes):
+    """ The values of the given attributes of `obj` as last flushed to the database. """
+    values = {}
+    for attribute in attributes:
+        history = get_history(obj, attribute)
+        if history.deleted:
+            values[attribute] = history.deleted[0]
+        elif history.unchanged:
+            values[attribute] = history.unchanged[0]
+        else:
+            values[attribute] = None
+    return values
+
+
+def _get_new_values(obj, attributes):
+    return dict((attribute, getattr(obj, attribute)) for attribute in attributes)
+
+
+def _add_to_count(connection, obj, counter, parent_id, delta):
+    """ Add `delta` to the count of `counter` for the parent with the given ID. """
+    parent_table = counter.parent.__table__
+    count = parent_table.c[counter.column]
+    connection.execute(parent_table.update()
+        .where(parent_table.c.id == parent_id)
+        .values({counter.column: count + delta}))
+    session = object_session(obj)
+    if session is not None:
+        session.info.setdefault(_CHANGED_KEY, set()).add((counter.parent, parent_id, counter.column))
+
+
+def _on_insert(mapper, connection, obj): # pylint: disable=unused-argument
+    for counter in COUNTERS:
+        if isinstance(obj, counter.child):
+            parent_id = counter.get_parent_id(_get_new_values(obj, counter.get_attributes()))
+            if parent_id is not None:
+                _add_to_count(connection, obj, counter, parent_id, 1)
+
+
+def _on_update(mapper, connection, obj): # pylint: disable=unused-argument
+    for counter in COUNTERS:
+        if isinstance(obj, counter.child):
+            attributes = counter.get_attributes()
+            old_parent_id = counter.get_parent_id(_get_old_values(obj, attributes))
+            new_parent_id = counter.get_parent_id(_get_new_values(obj, attributes))
+            if old_parent_id == new_parent_id:
+                continue
+            if old_parent_id is not None:
+                _add_to_count(connection, obj, counter, old_parent_id, -1)
+            if new_parent_id is not None:
+                _add_to_count(connection, obj, counter, new_parent_id, 1)
+
+
+def _on_delete(mapper, connection, obj): # pylint: disable=unused-argument
+    for counter in COUNTERS:
+        if isinstance(obj, counter.child):
+            # Changes made to the object before deleting it were never written
+            parent_id = counter.get_parent_id(_get_old_values(obj, counter.get_attributes()))
+            if parent_id is not None:
+                _add_to_count(connection, obj, counter, parent_id, -1)
+
+
+for _child in set(counter.child for counter in COUNTERS):
+    event.listen(_child, 'after_insert', _on_insert)
+    event.listen(_child, 'after_update', _on_update)
+    event.listen(_child, 'after_delete', _on_delete)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _on_flush(session, flush_context): # pylint: disable=unused-argument
+    """ Make objects in the session reload the counts that were changed behind the ORM's back. """
+    changed = session.info.pop(_CHANGED_KEY, None)
+    if not changed:
+        return
+    for model, parent_id, column in changed:
+        key = class_mapper(model).identity_key_from_primary_key((parent_id,))
+        parent = session.identity_map.get(key)
+        if parent is not None:
+            session.expire(parent, [column])
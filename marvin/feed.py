@@ -0,0 +1,132 @@
+"""
+    marvin.feed
+    ~~~~~~~~~~~
+
+    Push entries of a stream to a viewer as their entry points are reached during playback.
+
+    Instead of having clients poll for entries, a :class:`EntryFeed` keeps track of the viewer's
+    playback position and hands out entries when they are due. Entries are read from the database
+    a page at a time, and entries created while the feed is open are received through
+    :mod:`marvin.pubsub`, so they're delivered as soon as they're due without hitting the database.
+
+"""
+
+from bisect import insort
+from time import time
+
+#: Larger than any entry id, used to start reading entries after a given entry point
+_MAX_ID = 2**63 - 1
+
+
+def get_stream_channel(stream_id):
+    """ Name of the pub/sub channel where new entries for the given stream are published. """
+    return 'stream-entries:%d' % stream_id
+
+
+def make_feed_item(entry):
+    """ Get the representation of an entry passed around by the feed, and published to subscribers. """
+    return {
+        'id': entry.id,
+        'entry': entry.to_json(),
+    }
+
+
+class EntryFeed(object):
+    """ Entries of a stream, scheduled by the viewer's playback position.
+
+    :param load_entries: A callable taking an ``(entry_point_in_ms, id)`` tuple and a limit, returning
+        the entries after the given one as feed items (see :func:`make_feed_item`), sorted by entry
+        point and id.
+    :param subscription: A pub/sub subscription to the channel where new entries for the stream are published.
+    :param offset_ms: The viewer's current playback position. Only entries after this are delivered.
+    :param page_size: Number of entries to read from the database at a time.
+    :param clock: Function returning the current time in seconds, mostly here for testing.
+    """
+
+    def __init__(self, load_entries, subscription, offset_ms, page_size=100, clock=time):
+        self.load_entries = load_entries
+        self.subscription = subscription
+        self.offset_ms = offset_ms
+        self.page_size = page_size
+        self.clock = clock
+        self.started_at = clock()
+        self._pending = []
+        self._seen_ids = set()
+        self._last_loaded_key = (offset_ms, _MAX_ID)
+        self._exhausted = False
+        #: All entries up to this playback position have been handed out
+        self.delivered_until_ms = offset_ms
+
+
+    def get_position_ms(self):
+        """ The viewer's playback position right now, in ms. """
+        return self.offset_ms + (self.clock() - self.started_at)*1000
+
+
+    def get_due_entries(self, timeout):
+        """ Get the entries that have been reached by the playback position.
+
+        If none are due yet, wait up to `timeout` seconds for the next one to become due, or for a
+        new one to be published with an entry point we've already passed. Returns an empty list if
+        none became due in time.
+        """
+        deadline = self.clock() + timeout
+        while True:
+            position = self.get_position_ms()
+            self._refill(position)
+            due_entries = self._pop_due_entries(position)
+            if due_entries:
+                return due_entries
+            now = self.clock()
+            if now >= deadline:
+                return []
+            wait_until = deadline
+            if self._pending:
+                next_entry_point = self._pending[0][0][0]
+                wait_until = min(deadline, self.started_at + (next_entry_point - self.offset_ms)/1000.0)
+            item = self.subscription.get(timeout=max(wait_until - now, 0))
+            if item is not None:
+                self._add_item(item)
+
+
+    def close(self):
+        """ Stop listening for new entries. """
+        self.subscription.close()
+
+
+    def _refill(self, position):
+        # Read the next page if we have read past everything pending, since new entries published
+        # after the last page was read might otherwise make us skip some in the database, and until
+        # we have read past the playback position, so all the entries that are due are pending
+        while not self._exhausted and (not self._pending or self._pending[0][0] > self._last_loaded_key
+                or self._last_loaded_key[0] <= position):
+            items = self.load_entries(self._last_loaded_key, self.page_size)
+            if len(items) < self.page_size:
+                self._exhausted = True
+            for item in items:
+                self._add_item(item)
+            if items:
+                self._last_loaded_key = _get_key(items[-1])
+
+
+    def _pop_due_entries(self, position):
+        due_entries = []
+        while self._pending and self._pending[0][0][0] <= position:
+            due_entries.append(self._pending.pop(0)[1])
+        if self._exhausted or self._last_loaded_key[0] > position:
+            # Everything up to the position has been read, and is now handed out
+            self.delivered_until_ms = position
+        return due_entries
+
+
+    def _add_item(self, item):
+        key = _get_key(item)
+        if key[1] in self._seen_ids or key[0] <= self.offset_ms:
+            return
+        self._seen_ids.add(key[1])
+        insort(self._pending, (key, item['entry']))
+
+
+def _get_key(item):
+    """ The key entries are sorted by, which is ``(entry_point_in_ms, id)``. """
+    return (item['entry']['entry_point_in_ms'], item['id'])
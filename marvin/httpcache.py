@@ -0,0 +1,193 @@
+"""
+    marvin.httpcache
+    ~~~~~~~~~~~~~~~~
+
+    Caching of whole responses for endpoints that are read a lot more than they change.
+
+    Every cached response depends on one or more resources, identified by keys like ``movie:42``.
+    Each resource has a version, which changes whenever the resource does, see :func:`invalidate`.
+    The ETag of a response is derived from the versions of the resources it depends on, so we can
+    tell whether a client's copy is still fresh, and look up the response in the cache, without
+    touching the database.
+
+    Versions and responses are stored in the caches from :func:`get_cache <marvin.cache.get_cache>`.
+    With the ``redis`` backend they're shared by all processes. With the ``local`` backend every
+    process has its own, and changes made by one process are only seen by the others when their
+    versions expire, after ``RESPONSE_CACHE_TTL_IN_S``.
+
+    Views with a version of their own in the database, like the entries of a stream, can use
+    :func:`get_etag`, :func:`is_fresh` and :func:`not_modified` directly instead.
+
+"""
+from . import db
+from .cache import get_cache
+
+from flask import current_app, g, make_response, request
+from functools import wraps
+from hashlib import sha1
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.http import http_date
+
+import calendar
+import time
+import ujson
+import uuid
+
+#: Key of the resource versions that should be changed when the current transaction commits
+_PENDING_KEY = 'marvin_pending_invalidations'
+
+
+def cached_response(get_keys):
+    """ Decorate a view method to serve its responses from the response cache, and answer conditional
+    requests with 304 Not Modified.
+
+    :param get_keys: Function taking the arguments of the view method, returning the keys of the
+        resources the response depends on. Return None to skip caching for a request.
+    """
+    def decorator(view_method):
+        @wraps(view_method)
+        def wrapper(*args, **kwargs):
+            keys = get_keys(*args[1:], **kwargs)
+            if keys is None:
+                return view_method(*args, **kwargs)
+            # Read the versions before the data, so that a response is never cached under a
+            # version newer than the data in it
+            versions = [_get_or_create_version(key) for key in keys]
+            etag = get_etag(*[token for (token, _), _ in versions])
+            last_modified = max(timestamp for (_, timestamp), _ in versions)
+            headers = {
+                'ETag': '"%s"' % etag,
+                'Last-Modified': http_date(last_modified),
+                # Responses to logged in users contain private data
+                'Cache-Control': 'private, no-cache' if g.get('user') else 'no-cache',
+            }
+
+            # Only a response this client has been given successfully can be cached, or not modified. The
+            # ETag covers the user, so the view has checked that the resources exist and can be read.
+            cache = _get_response_cache()
+            body = cache.get(etag)
+            if body is None:
+                # Don't keep the versions we created for a response that fails, the resources might not
+                # even exist
+                try:
+                    result = view_method(*args, **kwargs)
+                except Exception:
+                    _delete_created_versions(keys, versions)
+                    raise
+                if not isinstance(result, dict):
+                    # Not a plain successful response, don't cache it
+                    _delete_created_versions(keys, versions)
+                    return result
+                body = ujson.dumps(result)
+                cache.set(etag, body, current_app.config['RESPONSE_CACHE_TTL_IN_S'])
+            if is_fresh(etag, last_modified):
+                return not_modified(headers)
+            response = make_response(body, 200)
+            response.headers.extend(headers)
+            response.headers['Content-Type'] = 'application/json'
+            return response
+        return wrapper
+    return decorator
+
+
+def get_version(key):
+    """ Get the current ``(version, timestamp)`` of the resource with the given key, creating one if necessary. """
+    return _get_or_create_version(key)[0]
+
+
+def _get_or_create_version(key):
+    """ Like :func:`get_version`, but returns a tuple of the version and whether we created it. """
+    versions = _get_version_cache()
+    version = versions.get(key)
+    if version is not None:
+        return version, False
+    version = _new_version()
+    if not versions.add(key, version, current_app.config['RESPONSE_CACHE_TTL_IN_S']):
+        # Someone else created it first, use theirs
+        return versions.get(key) or version, False
+    return version, True
+
+
+def _delete_created_versions(keys, versions):
+    version_cache = _get_version_cache()
+    for key, (_, created) in zip(keys, versions):
+        if created:
+            version_cache.delete(key)
+
+
+def invalidate(*keys):
+    """ Change the version of the resources with the given keys when the current transaction commits.
+
+    Waiting for the commit means no one can cache the old data under the new version in the meantime.
+    """
+    pending = db.session.info.setdefault(_PENDING_KEY, set())
+    pending.update(keys)
+
+
+def invalidate_now(*keys):
+    """ Change the version of the resources with the given keys right away. """
+    versions = _get_version_cache()
+    for key in keys:
+        version = _new_version()
+        previous = versions.get(key)
+        if previous is not None and version[1] <= previous[1]:
+            # Last-Modified only has a resolution of a second, so make sure a change within the same
+            # second as the previous one still looks modified to clients sending If-Modified-Since
+            version = (version[0], previous[1] + 1)
+        versions.set(key, version, current_app.config['RESPONSE_CACHE_TTL_IN_S'])
+
+
+@event.listens_for(Session, 'after_commit')
+def _on_commit(session):
+    """ Apply the invalidations of the committed transaction. """
+    keys = session.info.pop(_PENDING_KEY, None)
+    if keys:
+        invalidate_now(*keys)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _on_rollback(session):
+    """ The changes were never made, so there's nothing to invalidate. """
+    session.info.pop(_PENDING_KEY, None)
+
+
+def get_etag(*tokens):
+    """ Get the ETag of the response to the current request, given tokens identifying the versions of the
+    data in it.
+    """
+    user = g.get('user')
+    user_id = user.id if user else None
+    hasher = sha1()
+    # Responses contain absolute URLs, and private data for the logged in user
+    for part in [request.url_root, request.full_path, str(user_id)] + list(tokens):
+        hasher.update(part.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def is_fresh(etag, last_modified=None):
+    """ Whether the client's copy of the response is still fresh, according to the conditional request headers. """
+    if request.if_none_match:
+        return etag in request.if_none_match
+    if request.if_modified_since and last_modified is not None:
+        return last_modified <= calendar.timegm(request.if_modified_since.utctimetuple())
+    return False
+
+
+def not_modified(headers):
+    """ Get a 304 Not Modified response with the given headers. """
+    response = make_response('', 304)
+    response.headers.extend(headers)
+    return response
+
+
+def _new_version():
+    return (uuid.uuid4().hex, int(time.time()))
+
+
+def _get_version_cache():
+    return get_cache('resource-versions', current_app.config['RESPONSE_CACHE_SIZE'])
+
+
+def _get_response_cache():
+    return get_cache('responses', current_app.config['RESPONSE_CACHE_SIZE'])
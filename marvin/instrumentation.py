@@ -0,0 +1,175 @@
+"""
+    marvin.instrumentation
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures where the time goes in every request.
+
+    For each request we record how long it took, how many SQL statements it executed and how long
+    they took, and how long it took to serialize the response. These are:
+
+    * Logged to the ``marvin.requests`` logger, as a line of ``key=value`` pairs, with the values
+      also available to log formatters as the ``request_metrics`` attribute of the record.
+    * Added to the response as a ``Server-Timing`` header when debugging, or when
+      ``INSTRUMENTATION_SERVER_TIMING`` is set, so they show up in the browser's developer tools.
+    * Aggregated per resource in histograms, served in the Prometheus text format at ``/metrics``
+      by :mod:`marvin.views.metrics` if ``METRICS_ENABLED`` is set. Each process has it's own.
+
+    Statements are timed with SQLAlchemy engine events, which only record anything while handling
+    a request. Other parts of the code can time themselves with :func:`record_timing`.
+
+"""
+from flask import current_app, g, has_request_context, request
+from logging import getLogger
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from threading import Lock
+
+import time
+
+_logger = getLogger('marvin.requests')
+
+_metrics_lock = Lock()
+
+
+def init_app(app):
+    """ Start instrumenting requests to `app`, unless disabled with ``INSTRUMENTATION_ENABLED``. """
+    if not app.config['INSTRUMENTATION_ENABLED']:
+        return
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+
+def record_timing(name, duration):
+    """ Add `duration` seconds to the time spent on `name` in the current request, if any. """
+    if has_request_context() and 'marvin_timings' in g:
+        g.marvin_timings[name] = g.marvin_timings.get(name, 0.0) + duration
+
+
+def get_metrics():
+    """ Get the aggregated metrics of this process, as a dict of ``(resource, method)`` to a dict of:
+
+    * ``buckets``: Number of requests that finished within each of ``INSTRUMENTATION_BUCKETS_IN_S``.
+    * ``count``: Number of requests.
+    * ``duration``: Total time spent on the requests, in seconds.
+    * ``queries``: Total number of SQL statements executed.
+    * ``db``: Total time spent executing SQL statements, in seconds.
+    * ``serialize``: Total time spent serializing responses, in seconds.
+    """
+    with _metrics_lock:
+        metrics = current_app.extensions.setdefault('marvin_metrics', {})
+        return dict((key, dict(value, buckets=list(value['buckets']))) for key, value in metrics.items())
+
+
+def render_prometheus_metrics(metrics, buckets):
+    """ Render the metrics from :func:`get_metrics` in the Prometheus text format. """
+    lines = [
+        '# HELP marvin_request_duration_seconds Time spent handling requests.',
+        '# TYPE marvin_request_duration_seconds histogram',
+    ]
+    for (resource, method), values in sorted(metrics.items()):
+        labels = 'resource="%s",method="%s"' % (resource, method)
+        for upper_bound, count in zip(buckets, values['buckets']):
+            lines.append('marvin_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, upper_bound, count))
+        lines.append('marvin_request_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels, values['count']))
+        lines.append('marvin_request_duration_seconds_sum{%s} %f' % (labels, values['duration']))
+        lines.append('marvin_request_duration_seconds_count{%s} %d' % (labels, values['count']))
+    for name, key, help_text in [
+            ('marvin_request_queries_total', 'queries', 'SQL statements executed while handling requests.'),
+            ('marvin_request_db_seconds_total', 'db', 'Time spent executing SQL statements while handling requests.'),
+            ('marvin_request_serialize_seconds_total', 'serialize', 'Time spent serializing responses.')]:
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s counter' % name)
+        for (resource, method), values in sorted(metrics.items()):
+            lines.append('%s{resource="%s",method="%s"} %s' % (name, resource, method, values[key]))
+    return '\n'.join(lines) + '\n'
+
+
+def _start_request():
+    g.marvin_request_start = time.time()
+    g.marvin_timings = {}
+    g.marvin_query_count = 0
+
+
+def _finish_request(response):
+    if 'marvin_request_start' not in g:
+        # Something went wrong before we got to start
+        return response
+    duration = time.time() - g.marvin_request_start
+    timings = g.marvin_timings
+    metrics = {
+        'resource': get_resource_name(),
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round(duration*1000, 2),
+        'queries': g.marvin_query_count,
+        'db_ms': round(timings.get('db', 0.0)*1000, 2),
+        'serialize_ms': round(timings.get('serialize', 0.0)*1000, 2),
+    }
+    _logger.info(' '.join('%s=%s' % (key, metrics[key]) for key in ('method', 'path', 'resource', 'status',
+        'duration_ms', 'queries', 'db_ms', 'serialize_ms')), extra={'request_metrics': metrics})
+    _record_metrics(metrics['resource'], request.method, duration, g.marvin_query_count, timings)
+    if current_app.debug or current_app.config['INSTRUMENTATION_SERVER_TIMING']:
+        response.headers['Server-Timing'] = ', '.join([
+            'app;dur=%.2f' % (duration*1000),
+            'db;dur=%.2f;desc="%d queries"' % (timings.get('db', 0.0)*1000, g.marvin_query_count),
+            'serialize;dur=%.2f' % (timings.get('serialize', 0.0)*1000),
+        ])
+    return response
+
+
+def get_resource_name():
+    """ The name of the Flask-RESTful resource or view handling the current request. """
+    if request.endpoint is None:
+        return 'unknown'
+    view = current_app.view_functions.get(request.endpoint)
+    view_class = getattr(view, 'view_class', None)
+    return view_class.__name__ if view_class is not None else request.endpoint
+
+
+def _record_metrics(resource, method, duration, queries, timings):
+    buckets = current_app.config['INSTRUMENTATION_BUCKETS_IN_S']
+    with _metrics_lock:
+        metrics = current_app.extensions.setdefault('marvin_metrics', {})
+        values = metrics.get((resource, method))
+        if values is None:
+            values = metrics[(resource, method)] = {
+                'buckets': [0]*len(buckets),
+                'count': 0,
+                'duration': 0.0,
+                'queries': 0,
+                'db': 0.0,
+                'serialize': 0.0,
+            }
+        for index, upper_bound in enumerate(buckets):
+            if duration <= upper_bound:
+                values['buckets'][index] += 1
+        values['count'] += 1
+        values['duration'] += duration
+        values['queries'] += queries
+        values['db'] += timings.get('db', 0.0)
+        values['serialize'] += timings.get('serialize', 0.0)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    if has_request_context() and 'marvin_query_count' in g:
+        conn.info.setdefault('marvin_query_start', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    starts = conn.info.get('marvin_query_start')
+    if starts and has_request_context() and 'marvin_query_count' in g:
+        g.marvin_query_count += 1
+        record_timing('db', time.time() - starts.pop())
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # The statement never finished, so forget when it started
+    starts = context.connection.info.get('marvin_query_start') if context.connection else None
+    if starts:
+        starts.pop()
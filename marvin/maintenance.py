@@ -0,0 +1,164 @@
+"""
+    marvin.maintenance
+    ~~~~~~~~~~~~~~~~~~
+
+    Bulk maintenance of the database, used by the management commands.
+
+    Deleting through the ORM loads every row into the session and deletes them one at a time, which
+    is way too slow and memory hungry for a production sized database. Instead, the rows are deleted
+    with set-based ``DELETE`` statements, a chunk of streams at a time, committing after each chunk
+    so that locks are held briefly and an interrupted run keeps the progress it made.
+
+    Since this bypasses the ORM events, the denormalized counts and the movie title search index are
+    kept up to date here.
+
+"""
+from . import db
+from .counters import discount_rows, reconcile_counters
+from .httpcache import invalidate
+from .models import Entry, Movie, MovieTitleTrigram, Stream
+
+from logging import getLogger
+from sqlalchemy import and_, func, select
+
+_logger = getLogger('marvin.maintenance')
+
+
+def delete_streams(movie_ids=None, creator_ids=None, added_after=None, added_before=None, wipe_movies=False,
+        dry_run=False, chunk_size=1000, progress=None):
+    """ Delete streams and their entries, and optionally the movies too.
+
+    With no scope given, everything is deleted. Scopes given together must all match.
+
+    :param movie_ids: Only delete streams of these movies.
+    :param creator_ids: Only delete streams created by these users.
+    :param added_after: Only delete streams added at or after this (UTC) datetime.
+    :param added_before: Only delete streams added before this (UTC) datetime.
+    :param wipe_movies: Delete the movies too. Can only be scoped by `movie_ids`.
+    :param dry_run: Only count the rows that would be deleted.
+    :param chunk_size: Number of streams or movies to delete per transaction.
+    :param progress: Function called with the table name, the number of rows deleted so far from it,
+        and the total, after every chunk.
+    :returns: A dict of table name to the number of rows to delete, as counted before deleting anything.
+    """
+    if wipe_movies and (creator_ids is not None or added_after is not None or added_before is not None):
+        raise ValueError('Movies can only be deleted by movie, not by user or date.')
+    stream_table = Stream.__table__
+    movie_table = Movie.__table__
+    stream_condition = _get_stream_condition(movie_ids, creator_ids, added_after, added_before)
+    movie_condition = movie_table.c.id.in_(movie_ids) if movie_ids is not None else None
+
+    counts = _count_rows(stream_condition, movie_condition, wipe_movies)
+    if dry_run:
+        return counts
+
+    deleted = _delete_in_chunks(stream_table, stream_condition, chunk_size, _delete_streams_in_range,
+        counts['stream'], progress)
+    if wipe_movies:
+        _delete_in_chunks(movie_table, movie_condition, chunk_size, _delete_movies_in_range, counts['movie'],
+            progress)
+    else:
+        # Fix any counts that were already off, like the old recount did
+        reconcile_counters()
+    _logger.info("Deleted %d streams", deleted)
+    return counts
+
+
+def _get_stream_condition(movie_ids, creator_ids, added_after, added_before):
+    stream_table = Stream.__table__
+    criteria = []
+    if movie_ids is not None:
+        criteria.append(stream_table.c.movie_id.in_(movie_ids))
+    if creator_ids is not None:
+        criteria.append(stream_table.c.creator_id.in_(creator_ids))
+    if added_after is not None:
+        criteria.append(stream_table.c.datetime_added >= added_after)
+    if added_before is not None:
+        criteria.append(stream_table.c.datetime_added < added_before)
+    return and_(*criteria) if criteria else None
+
+
+def _count_rows(stream_condition, movie_condition, wipe_movies):
+    """ Count the rows in each table that would be deleted. """
+    stream_table = Stream.__table__
+    entry_table = Entry.__table__
+    movie_table = Movie.__table__
+    trigram_table = MovieTitleTrigram.__table__
+    counts = {
+        'stream': _count(stream_table, stream_condition),
+        'entry': _count(entry_table, _get_child_condition(entry_table.c.stream_id, stream_table, stream_condition)),
+    }
+    if wipe_movies:
+        counts['movie'] = _count(movie_table, movie_condition)
+        counts['movie_title_trigram'] = _count(trigram_table,
+            _get_child_condition(trigram_table.c.movie_id, movie_table, movie_condition))
+    return counts
+
+
+def _count(table, condition):
+    query = select([func.count()]).select_from(table)
+    if condition is not None:
+        query = query.where(condition)
+    return db.session.execute(query).scalar()
+
+
+def _get_child_condition(foreign_key, parent_table, parent_condition):
+    """ A condition matching the rows whose parent matches `parent_condition`. """
+    if parent_condition is None:
+        return None
+    return foreign_key.in_(select([parent_table.c.id]).where(parent_condition))
+
+
+def _delete_in_chunks(table, condition, chunk_size, delete_range, total, progress):
+    """ Delete the rows of `table` matching `condition`, `chunk_size` rows at a time, by ascending id.
+
+    Each chunk is deleted by its range of ids rather than a list of them, to keep the statements
+    small, and within the limit on bind params of SQLite.
+    """
+    query = select([table.c.id]).order_by(table.c.id.asc()).limit(chunk_size)
+    if condition is not None:
+        query = query.where(condition)
+    deleted = 0
+    last_id = 0
+    while True:
+        # Page by id, so that every chunk is an index range scan
+        ids = [row[0] for row in db.session.execute(query.where(table.c.id > last_id))]
+        if not ids:
+            return deleted
+        chunk_condition = table.c.id.between(ids[0], ids[-1])
+        if condition is not None:
+            chunk_condition = and_(condition, chunk_condition)
+        delete_range(chunk_condition)
+        db.session.commit()
+        deleted += len(ids)
+        last_id = ids[-1]
+        if progress is not None:
+            progress(table.name, deleted, total)
+
+
+def _delete_streams_in_range(condition):
+    """ Delete the streams matching `condition`, and their entries. """
+    stream_table = Stream.__table__
+    entry_table = Entry.__table__
+    affected = db.session.execute(select([stream_table.c.id, stream_table.c.movie_id]).where(condition)).fetchall()
+    discount_rows(Stream, condition)
+    db.session.execute(entry_table.delete().where(
+        _get_child_condition(entry_table.c.stream_id, stream_table, condition)))
+    db.session.execute(stream_table.delete().where(condition))
+    invalidate('movies', *set(['stream:%d' % stream_id for stream_id, _ in affected] +
+        ['movie:%d' % movie_id for _, movie_id in affected]))
+
+
+def _delete_movies_in_range(condition):
+    """ Delete the movies matching `condition`, along with their search index and any streams left. """
+    movie_table = Movie.__table__
+    stream_table = Stream.__table__
+    trigram_table = MovieTitleTrigram.__table__
+    # The streams were deleted first, but new ones might have been created since
+    _delete_streams_in_range(_get_child_condition(stream_table.c.movie_id, movie_table, condition))
+    # ON DELETE CASCADE isn't enforced everywhere
+    db.session.execute(trigram_table.delete().where(
+        _get_child_condition(trigram_table.c.movie_id, movie_table, condition)))
+    movie_ids = [row[0] for row in db.session.execute(select([movie_table.c.id]).where(condition))]
+    db.session.execute(movie_table.delete().where(condition))
+    invalidate('movies', *['movie:%d' % movie_id for movie_id in movie_ids])
@@ -5,13 +5,19 @@
     Configures the manager, and acts as an entry point for the manage command.
 
 """
-# pylint: disable=invalid-name
+# pylint: disable=invalid-name,superfluous-parens
 from . import create_app, db
-from .models import Stream, Entry, Movie
-
+from .counters import reconcile_counters as _reconcile_counters
+from .maintenance import delete_streams
+from .profiling import make_profiling_token
+from .relevancy import recompute_relevancy as _recompute_relevancy
+from .search import rebuild_index
+from .security import calibrate_scrypt_params
+from .stats import refresh_stats as _refresh_stats
+
+from datetime import datetime
 from flask.ext.script import Manager
 from flask.ext.migrate import Migrate, MigrateCommand
-
 from os import path
 
 app = create_app()
@@ -29,39 +35,106 @@ def runserver(): # pragma: no cover
     dev_app.run()
 
 
+@manager.option('-w', '--wipe_movies', action='store_true', help='Delete the movies too')
+@manager.option('-d', '--dry_run', action='store_true', help='Only count the rows that would be deleted')
+@manager.option('-m', '--movies', help='Only delete streams of these movies, as comma-separated IDs')
+@manager.option('-u', '--users', help='Only delete streams created by these users, as comma-separated IDs')
+@manager.option('--added_after', help='Only delete streams added on or after this date, as YYYY-MM-DD')
+@manager.option('--added_before', help='Only delete streams added before this date, as YYYY-MM-DD')
+@manager.option('-c', '--chunk_size', type=int, default=1000, help='Number of rows to delete per transaction')
+def delete_streams_and_entries(wipe_movies=False, dry_run=False, movies=None, users=None, added_after=None,
+        added_before=None, chunk_size=1000):
+    """ Delete streams and their entries.
+
+    Deletes everything by default, or only the streams of the given --movies, by the given --users
+    (comma-separated IDs), or added in the range --added_after to --added_before (YYYY-MM-DD, UTC).
+    Can optionally also delete the movies, if the --wipe_movies flag is used, which can only be scoped
+    by movie. Use --dry_run to only see how many rows would be deleted. """
+    try:
+        scope = {
+            'movie_ids': _parse_ids(movies),
+            'creator_ids': _parse_ids(users),
+            'added_after': _parse_date(added_after),
+            'added_before': _parse_date(added_before),
+        }
+    except ValueError as error:
+        print('Invalid arguments: %s' % error)
+        return
+
+    def report_progress(table_name, deleted, total):
+        """ Print how far we've come. """
+        print('Deleted %d/%d rows from %s' % (deleted, total, table_name))
+
+    try:
+        counts = delete_streams(wipe_movies=wipe_movies, dry_run=dry_run, chunk_size=chunk_size,
+            progress=report_progress, **scope)
+    except ValueError as error:
+        print(error)
+        return
+    for table_name, count in sorted(counts.items()):
+        print('%s %d rows from %s' % ('Would delete' if dry_run else 'Deleted', count, table_name))
+
+
+def _parse_ids(value):
+    """ Parse a comma-separated list of IDs, or None if not given. """
+    if value is None:
+        return None
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+def _parse_date(value):
+    """ Parse a YYYY-MM-DD date, or None if not given. """
+    if value is None:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d')
+
+
 @manager.command
-def delete_streams_and_entries(wipe_movies=False):
-    """ Delete all streams and entries.
+def reconcile_counters():
+    """ Recount the denormalized counts, like the number of streams of each movie, fixing any that are off. """
+    fixed = _reconcile_counters()
+    for name, number_of_rows in sorted(fixed.items()):
+        print('Fixed the %s of %d rows' % (name, number_of_rows))
 
-    After deletion it will reset movie stream counts to 0. Can optionally also
-    delete all movies, if the --wipe_movies flag is used. """
 
-    all_streams = Stream.query.all()
-    for stream in all_streams:
-        db.session.delete(stream)
-    all_entries = Entry.query.all()
-    for entry in all_entries:
-        db.session.delete(entry)
+@manager.command
+def rebuild_search_index():
+    """ Rebuild the movie title search index from scratch. """
+    rebuild_index()
 
-    if wipe_movies:
-        all_movies = Movie.query.all()
-        for movie in all_movies:
-            db.session.delete(movie)
-    else:
-        # Just reset the stream counts
-        reset_movie_stream_counts()
-    db.session.commit()
+
+@manager.command
+def recompute_relevancy(recompute_all=False):
+    """ Recalculate stale movie relevancy scores, or all of them if the --recompute_all flag is used. """
+    updated = _recompute_relevancy(only_stale=not recompute_all, chunk_size=app.config['RELEVANCY_CHUNK_SIZE'])
+    print('Recalculated relevancy for %d movies' % updated)
 
 
 @manager.command
-def reset_movie_stream_counts():
-    """ Recount the movie number_of_streams where it's > 0. """
-    movies_with_stream_count = Movie.query.filter(Movie.number_of_streams > 0).all()
-    for movie in movies_with_stream_count:
-        movie.number_of_streams = len([s for s in movie.streams if s.public])
-    db.session.commit()
+def refresh_stats():
+    """ Recount the statistics shown on the stats page, without waiting for the refresh-stats task. """
+    print('Refreshed %d statistics' % _refresh_stats())
 
 
+@manager.command
+def profiling_token():
+    """ Print a token that gets requests profiled when sent in the PROFILING_HEADER header. """
+    with app.app_context():
+        print('%s: %s' % (app.config['PROFILING_HEADER'], make_profiling_token()))
+
+
+@manager.option('-c', '--config-file', dest='config_file', help='Append the resulting SCRYPT_PARAMS to this file')
+def calibrate_scrypt(config_file=None):
+    """ Find scrypt params for this machine, within SCRYPT_TARGET_TIME_IN_S and SCRYPT_MAX_MEMORY_IN_BYTES. """
+    with app.app_context():
+        params = calibrate_scrypt_params(app.config['SCRYPT_TARGET_TIME_IN_S'],
+            app.config['SCRYPT_MAX_MEMORY_IN_BYTES'])
+    setting = 'SCRYPT_PARAMS = (%d, %d, %d)' % params
+    print(setting)
+    if config_file:
+        with open(config_file, 'a') as config_fh:
+            config_fh.write('\n%s\n' % setting)
+
 
 @manager.command
 def init_db():
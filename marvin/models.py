@@ -8,13 +8,17 @@
 """
 from . import db
 from .fields import JSONField
-from .security import generate_pw_hash
+from .security import generate_pw_hash, get_token_serializer, uncache_user
+from .utils import external_url
 
 from datetime import datetime
-from flask import url_for, current_app
+from flask import url_for
 from flask.ext.wtf import Form
 from flask.ext.principal import Permission, UserNeed
-from itsdangerous import constant_time_compare, URLSafeSerializer
+from itsdangerous import constant_time_compare
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy_defaults import Column
 from sqlalchemy_utils import EmailType, JSONType
 from time import time
@@ -53,7 +57,7 @@ class Movie(db.Model):
     year = Column(db.Integer, min=1880, max=2050)
     #: Small cover art, 300px-ish
     cover_img = Column(db.String(100), nullable=True)
-    #: An aggregate of number of streams available
+    #: Number of public streams of the movie, kept up to date by :mod:`marvin.counters`
     number_of_streams = Column(db.Integer, default=0, nullable=False, min=0)
     # Movie duration, in seconds
     duration_in_s = Column(db.Integer, min=0)
@@ -65,6 +69,9 @@ class Movie(db.Model):
     metascore = Column(db.Integer, default=0, min=0, max=100, nullable=False)
     # A measurement of how relevant this movie is, used for search ranking purposes
     relevancy = Column(db.Float, min=0.0, default=0, nullable=False)
+    #: When the relevancy was last calculated, in local time. The relevancy depends on the current
+    #: year, so it's stale if this is before the start of the year, see :mod:`marvin.relevancy`.
+    relevancy_computed_at = Column(db.DateTime, nullable=True, index=True)
 
 
     def __init__(self, **kwargs):
@@ -78,7 +85,7 @@ class Movie(db.Model):
     def to_json(self, include_streams=True):
         """ A dict representation of the movie that can be used for serialization. """
         movie = {
-            'href': url_for('moviedetailview', movie_id=self.id, _external=True),
+            'href': external_url('moviedetailview', movie_id=self.id),
             'external_id': self.external_id,
             'title': self.title,
             'category': self.category,
@@ -91,29 +98,56 @@ class Movie(db.Model):
             'metascore': self.metascore,
             'duration_in_s': self.duration_in_s,
             '_links': {
-                'createStream': url_for('createstreamview', movie_id=self.id, _external=True),
+                'createStream': external_url('createstreamview', movie_id=self.id),
             },
         }
         if include_streams:
-            streams = [s for s in self.streams if s.public or Permission(UserNeed(s.creator_id))]
+            # Load the creators in the same query, since every stream will need it for serialization
+            streams = self.streams.options(joinedload('creator'))
+            streams = [s for s in streams if s.public or Permission(UserNeed(s.creator_id))]
             movie['streams'] = [stream.to_json(include_movie=False) for stream in streams]
         return movie
 
 
     def update_relevancy(self):
-        """ Calculate a new relevancy rating for the movie.
+        """ Calculate a new relevancy rating for the movie. See :func:`compute_relevancy`. """
+        now = datetime.now()
+        self.relevancy = compute_relevancy(self.imdb_rating, self.metascore, self.number_of_imdb_votes, self.year,
+            now.year)
+        self.relevancy_computed_at = now
+
+
+def compute_relevancy(imdb_rating, metascore, number_of_imdb_votes, year, current_year=None):
+    """ Calculate the relevancy rating for a movie with the given properties.
+
+    The IMDb rating is weighted the most, contributing a potential 200 points out of a 325 max,
+    while the metascore ranking can contribute another 100 points, 25 points for number of
+    votes, and then the score is discounted by a factor of .99 for each year since it's relase.
+
+    :param current_year: The year to calculate the age of the movie from, defaults to this year.
+    """
+    imdb_ranking = 20*imdb_rating
+    metascore_ranking = metascore
+    imdb_votes_ranking = min(number_of_imdb_votes, 25000) // 1000
+    current_year = current_year or datetime.now().year
+    years_since_release = current_year - (year or 1900)
+    age_discount = 0.99**(years_since_release)
+    return (imdb_ranking + imdb_votes_ranking + metascore_ranking)*age_discount
 
-        The IMDb rating is weighted the most, contributing a potential 200 points out of a 325 max,
-        while the metascore ranking can contribute another 100 points, 25 points for number of
-        votes, and then the score is discounted by a factor of .99 for each year since it's relase.
-        """
-        imdb_ranking = 20*self.imdb_rating
-        metascore_ranking = self.metascore
-        imdb_votes_ranking = min(self.number_of_imdb_votes, 25000) / 1000
-        current_year = datetime.now().year
-        years_since_release = current_year - (self.year or 1900)
-        age_discount = 0.99**(years_since_release)
-        self.relevancy = (imdb_ranking + imdb_votes_ranking + metascore_ranking)*age_discount
+
+class MovieTitleTrigram(db.Model):
+    """ A three character slice of a lowercased movie title.
+
+    Together these make up the inverted index used to search for movies on databases without
+    native trigram support. The rows are maintained automatically by :mod:`marvin.search` whenever a
+    movie is inserted, renamed or deleted, so there should be no need to touch them manually.
+    """
+    __lazy_options__ = {}
+
+    #: The trigram, always lowercase
+    trigram = Column(db.String(3), primary_key=True)
+    #: Foreign key to the movie the trigram was found in
+    movie_id = Column(db.Integer, db.ForeignKey('movie.id', ondelete='CASCADE'), primary_key=True, index=True)
 
 
 class MovieForm(ModelForm):
@@ -140,16 +174,23 @@ class Stream(db.Model):
     #: Short description of the stream
     description = Column(db.String(140), nullable=False, default='')
     #: Foreign key to a movie
-    movie_id = Column(db.Integer, db.ForeignKey('movie.id'), nullable=False)
+    movie_id = Column(db.Integer, db.ForeignKey('movie.id'), nullable=False, index=True)
     #: The movie this stream is associated to.
     movie = db.relationship('Movie', backref=db.backref('streams', lazy='dynamic'))
     #: Foreign key to the user that created the stream
-    creator_id = Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    creator_id = Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     #: The user that created the stream
     creator = db.relationship('User', backref=db.backref('created_streams', lazy='dynamic'))
     #: Whether the stream is visible public. Must be set explicitly to True by the user when he/she
     #: considers the stream done.
     public = Column(db.Boolean, default=False, nullable=False)
+    #: When the stream was created, in UTC. Unknown for streams created before this was recorded.
+    datetime_added = Column(db.DateTime, auto_now=True, nullable=True, index=True)
+    #: Incremented whenever the entries of the stream, or how they're presented, change. Lets us tell
+    #: whether a client's copy of the entries is still fresh without loading them.
+    entries_version = Column(db.Integer, default=0, nullable=False)
+    #: Number of entries in the stream, kept up to date by :mod:`marvin.counters`
+    number_of_entries = Column(db.Integer, default=0, nullable=False, min=0)
 
 
     def __init__(self, movie=None, creator=None, **kwargs):
@@ -167,24 +208,24 @@ class Stream(db.Model):
     def to_json(self, include_movie=True):
         """ Get a dict representation of the stream suitable for serialization. """
         stream = {
-            'href': url_for('streamdetailview', stream_id=self.id, _external=True),
+            'href': external_url('streamdetailview', stream_id=self.id),
             'name': self.name,
             'published': self.public,
             'description': self.description,
             'author': {
                 'username': self.creator.username,
-                'href': url_for('userdetailview', user_id=self.creator.id, _external=True),
+                'href': external_url('userdetailview', user_id=self.creator.id),
             },
             '_links': {
-                'createEntry': url_for('createentryview', stream_id=self.id, _external=True),
-                'entries': url_for('streamentryview', stream_id=self.id, _external=True),
-                'publish': url_for('publishstreamview', stream_id=self.id, _external=True),
-                'unpublish': url_for('unpublishstreamview', stream_id=self.id, _external=True),
+                'createEntry': external_url('createentryview', stream_id=self.id),
+                'entries': external_url('streamentryview', stream_id=self.id),
+                'publish': external_url('publishstreamview', stream_id=self.id),
+                'unpublish': external_url('unpublishstreamview', stream_id=self.id),
             }
         }
         if include_movie:
             stream['movie'] = {
-                'href': url_for('moviedetailview', movie_id=self.movie_id, _external=True),
+                'href': external_url('moviedetailview', movie_id=self.movie_id),
                 'title': self.movie.title,
             }
         return stream
@@ -205,6 +246,10 @@ class StreamForm(ModelForm):
 class Entry(db.Model):
     """ User-created content that appears at a given time in the movie. """
     __lazy_options__ = {}
+    __table_args__ = (
+        # Entries are always fetched for a single stream, in order of appearance
+        db.Index('ix_entry_stream_id_entry_point_in_ms', 'stream_id', 'entry_point_in_ms', 'id'),
+    )
 
     #: Unique identifier
     id = Column(db.Integer, primary_key=True)
@@ -243,13 +288,13 @@ class Entry(db.Model):
     def to_json(self):
         """ Get a dict representation of the entry suitable for serialization. """
         return {
-            'href': url_for('entrydetailview', entry_id=self.id, _external=True),
+            'href': external_url('entrydetailview', entry_id=self.id),
             'entry_point_in_ms': self.entry_point_in_ms,
             'content_type': self.content_type,
             'content': self.content,
             'title': self.title,
             'stream': {
-                'href': url_for('streamdetailview', stream_id=self.stream_id, _external=True),
+                'href': external_url('streamdetailview', stream_id=self.stream_id),
                 'name': self.stream.name,
             },
         }
@@ -284,6 +329,8 @@ class User(db.Model):
     password_hash = Column(db.String(250))
     #: Date and time of signup
     user_created_datetime = Column(db.DateTime, auto_now=True)
+    #: Number of public streams created by the user, kept up to date by :mod:`marvin.counters`
+    number_of_published_streams = Column(db.Integer, default=0, nullable=False, min=0)
 
 
     def __init__(self, **kwargs):
@@ -322,16 +369,17 @@ class User(db.Model):
 
         :param include_personal_data: Whether to include sensitive data such as email.
         """
-        streams = [s for s in self.created_streams if include_personal_data or s.public]
+        created_streams = self.created_streams.options(joinedload('movie'))
+        streams = [s for s in created_streams if include_personal_data or s.public]
         data = {
             'username': self.username,
             'href': url_for('userdetailview', user_id=self.id),
             'streams': [{
-                'href': url_for('streamdetailview', stream_id=s.id, _external=True),
+                'href': external_url('streamdetailview', stream_id=s.id),
                 'name': s.name,
                 'published': s.public,
                 'movie': {
-                    'href': url_for('moviedetailview', movie_id=s.movie.id, _external=True),
+                    'href': external_url('moviedetailview', movie_id=s.movie.id),
                     'title': s.movie.title,
                 },
                 } for s in streams],
@@ -356,8 +404,7 @@ class User(db.Model):
             # expired if the user changes password
             'p': self.password_hash[-10:],
         }
-        serializer = URLSafeSerializer(current_app.config['SECRET_KEY'])
-        return serializer.dumps(data)
+        return get_token_serializer().dumps(data)
 
 
     def verify_auth_data(self, auth_data):
@@ -369,6 +416,65 @@ class User(db.Model):
         return constant_time_compare(auth_data['p'].encode('ascii'), self.password_hash[-10:].encode('ascii'))
 
 
+@event.listens_for(User, 'after_update')
+def on_user_updated(mapper, connection, user): # pylint: disable=unused-argument
+    """ Make sure auth tokens issued before a password change can't be used with a cached user. """
+    if get_history(user, 'password_hash').has_changes():
+        uncache_user(user.id)
+
+
+@event.listens_for(User, 'after_delete')
+def on_user_deleted(mapper, connection, user): # pylint: disable=unused-argument
+    """ Make sure deleted users can't authenticate with a cached user. """
+    uncache_user(user.id)
+
+
+@event.listens_for(Stream, 'before_update')
+def on_stream_updated(mapper, connection, stream): # pylint: disable=unused-argument
+    """ Entries include the name of their stream, and can only be read from public streams. """
+    if get_history(stream, 'name').has_changes() or get_history(stream, 'public').has_changes():
+        # Increment in the database, so that concurrent changes aren't lost
+        stream.entries_version = Stream.entries_version + 1
+
+
+@event.listens_for(Entry, 'after_insert')
+@event.listens_for(Entry, 'after_delete')
+def on_entry_added_or_deleted(mapper, connection, entry): # pylint: disable=unused-argument
+    """ Make clients refetch the entries of the stream. """
+    _bump_entries_version(connection, [entry.stream_id])
+
+
+@event.listens_for(Entry, 'after_update')
+def on_entry_updated(mapper, connection, entry): # pylint: disable=unused-argument
+    """ Make clients refetch the entries of the stream, and the one it was moved from, if any. """
+    added, _, deleted = get_history(entry, 'stream_id')
+    stream_ids = set(added or [entry.stream_id]) | set(deleted or [])
+    _bump_entries_version(connection, [stream_id for stream_id in stream_ids if stream_id is not None])
+
+
+def _bump_entries_version(connection, stream_ids):
+    stream_table = Stream.__table__
+    connection.execute(stream_table.update()
+        .where(stream_table.c.id.in_(stream_ids))
+        .values(entries_version=stream_table.c.entries_version + 1))
+
+
+class Statistic(db.Model):
+    """ A precomputed aggregate about the database, like the number of published streams.
+
+    Counting the big tables is too slow to do on every view of the stats page, so the aggregates are
+    recomputed periodically by :mod:`marvin.stats`, and read from here.
+    """
+    __lazy_options__ = {}
+
+    #: What's been counted, like ``movies``, ``streams:published`` or ``signups:2014-06-01``
+    key = Column(db.String(100), primary_key=True)
+    #: The count
+    value = Column(db.Integer, nullable=False)
+    #: When the count was made
+    computed_at = Column(db.DateTime, nullable=False)
+
+
 class AnonymousUser(object):
     """ Represents an anonymous user. """
 
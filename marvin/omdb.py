@@ -0,0 +1,147 @@
+"""
+    marvin.omdb
+    ~~~~~~~~~~~
+
+    A client for the OMDb API, shared by everything talking to it.
+
+    The client keeps connections to OMDb alive between requests, retries requests that fail because
+    of the network or a server error, and caches responses so that repeated searches and metadata
+    refreshes don't fetch the same data over and over again. Responses are cached in memory, and
+    also on disk if ``OMDB_CACHE_DIR`` is set, so that they survive restarts and are shared between
+    processes on the same machine.
+
+"""
+
+from .cache import DiskCache, LocalCache
+
+from flask import current_app
+from logging import getLogger
+
+try:
+    from urllib import urlencode
+except ImportError: # pragma: no cover
+    from urllib.parse import urlencode
+
+import requests
+import textwrap
+import time
+
+_logger = getLogger('marvin.omdb')
+
+
+def get_omdb_client():
+    """ Get the OMDb client for the current app, configured by the ``OMDB_*`` settings. """
+    client = current_app.extensions.get('marvin_omdb_client')
+    if client is None:
+        config = current_app.config
+        caches = []
+        if config['OMDB_CACHE_SIZE']:
+            caches.append(LocalCache(config['OMDB_CACHE_SIZE']))
+        if config['OMDB_CACHE_DIR']:
+            caches.append(DiskCache(config['OMDB_CACHE_DIR']))
+        client = OMDbClient(config['OMDB_URL'],
+            timeout=config['OMDB_TIMEOUT_IN_S'],
+            retries=config['OMDB_RETRIES'],
+            pool_size=config['OMDB_CONNECTION_POOL_SIZE'],
+            caches=caches,
+            ttls={
+                's': config['OMDB_SEARCH_CACHE_TTL_IN_S'],
+                'i': config['OMDB_LOOKUP_CACHE_TTL_IN_S'],
+            })
+        client = current_app.extensions.setdefault('marvin_omdb_client', client)
+    return client
+
+
+def get_cache_key(params):
+    """ Get the key a query with the given params is cached by.
+
+    Names are lowercased, and values are stripped, lowercased and have repeated whitespace removed,
+    since OMDb doesn't care about any of it. Values that aren't strings, like numbers, are converted first.
+    """
+    normalized = sorted((name.lower(), ' '.join(unicode(value).lower().split())) for name, value in params.items())
+    return 'omdb:' + urlencode([(name, value.encode('utf-8')) for name, value in normalized])
+
+
+class OMDbClient(object):
+    """ Makes requests to OMDb, over pooled keep-alive connections, with retries and caching.
+
+    Safe to share between threads.
+
+    :param url: The OMDb API URL.
+    :param timeout: Seconds to wait for OMDb to respond.
+    :param retries: How many times to retry requests failing because of connection errors, timeouts
+        or server errors.
+    :param backoff: Seconds to wait before the first retry. The wait is doubled for every retry after.
+    :param pool_size: Maximum number of connections to keep open to OMDb.
+    :param caches: The caches to look up responses in, in order. Responses are stored in all of them.
+    :param ttls: Number of seconds to cache responses for, by the name of the param determining the
+        kind of query, like ``s`` for searches. Queries not matching any of them aren't cached.
+    :param session: The requests session to use, mostly here for testing.
+    """
+
+    def __init__(self, url, timeout=10, retries=2, backoff=0.5, pool_size=10, caches=(), ttls=None, session=None):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.caches = list(caches)
+        self.ttls = ttls or {}
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+
+    def get(self, params):
+        """ Query OMDb with the given params, returning the decoded JSON response.
+
+        Returns None if OMDb responded with an error. Raises :class:`requests.RequestException` if
+        we couldn't get a response after all the retries.
+        """
+        ttl = self._get_ttl(params)
+        cache_key = get_cache_key(params) if ttl else None
+        if cache_key:
+            for index, cache in enumerate(self.caches):
+                result = cache.get(cache_key)
+                if result is not None:
+                    # Populate the faster caches we missed in
+                    for faster_cache in self.caches[:index]:
+                        faster_cache.set(cache_key, result, ttl)
+                    return result
+        result = self._request(params)
+        if cache_key and result is not None:
+            for cache in self.caches:
+                cache.set(cache_key, result, ttl)
+        return result
+
+
+    def _get_ttl(self, params):
+        for name, ttl in self.ttls.items():
+            if name in params:
+                return ttl
+        return None
+
+
+    def _request(self, params):
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(self.url, params=params, timeout=self.timeout)
+                if response.status_code < 500 or attempt >= self.retries:
+                    break
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+                _logger.warning("Request to OMDb failed, retrying", exc_info=True)
+            time.sleep(self.backoff*2**attempt)
+            attempt += 1
+        if response.status_code != 200:
+            _logger.error(textwrap.dedent("""OMDb query returned non-200 status code.
+                URL:         %s
+                Status code: %d
+                Response:    %s
+            """), response.url, response.status_code, response.text)
+            return None
+        return response.json()
@@ -0,0 +1,137 @@
+"""
+    marvin.profiling
+    ~~~~~~~~~~~~~~~~
+
+    Profiles requests under real traffic, with a sampling profiler.
+
+    A request is profiled if it has a valid token from :func:`make_profiling_token` in the
+    ``PROFILING_HEADER`` header, or by chance, for a ``PROFILING_SAMPLE_RATE`` share of all requests.
+    While it's handled, a background thread looks at the stack of the thread handling it every
+    ``PROFILING_INTERVAL_IN_S`` seconds, which costs far less than tracing every call like cProfile.
+
+    The stacks sampled are appended to a file per resource and method in ``PROFILING_OUTPUT_DIR``,
+    like ``MovieDetailView.GET.collapsed``, in the collapsed format read by flame graph tools::
+
+        $ flamegraph.pl profiles/MovieDetailView.GET.collapsed > movie_detail.svg
+
+    Profiling is disabled unless ``PROFILING_OUTPUT_DIR`` is set.
+
+"""
+from .instrumentation import get_resource_name
+
+from flask import current_app, g, request
+from itsdangerous import BadData, URLSafeTimedSerializer
+from logging import getLogger
+from os import path
+from threading import Event, Lock, Thread
+
+import os
+import random
+import sys
+
+try:
+    from threading import get_ident
+except ImportError: # pragma: no cover
+    from thread import get_ident
+
+_logger = getLogger('marvin.profiling')
+
+_output_lock = Lock()
+
+
+def init_app(app):
+    """ Start profiling some requests to `app`, if ``PROFILING_OUTPUT_DIR`` is set. """
+    output_dir = app.config['PROFILING_OUTPUT_DIR']
+    if output_dir is None:
+        return
+    if not path.isdir(output_dir):
+        os.makedirs(output_dir)
+    app.before_request(_start_profiling)
+    app.teardown_request(_finish_profiling)
+
+
+def make_profiling_token():
+    """ Create a token that makes requests carrying it in the ``PROFILING_HEADER`` header get profiled,
+    for the next ``PROFILING_TOKEN_MAX_AGE_IN_S`` seconds.
+    """
+    return _get_token_serializer().dumps('profile')
+
+
+def collapse_stack(frame):
+    """ Describe the stack ending in `frame` as the functions called, outermost first, separated by ``;``. """
+    functions = []
+    while frame is not None:
+        functions.append('%s.%s' % (frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(functions))
+
+
+class Sampler(object):
+    """ Samples the stack of a thread from a background thread, until stopped.
+
+    :param thread_id: The ident of the thread to sample.
+    :param interval: Number of seconds between samples.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        #: Number of samples of each collapsed stack
+        self.counts = {}
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name='profiling-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        """ Stop sampling, and get the number of samples of each collapsed stack. """
+        self._stopped.set()
+        self._thread.join()
+        return self.counts
+
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id) # pylint: disable=protected-access
+            if frame is None:
+                break
+            stack = collapse_stack(frame)
+            self.counts[stack] = self.counts.get(stack, 0) + 1
+
+
+def _should_profile():
+    token = request.headers.get(current_app.config['PROFILING_HEADER'])
+    if token is not None:
+        try:
+            return _get_token_serializer().loads(token,
+                max_age=current_app.config['PROFILING_TOKEN_MAX_AGE_IN_S']) == 'profile'
+        except BadData:
+            _logger.warning('Invalid profiling token from %s', request.remote_addr)
+            return False
+    return random.random() < current_app.config['PROFILING_SAMPLE_RATE']
+
+
+def _start_profiling():
+    if _should_profile():
+        g.marvin_sampler = Sampler(get_ident(), current_app.config['PROFILING_INTERVAL_IN_S'])
+
+
+def _finish_profiling(exception=None): # pylint: disable=unused-argument
+    sampler = getattr(g, 'marvin_sampler', None)
+    if sampler is None:
+        return
+    g.marvin_sampler = None
+    counts = sampler.stop()
+    if not counts:
+        return
+    filename = '%s.%s.collapsed' % (get_resource_name(), request.method)
+    output_path = path.join(current_app.config['PROFILING_OUTPUT_DIR'], filename)
+    with _output_lock:
+        with open(output_path, 'a') as output_fh:
+            for stack, count in counts.items():
+                output_fh.write('%s %d\n' % (stack, count))
+
+
+def _get_token_serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='profiling')
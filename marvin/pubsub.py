@@ -0,0 +1,141 @@
+"""
+    marvin.pubsub
+    ~~~~~~~~~~~~~
+
+    A minimal publish/subscribe interface, used to notify listeners about changes as they happen.
+
+    Two backends are available, selected by the ``PUBSUB_BACKEND`` setting:
+
+    * ``local``: Delivers messages within the current process only. Fine for development and single
+      process deployments, and the only one that doesn't need any external service.
+    * ``redis``: Delivers messages through Redis pub/sub to all processes connected to the same
+      server, set by ``PUBSUB_REDIS_URL``. Requires the redis package to be installed.
+
+    Both block while waiting for messages using primitives that gevent can monkeypatch, so listening
+    for messages in a request only ties up a greenlet when running on a gevent worker.
+
+"""
+
+from flask import current_app
+from logging import getLogger
+from threading import Lock
+
+import ujson
+
+try:
+    from queue import Queue, Empty
+except ImportError: # pragma: no cover
+    from Queue import Queue, Empty
+
+_logger = getLogger('marvin.pubsub')
+
+
+def get_pubsub():
+    """ Get the pub/sub backend configured for the current app. """
+    pubsub = current_app.extensions.get('marvin_pubsub')
+    if pubsub is None:
+        backend = current_app.config['PUBSUB_BACKEND']
+        if backend == 'local':
+            pubsub = LocalPubSub()
+        elif backend == 'redis':
+            pubsub = RedisPubSub(current_app.config['PUBSUB_REDIS_URL'])
+        else:
+            raise ValueError("Unknown PUBSUB_BACKEND '%s'" % backend)
+        pubsub = current_app.extensions.setdefault('marvin_pubsub', pubsub)
+    return pubsub
+
+
+class LocalPubSub(object):
+    """ Pub/sub delivering messages to subscribers in the same process. """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._subscriptions = {}
+
+
+    def publish(self, channel, message):
+        """ Send `message` to all current subscribers of `channel`. """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.queue.put(message)
+
+
+    def subscribe(self, channel):
+        """ Start listening for messages on `channel`. Remember to close the subscription when done. """
+        subscription = LocalSubscription(self, channel)
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+
+    def unsubscribe(self, subscription):
+        """ Stop delivering messages to the given subscription. """
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.channel, None)
+
+
+class LocalSubscription(object):
+    """ A subscription to a :class:`LocalPubSub` channel. """
+
+    def __init__(self, pubsub, channel):
+        self.pubsub = pubsub
+        self.channel = channel
+        self.queue = Queue()
+
+
+    def get(self, timeout):
+        """ Wait up to `timeout` seconds for a message. Returns None if none arrived in time. """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+    def close(self):
+        """ Stop listening for messages. """
+        self.pubsub.unsubscribe(self)
+
+
+class RedisPubSub(object):
+    """ Pub/sub backed by a Redis server. Messages must be JSON serializable. """
+
+    def __init__(self, url):
+        # Import here so that redis is only required when actually used
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+
+
+    def publish(self, channel, message):
+        """ Send `message` to all current subscribers of `channel`. """
+        self.client.publish(channel, ujson.dumps(message))
+
+
+    def subscribe(self, channel):
+        """ Start listening for messages on `channel`. Remember to close the subscription when done. """
+        return RedisSubscription(self.client, channel)
+
+
+class RedisSubscription(object):
+    """ A subscription to a Redis channel. """
+
+    def __init__(self, client, channel):
+        self.channel = channel
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+
+
+    def get(self, timeout):
+        """ Wait up to `timeout` seconds for a message. Returns None if none arrived in time. """
+        message = self.pubsub.get_message(timeout=timeout)
+        if message is None:
+            return None
+        return ujson.loads(message['data'])
+
+
+    def close(self):
+        """ Stop listening for messages. """
+        self.pubsub.close()
@@ -0,0 +1,149 @@
+"""
+    marvin.relevancy
+    ~~~~~~~~~~~~~~~~
+
+    Keeps the relevancy of movies up to date.
+
+    The relevancy of a movie (see :func:`compute_relevancy <marvin.models.compute_relevancy>`) is
+    discounted by the age of the movie, which makes every score stale when a new year starts, even
+    if nothing about the movie changed. :func:`recompute_relevancy` recalculates the scores of all
+    the movies that were last calculated before the start of this year, or never, and is run
+    periodically by the ``recompute-relevancy`` task.
+
+    On databases with a ``power`` function the scores are calculated by the database with a single
+    ``UPDATE``, everywhere else they're calculated in chunks and written back in bulk. Each chunk is
+    read as columns and scored in one pass by :func:`compute_relevancy_array` if NumPy is installed,
+    and one movie at a time otherwise.
+
+"""
+from . import db
+from .httpcache import invalidate
+from .models import Movie, compute_relevancy
+
+from datetime import datetime
+from logging import getLogger
+from sqlalchemy import bindparam, case, func, or_
+
+# NumPy is optional, it only speeds up recalculating the relevancy on databases that can't do it in SQL
+try:
+    import numpy
+except ImportError: # pragma: no cover
+    numpy = None # pylint: disable=invalid-name
+
+_logger = getLogger('marvin.relevancy')
+
+#: Dialects that can calculate the relevancy in SQL
+_SQL_POWER_DIALECTS = ('postgresql', 'mysql')
+
+
+def get_stale_filter(now):
+    """ Get a filter for the movies whose relevancy has to be recalculated at the time `now`. """
+    start_of_year = datetime(now.year, 1, 1)
+    return or_(Movie.relevancy_computed_at.is_(None), Movie.relevancy_computed_at < start_of_year)
+
+
+def recompute_relevancy(only_stale=True, chunk_size=10000, method=None):
+    """ Recalculate the relevancy of movies.
+
+    :param only_stale: Whether to only recalculate the scores that are stale, see :func:`get_stale_filter`.
+    :param chunk_size: Number of movies to calculate at a time, when not done by the database.
+    :param method: How to calculate the scores, either ``sql``, ``numpy`` or ``python``. Defaults to the
+        fastest one available.
+    :returns: The number of movies updated.
+    """
+    now = datetime.now()
+    condition = get_stale_filter(now) if only_stale else None
+    if method is None:
+        if db.engine.dialect.name in _SQL_POWER_DIALECTS:
+            method = 'sql'
+        else:
+            method = 'numpy' if numpy is not None else 'python'
+    if method == 'sql':
+        updated = _recompute_in_sql(condition, now)
+    else:
+        score_chunk = _score_chunk_with_numpy if method == 'numpy' else _score_chunk
+        updated = _recompute_in_chunks(condition, now, chunk_size, score_chunk)
+    # The front page is sorted by relevancy
+    invalidate('movies')
+    db.session.commit()
+    _logger.info("Recalculated relevancy for %d movies", updated)
+    return updated
+
+
+def get_relevancy_expression(current_year):
+    """ The relevancy formula as a SQL expression over the movie columns. Requires a ``power`` function. """
+    # Rounded down like compute_relevancy, / alone is decimal division on MySQL
+    imdb_votes_ranking = func.floor(
+        case([(Movie.number_of_imdb_votes > 25000, 25000)], else_=Movie.number_of_imdb_votes) / 1000)
+    years_since_release = current_year - func.coalesce(Movie.year, 1900)
+    return ((20*Movie.imdb_rating + imdb_votes_ranking + Movie.metascore) *
+        func.power(0.99, years_since_release))
+
+
+def _recompute_in_sql(condition, now):
+    movie_table = Movie.__table__
+    update = movie_table.update().values(
+        relevancy=get_relevancy_expression(now.year),
+        relevancy_computed_at=now,
+    )
+    if condition is not None:
+        update = update.where(condition)
+    return db.session.execute(update).rowcount
+
+
+def compute_relevancy_array(imdb_ratings, metascores, numbers_of_imdb_votes, years, current_year):
+    """ Calculate the relevancy for many movies at once, with the same formula as
+    :func:`compute_relevancy <marvin.models.compute_relevancy>`. Requires NumPy.
+
+    Takes a sequence for each of the properties of the movies, with None for unknown years, and
+    returns an array of the scores.
+    """
+    imdb_ratings = numpy.asarray(imdb_ratings, dtype=numpy.float64)
+    metascores = numpy.asarray(metascores, dtype=numpy.float64)
+    numbers_of_imdb_votes = numpy.asarray(numbers_of_imdb_votes, dtype=numpy.int64)
+    years = numpy.array(years, dtype=numpy.float64)
+    years[numpy.isnan(years)] = 1900
+    imdb_votes_ranking = numpy.minimum(numbers_of_imdb_votes, 25000) // 1000
+    age_discount = 0.99**(current_year - years)
+    return (20*imdb_ratings + imdb_votes_ranking + metascores)*age_discount
+
+
+def _score_chunk(movies, current_year):
+    """ Get the relevancy of each of `movies`, one movie at a time. """
+    return [compute_relevancy(movie.imdb_rating, movie.metascore, movie.number_of_imdb_votes, movie.year,
+        current_year) for movie in movies]
+
+
+def _score_chunk_with_numpy(movies, current_year):
+    """ Get the relevancy of each of `movies` in a single pass over the columns. """
+    _, imdb_ratings, metascores, numbers_of_imdb_votes, years = zip(*movies)
+    return compute_relevancy_array(imdb_ratings, metascores, numbers_of_imdb_votes, years, current_year).tolist()
+
+
+def _recompute_in_chunks(condition, now, chunk_size, score_chunk):
+    movie_table = Movie.__table__
+    base_query = db.session.query(Movie.id, Movie.imdb_rating, Movie.metascore, Movie.number_of_imdb_votes,
+        Movie.year)
+    if condition is not None:
+        base_query = base_query.filter(condition)
+    # The bind params can't share names with the columns
+    update = movie_table.update().where(movie_table.c.id == bindparam('movie_id_')).values(
+        relevancy=bindparam('relevancy_'),
+        relevancy_computed_at=bindparam('relevancy_computed_at_'),
+    )
+    updated = 0
+    last_id = 0
+    while True:
+        # Page by id instead of keeping a cursor open while writing
+        movies = base_query.filter(Movie.id > last_id).order_by(Movie.id.asc()).limit(chunk_size).all()
+        if not movies:
+            return updated
+        scores = score_chunk(movies, now.year)
+        rows = [{
+            'movie_id_': movie.id,
+            'relevancy_': score,
+            'relevancy_computed_at_': now,
+        } for movie, score in zip(movies, scores)]
+        db.session.execute(update, rows)
+        updated += len(rows)
+        last_id = movies[-1].id
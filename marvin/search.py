@@ -0,0 +1,258 @@
+"""
+    marvin.search
+    ~~~~~~~~~~~~~
+
+    Title search for movies.
+
+    A search matches movies whose title contains all the words in the query, in the given order,
+    ignoring case. Doing this with a plain ``ILIKE '%word%word%'`` can't use any index, so we narrow
+    down the candidates with a trigram index first, and only run the ILIKE on those. On PostgreSQL
+    the pg_trgm extension does this for us (see the migration adding ``ix_movie_title_trgm``), on
+    other databases we maintain the :class:`MovieTitleTrigram <marvin.models.MovieTitleTrigram>`
+    table ourselves through the mapper events below.
+
+    Searches are also sent on to OMDb to discover movies we don't know about yet. Popular queries
+    would cause lots of identical OMDb searches, so :func:`schedule_external_search` only lets one
+    search for a given query through every ``EXTERNAL_SEARCH_COALESCE_TTL_IN_S``. Requests that need
+    the results wait for the search to finish with :func:`wait_for_external_search`, when that's
+    possible, see :func:`can_track_external_searches`.
+
+"""
+from . import db
+from .cache import get_cache
+from .models import Movie, MovieTitleTrigram
+from .pubsub import get_pubsub
+
+from flask import current_app
+from logging import getLogger
+from threading import Lock
+from sqlalchemy import event, func
+from sqlalchemy.orm.attributes import get_history
+
+_logger = getLogger('marvin.search')
+
+
+def get_trigrams(text):
+    """ Get the set of all three character slices of the lowercased `text`.
+
+    Strings shorter than three characters have no trigrams.
+    """
+    text = text.lower()
+    return set(text[i:i+3] for i in range(len(text) - 2))
+
+
+def get_search_backend(dialect_name=None):
+    """ Get the name of the search backend to use, resolving 'auto' from the database dialect.
+
+    :param dialect_name: Name of the database dialect in use, taken from the app's engine if not given.
+    """
+    backend = current_app.config['SEARCH_BACKEND']
+    if backend == 'auto':
+        dialect_name = dialect_name or db.engine.dialect.name
+        backend = 'pg_trgm' if dialect_name == 'postgresql' else 'trigram'
+    return backend
+
+
+def search_movies(search_query, limit=15):
+    """ Get a query for the movies matching `search_query`, the most relevant first.
+
+    :param search_query: The words to search for, separated by whitespace.
+    :param limit: Maximum number of movies to return.
+    """
+    search_words = search_query.split()
+    movie_query = Movie.query.filter(Movie.title.ilike('%' + '%'.join(search_words) + '%'))
+    if get_search_backend() == 'trigram':
+        trigrams = set()
+        for word in search_words:
+            trigrams.update(get_trigrams(word))
+        # Words shorter than three characters can't be looked up in the index, but they'll still
+        # be checked by the ILIKE, which now only has to scan the candidates
+        if trigrams:
+            candidates = (db.session.query(MovieTitleTrigram.movie_id)
+                .filter(MovieTitleTrigram.trigram.in_(trigrams))
+                .group_by(MovieTitleTrigram.movie_id)
+                .having(func.count(MovieTitleTrigram.trigram) == len(trigrams)))
+            movie_query = movie_query.filter(Movie.id.in_(candidates.subquery()))
+    return movie_query.order_by(Movie.relevancy.desc()).limit(limit)
+
+
+def rebuild_index(chunk_size=1000):
+    """ Recreate the trigram index for all movies. Does nothing when using pg_trgm. """
+    if get_search_backend() != 'trigram':
+        _logger.info("Search index is maintained by the database, nothing to rebuild")
+        return
+    trigram_table = MovieTitleTrigram.__table__
+    db.session.execute(trigram_table.delete())
+    last_id = 0
+    while True:
+        # Page through the movies by id, to avoid holding an open cursor while we insert
+        movies = (db.session.query(Movie.id, Movie.title)
+            .filter(Movie.id > last_id)
+            .order_by(Movie.id.asc())
+            .limit(chunk_size)
+            .all())
+        if not movies:
+            break
+        rows = [{'trigram': trigram, 'movie_id': movie_id}
+            for movie_id, title in movies
+            for trigram in get_trigrams(title or '')]
+        if rows:
+            db.session.execute(trigram_table.insert(), rows)
+        last_id = movies[-1].id
+    db.session.commit()
+
+
+def normalize_query(search_query):
+    """ Get the canonical form of `search_query`, lowercased and with repeated whitespace removed. """
+    return ' '.join(search_query.lower().split())
+
+
+#: Status of an external search that has been enqueued, but hasn't finished
+SEARCH_PENDING = 'pending'
+#: Status of an external search that has finished, and stored any new movies found
+SEARCH_DONE = 'done'
+#: Status of a query that hasn't been searched for recently
+SEARCH_UNKNOWN = 'unknown'
+
+
+def schedule_external_search(search_query):
+    """ Enqueue a search of external resources for `search_query`, unless the same search is already in
+    flight or was done recently.
+
+    Queries are compared in their normalized form (see :func:`normalize_query`), and remembered for
+    ``EXTERNAL_SEARCH_COALESCE_TTL_IN_S`` seconds in a cache shared between processes when using a
+    shared ``CACHE_BACKEND``. Suppressed searches are counted, see :func:`get_external_search_counts`.
+
+    :returns: Whether a search was enqueued.
+    """
+    # Import the task here since it will cause circular imports if it's done on the top
+    from .tasks import external_search
+    query = normalize_query(search_query)
+    registered = _get_search_registry().add(query, SEARCH_PENDING,
+        current_app.config['EXTERNAL_SEARCH_COALESCE_TTL_IN_S'])
+    if not registered:
+        _logger.debug("External search for '%s' suppressed, already done recently", query)
+        _count_external_search('suppressed')
+        return False
+    _count_external_search('enqueued')
+    external_search.delay(query)
+    return True
+
+
+def can_track_external_searches():
+    """ Whether this process can see external searches finish, to wait for them or report their status.
+
+    That's the case when the celery tasks run eagerly in this process, or when both ``CACHE_BACKEND``
+    and ``PUBSUB_BACKEND`` are shared with the celery workers. With the local backends, a search run by
+    a worker is never seen to finish, so waiting for it would always time out.
+    """
+    config = current_app.config
+    if config.get('CELERY_ALWAYS_EAGER'):
+        return True
+    return config['CACHE_BACKEND'] != 'local' and config['PUBSUB_BACKEND'] != 'local'
+
+
+def wait_for_external_search(search_query, timeout):
+    """ Wait up to `timeout` seconds for the external search for `search_query` to finish.
+
+    Finished searches are announced through :mod:`marvin.pubsub`, so when the searches run in other
+    processes, both the pub/sub and the cache backend need to be shared for this to ever succeed.
+
+    :returns: Whether the search has finished.
+    """
+    query = normalize_query(search_query)
+    subscription = get_pubsub().subscribe(_get_search_channel(query))
+    try:
+        # Check after subscribing, so that we can't miss a search finishing in between
+        if get_external_search_status(query) == SEARCH_DONE:
+            return True
+        finished = subscription.get(timeout=timeout) is not None
+    finally:
+        subscription.close()
+    if not finished:
+        _count_external_search('timed_out')
+    return finished
+
+
+def get_external_search_status(search_query):
+    """ Get the status of the latest external search for `search_query`, one of :data:`SEARCH_PENDING`,
+    :data:`SEARCH_DONE` or :data:`SEARCH_UNKNOWN`. Always unknown if :func:`can_track_external_searches`
+    is false, since the search would otherwise seem pending forever.
+    """
+    if not can_track_external_searches():
+        return SEARCH_UNKNOWN
+    return _get_search_registry().get(normalize_query(search_query)) or SEARCH_UNKNOWN
+
+
+def finish_external_search(search_query):
+    """ Mark the external search for `search_query` as done, notifying anyone waiting for it. """
+    query = normalize_query(search_query)
+    _get_search_registry().set(query, SEARCH_DONE, current_app.config['EXTERNAL_SEARCH_COALESCE_TTL_IN_S'])
+    get_pubsub().publish(_get_search_channel(query), SEARCH_DONE)
+
+
+def forget_external_search(search_query):
+    """ Allow a new external search for `search_query` right away, like when the last one failed. """
+    _get_search_registry().delete(normalize_query(search_query))
+
+
+def get_external_search_counts():
+    """ Get the number of external searches enqueued, suppressed and timed out waiting for by this process. """
+    counts = current_app.extensions.setdefault('marvin_external_search_counts', {})
+    return {
+        'enqueued': counts.get('enqueued', 0),
+        'suppressed': counts.get('suppressed', 0),
+        'timed_out': counts.get('timed_out', 0),
+    }
+
+
+_external_search_counts_lock = Lock()
+
+def _count_external_search(kind):
+    with _external_search_counts_lock:
+        counts = current_app.extensions.setdefault('marvin_external_search_counts', {})
+        counts[kind] = counts.get(kind, 0) + 1
+
+
+def _get_search_registry():
+    """ The cache of the status of external searches that were recently done or are in flight. """
+    return get_cache('external-searches', current_app.config['EXTERNAL_SEARCH_REGISTRY_SIZE'])
+
+
+def _get_search_channel(query):
+    """ Name of the pub/sub channel where it's announced that the search for `query` has finished. """
+    return 'external-search:%s' % query
+
+
+def _index_movie(connection, movie):
+    trigram_table = MovieTitleTrigram.__table__
+    _unindex_movie(connection, movie)
+    rows = [{'trigram': trigram, 'movie_id': movie.id} for trigram in get_trigrams(movie.title or '')]
+    if rows:
+        connection.execute(trigram_table.insert(), rows)
+
+
+def _unindex_movie(connection, movie):
+    trigram_table = MovieTitleTrigram.__table__
+    connection.execute(trigram_table.delete().where(trigram_table.c.movie_id == movie.id))
+
+
+@event.listens_for(Movie, 'after_insert')
+def on_movie_inserted(mapper, connection, movie): # pylint: disable=unused-argument
+    """ Add the title of new movies to the index. """
+    if get_search_backend(connection.dialect.name) == 'trigram':
+        _index_movie(connection, movie)
+
+
+@event.listens_for(Movie, 'after_update')
+def on_movie_updated(mapper, connection, movie): # pylint: disable=unused-argument
+    """ Reindex movies that changed title. """
+    if get_history(movie, 'title').has_changes() and get_search_backend(connection.dialect.name) == 'trigram':
+        _index_movie(connection, movie)
+
+
+@event.listens_for(Movie, 'after_delete')
+def on_movie_deleted(mapper, connection, movie): # pylint: disable=unused-argument
+    """ Remove deleted movies from the index, since ON DELETE CASCADE is not enforced everywhere. """
+    if get_search_backend(connection.dialect.name) == 'trigram':
+        _unindex_movie(connection, movie)
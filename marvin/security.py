@@ -6,11 +6,19 @@
 
 """
 
+from . import settings
+from .cache import get_cache
 from .utils import generic_error_handler
 
 from itsdangerous import BadData, constant_time_compare, URLSafeSerializer
-from flask import abort, current_app, g, request
+from flask import abort, current_app, g, has_app_context, request
 from flask.ext.principal import identity_changed, Identity
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from multiprocessing import cpu_count, Pool, TimeoutError as PoolTimeoutError
+from threading import BoundedSemaphore, Lock
+from time import time
 
 import base64
 import os
@@ -18,7 +26,9 @@ import os
 # Don't require scrypt to be installed in debug mode, since it's hell to compile on windows
 try:
     import scrypt
+    _HAS_SCRYPT = True
 except ImportError: # pragma: no cover
+    _HAS_SCRYPT = False
     from hashlib import sha256
     class scrypt(object): # pylint: disable=invalid-name
         """ Faking scrypt using a single sha256 hash if scrypt is not available. """
@@ -33,6 +43,64 @@ except ImportError: # pragma: no cover
             return hasher.digest()
 
 
+#: The process pool used for hashing, and the semaphore limiting the number of jobs waiting for it,
+#: for the process that created them
+_hashing_pool = None
+_hashing_slots = None
+_hashing_pool_pid = None
+_hashing_pool_lock = Lock()
+
+#: Key in the session info of the IDs of the users to remove from the auth cache when the transaction commits
+_PENDING_UNCACHE_KEY = 'marvin_pending_uncached_users'
+
+
+def _scrypt_hash(password, salt, N, p, r): # pylint: disable=invalid-name
+    """ Run scrypt, in a worker process. Must be a module-level function to be picklable. """
+    return scrypt.hash(password, salt, N, p, r)
+
+
+def _get_hashing_pool():
+    """ Get the process pool and job slots for this process, creating them if necessary.
+
+    The pool is tied to the process that created it, so a new one is created after forking.
+    """
+    # pylint: disable=global-statement
+    global _hashing_pool, _hashing_slots, _hashing_pool_pid
+    with _hashing_pool_lock:
+        if _hashing_pool_pid != os.getpid():
+            pool_size = current_app.config['PASSWORD_HASHING_POOL_SIZE'] or cpu_count()
+            queue_limit = current_app.config['PASSWORD_HASHING_QUEUE_LIMIT']
+            _hashing_pool = Pool(pool_size)
+            _hashing_slots = BoundedSemaphore(pool_size + queue_limit)
+            _hashing_pool_pid = os.getpid()
+        return _hashing_pool, _hashing_slots
+
+
+def _hash(password, salt, N, p, r): # pylint: disable=invalid-name
+    """ Hash the password with scrypt.
+
+    Hashing is deliberately slow, so unless ``PASSWORD_HASHING_POOL_SIZE`` is 0 it's done in a
+    pool of worker processes, to keep a burst of logins from starving other requests of CPU. If
+    more than ``PASSWORD_HASHING_QUEUE_LIMIT`` hashes are already waiting for the pool, we fail
+    with HTTP 503 instead of queueing up even more work, as we do if the hash takes longer than
+    ``PASSWORD_HASHING_TIMEOUT_IN_S``. Outside of an app context, like when creating users from
+    scripts, it's always done inline.
+    """
+    if not has_app_context() or current_app.config['PASSWORD_HASHING_POOL_SIZE'] == 0 or not _HAS_SCRYPT:
+        return scrypt.hash(password, salt, N, p, r)
+    pool, slots = _get_hashing_pool()
+    if not slots.acquire(False):
+        abort(503)
+    try:
+        job = pool.apply_async(_scrypt_hash, (password, salt, N, p, r))
+        try:
+            return job.get(timeout=current_app.config['PASSWORD_HASHING_TIMEOUT_IN_S'])
+        except PoolTimeoutError:
+            abort(503)
+    finally:
+        slots.release()
+
+
 def _generate_salt_bytes():
     """ Generate a random bytestring that can be used as a cryptographic salt.
 
@@ -55,14 +123,58 @@ def generate_pw_hash(password):
     (N, p, r) = get_system_scrypt_params()
     method = '%s:%d:%d:%d' % ('scrypt', N, p, r)
     password_bytes = password.encode('utf-8')
-    pwhash = scrypt.hash(password_bytes, salt, N, p, r)
+    pwhash = _hash(password_bytes, salt, N, p, r)
     return '%s$%s$%s' % (method, salt, base64.b64encode(pwhash))
 
 
 def get_system_scrypt_params():
-    """ Get optimal N, p and r values for this sytem. """
-    #FIXME: Hardcoded for now since lead dev is on windows and can't test against working scrypt...
-    return (1024, 8, 1)
+    """ Get the N, p and r values to hash new passwords with, set by ``SCRYPT_PARAMS``. Outside of an
+    app context the default from :mod:`marvin.settings` is used.
+
+    Use :func:`calibrate_scrypt_params` to find good values for a given machine.
+    """
+    config = current_app.config if has_app_context() else vars(settings)
+    return tuple(config['SCRYPT_PARAMS'])
+
+
+def calibrate_scrypt_params(target_time_in_s, max_memory_in_bytes, hash_func=None, timer=time):
+    """ Find the strongest N, p and r values that hash a password within the given time and memory budget.
+
+    p and r are kept at their defaults, and N is doubled as long as hashing stays within budget. Note
+    that the params are passed on positionally to ``scrypt.hash``, which takes them as N, r, p, which
+    means the second value is the block size, and the memory used is ``128*N*p`` bytes.
+
+    :param target_time_in_s: The longest a single hash should take, in seconds.
+    :param max_memory_in_bytes: The most memory a single hash can use.
+    :param hash_func: Function to time, defaults to ``scrypt.hash``. Mostly here for testing.
+    :param timer: Function returning the current time in seconds. Mostly here for testing.
+    """
+    # pylint: disable=invalid-name
+    hash_func = hash_func or scrypt.hash
+    (_, p, r) = current_app.config['SCRYPT_PARAMS']
+    salt = _generate_salt_bytes()
+    N = 2**10
+    while 128*(2*N)*p <= max_memory_in_bytes:
+        start = timer()
+        hash_func(b'calibration password', salt, 2*N, p, r)
+        if timer() - start > target_time_in_s:
+            break
+        N *= 2
+    return (N, p, r)
+
+
+def needs_rehash(password_hash):
+    """ Whether the given password hash was created with weaker params than the ones currently used.
+
+    The cost of scrypt grows with the product of N, p and r. Hashes with stronger params are left alone,
+    so that processes configured differently don't keep rehashing the same passwords back and forth,
+    which would also invalidate the auth tokens of the user every time.
+    """
+    # pylint: disable=invalid-name
+    method = password_hash.split('$', 1)[0]
+    (_, N, p, r) = method.split(':')
+    (current_N, current_p, current_r) = get_system_scrypt_params()
+    return int(N)*int(p)*int(r) < current_N*current_p*current_r
 
 
 def force_bytes(string):
@@ -90,16 +202,25 @@ def is_correct_pw(password, password_hash):
     password_bytes = password.encode('utf-8')
     salt_bytes = salt.encode('utf-8')
     (N, p, r) = (int(N), int(p), int(r))
-    hashed_bytes = scrypt.hash(password_bytes, salt_bytes, N, p, r)
+    hashed_bytes = _hash(password_bytes, salt_bytes, N, p, r)
     b64hash = base64.b64encode(hashed_bytes)
     b64hash_bytes = force_bytes(b64hash)
     hashed_pw_bytes = force_bytes(hashed_pw)
     return constant_time_compare(hashed_pw_bytes, b64hash_bytes)
 
 
+def get_token_serializer():
+    """ Get the serializer used to sign and verify auth tokens, shared by all requests to the app. """
+    serializer = current_app.extensions.get('marvin_token_serializer')
+    if serializer is None:
+        serializer = URLSafeSerializer(current_app.config['SECRET_KEY'])
+        current_app.extensions['marvin_token_serializer'] = serializer
+    return serializer
+
+
 def decode_token_or_400(auth_token):
     """ Decode the given auth_token and return the data dict therein, or fail with a HTTP 400 error. """
-    serializer = URLSafeSerializer(current_app.config['SECRET_KEY'])
+    serializer = get_token_serializer()
     try:
         return serializer.loads(auth_token)
     except BadData as ex:
@@ -119,6 +240,70 @@ def get_user_from_auth_data(auth_data):
     abort(401)
 
 
+def get_user_from_token(auth_token):
+    """ Get the user the given auth_token belongs to, or fail with HTTP 400 or 401 like
+    :func:`decode_token_or_400` and :func:`get_user_from_auth_data`.
+
+    Both the decoded tokens and the users they belong to are cached for ``AUTH_CACHE_TTL_IN_S``,
+    so that authenticated requests usually don't have to verify the token signature or query for
+    the user. Cached users are evicted when their password changes, see :func:`uncache_user`. That
+    only reaches other processes with a shared ``CACHE_BACKEND``, so with the local one the password
+    hash of a cached user is still checked against the database on every request.
+    """
+    # pylint: disable=invalid-name
+    from . import db
+    from .models import User
+    cache = get_cache('auth', current_app.config['AUTH_CACHE_SIZE'])
+    ttl = current_app.config['AUTH_CACHE_TTL_IN_S']
+    auth_data = cache.get('token:' + auth_token)
+    if auth_data is None:
+        auth_data = decode_token_or_400(auth_token)
+        cache.set('token:' + auth_token, auth_data, ttl)
+    user_key = 'user:%d' % auth_data['i']
+    cached_user = cache.get(user_key)
+    if cached_user is not None and current_app.config['CACHE_BACKEND'] == 'local':
+        # Other processes can't evict the user from our cache, so make sure it's not stale
+        password_hash = db.session.query(User.password_hash).filter(User.id == auth_data['i']).scalar()
+        if password_hash != cached_user.password_hash:
+            cached_user = None
+    if cached_user is None or not cached_user.verify_auth_data(auth_data):
+        cached_user = get_user_from_auth_data(auth_data)
+        # Keep a detached copy in the cache, so that it's not affected by changes in this session
+        db.session.expunge(cached_user)
+        cache.set(user_key, cached_user, ttl)
+    # Attach a copy of the cached user to this session without querying the database
+    return db.session.merge(cached_user, load=False)
+
+
+def uncache_user(user_id):
+    """ Remove the user with the given ID from the auth cache when the current transaction commits. Call
+    whenever the password changes.
+
+    Waiting for the commit means no concurrent request can cache the old user again in the meantime.
+    """
+    from . import db
+    pending = db.session.info.setdefault(_PENDING_UNCACHE_KEY, set())
+    pending.add(user_id)
+
+
+def uncache_user_now(user_id):
+    """ Remove the user with the given ID from the auth cache right away. """
+    get_cache('auth', current_app.config['AUTH_CACHE_SIZE']).delete('user:%d' % user_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _on_commit(session):
+    """ Evict the users changed by the committed transaction. """
+    for user_id in session.info.pop(_PENDING_UNCACHE_KEY, ()):
+        uncache_user_now(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _on_rollback(session):
+    """ The users were never changed, so they can stay cached. """
+    session.info.pop(_PENDING_UNCACHE_KEY, None)
+
+
 def get_auth_token_from_header():
     """ Extract the token from a HTTP Authorization header.
 
@@ -143,8 +328,7 @@ def before_request_authentication():
     from .models import AnonymousUser
     auth_token = get_auth_token_from_header()
     if auth_token:
-        data = decode_token_or_400(auth_token)
-        user = get_user_from_auth_data(data)
+        user = get_user_from_token(auth_token)
         g.user = user
         identity_changed.send(current_app._get_current_object(), identity=Identity(user.id))
     else:
@@ -15,7 +15,170 @@
     parameter to :func:`marvin.create_app`.
 """
 
+from datetime import timedelta
+
 WTF_CSRF_ENABLED = False
 
 # prevent flask from messing with log handlers
 LOGGER_NAME = 'nonexistent'
+
+# Which backend to use for movie title search. 'pg_trgm' lets PostgreSQL answer searches from a
+# trigram index on movie.title, 'trigram' maintains our own trigram table which works on any
+# database. 'auto' selects 'pg_trgm' on PostgreSQL, and 'trigram' otherwise.
+SEARCH_BACKEND = 'auto'
+
+# Upper limit for the number of entries returned by a single request for stream entries
+MAX_ENTRIES_PER_PAGE = 500
+
+# The longest time window entries can be fetched for in a single request to a movie's entries, in ms
+MAX_ENTRY_WINDOW_IN_MS = 30*60*1000
+
+# Pub/sub backend used to notify listeners about new entries, either 'local' (in-process only)
+# or 'redis' (across processes, needs PUBSUB_REDIS_URL). See marvin.pubsub.
+PUBSUB_BACKEND = 'local'
+PUBSUB_REDIS_URL = 'redis://localhost:6379/0'
+
+# Stream entry feeds: how often to send keep-alives on idle event streams, how long to keep an
+# event stream open before asking the client to reconnect, and how long to hold long-poll requests,
+# all in seconds. The feed holds on to the request while waiting, so run it on a gevent worker.
+FEED_HEARTBEAT_IN_S = 15
+FEED_MAX_DURATION_IN_S = 300
+FEED_LONGPOLL_TIMEOUT_IN_S = 25
+
+# Number of compiled URL templates to keep for building links, see marvin.utils.external_url. There's
+# one per endpoint and set of arguments for every host the API is reached through.
+URL_TEMPLATE_CACHE_SIZE = 1000
+
+# Cache backend, either 'local' (in-process) or 'redis' (shared, needs CACHE_REDIS_URL). See marvin.cache.
+CACHE_BACKEND = 'local'
+CACHE_REDIS_URL = 'redis://localhost:6379/1'
+
+# How many verified auth tokens and users to cache, and for how long, in seconds. With the local
+# CACHE_BACKEND, a password change or deleted user is only noticed by other processes through a query
+# for the password hash on every authenticated request, use a shared backend to skip it.
+AUTH_CACHE_SIZE = 10000
+AUTH_CACHE_TTL_IN_S = 300
+
+# Number of processes to hash passwords in, defaults to the number of cores if None. Set to 0 to hash
+# in the request thread instead. When more than PASSWORD_HASHING_QUEUE_LIMIT hashes are waiting for
+# a process, or a hash takes longer than PASSWORD_HASHING_TIMEOUT_IN_S, requests needing one fail with
+# HTTP 503.
+PASSWORD_HASHING_POOL_SIZE = None
+PASSWORD_HASHING_QUEUE_LIMIT = 32
+PASSWORD_HASHING_TIMEOUT_IN_S = 30
+
+# The scrypt N, p and r params used to hash new passwords. Passwords hashed with weaker params are
+# rehashed on the next successful login. Run `manage.py calibrate_scrypt -c <config file>` once to find
+# params suiting the machine, targeting a hashing time of SCRYPT_TARGET_TIME_IN_S seconds using at most
+# SCRYPT_MAX_MEMORY_IN_BYTES, and use the same config for every process.
+SCRYPT_PARAMS = (1024, 8, 1)
+SCRYPT_TARGET_TIME_IN_S = 0.1
+SCRYPT_MAX_MEMORY_IN_BYTES = 32*1024*1024
+
+# The OMDb API, used to search for movies and fetch their metadata
+OMDB_URL = 'http://www.omdbapi.com/'
+
+# Refreshing metadata for many movies: number of movies to process and write back at a time, number of
+# requests to OMDb to have in flight at once, and the maximum number of requests to start per second
+OMDB_REFRESH_CHUNK_SIZE = 200
+OMDB_CONCURRENCY = 8
+OMDB_REQUESTS_PER_SECOND = 20
+
+# Requests to OMDb: seconds to wait for a response, how many times to retry on network and server
+# errors, and how many keep-alive connections to keep open
+OMDB_TIMEOUT_IN_S = 10
+OMDB_RETRIES = 2
+OMDB_CONNECTION_POOL_SIZE = 16
+
+# Caching of OMDb responses: number of responses to keep in memory (0 to disable), a directory to
+# also store them in so they survive restarts (None to disable), and how long to keep search results
+# and movie lookups, in seconds
+OMDB_CACHE_SIZE = 1000
+OMDB_CACHE_DIR = None
+OMDB_SEARCH_CACHE_TTL_IN_S = 60*60
+OMDB_LOOKUP_CACHE_TTL_IN_S = 24*60*60
+
+# Searches are sent on to OMDb at most once every EXTERNAL_SEARCH_COALESCE_TTL_IN_S seconds for the same
+# query, keeping track of at most EXTERNAL_SEARCH_REGISTRY_SIZE queries when using the local cache backend
+EXTERNAL_SEARCH_COALESCE_TTL_IN_S = 10*60
+EXTERNAL_SEARCH_REGISTRY_SIZE = 10000
+
+# When a search has no local results, wait at most EXTERNAL_SEARCH_WAIT_IN_S seconds for the external
+# search to finish. If it doesn't, respond with no results, asking the client to check the search status
+# again after EXTERNAL_SEARCH_RETRY_AFTER_IN_S seconds. When the external searches run in other processes,
+# both PUBSUB_BACKEND and CACHE_BACKEND must be shared for the results to be waited for, otherwise the
+# response is returned right away, see marvin.search.can_track_external_searches.
+EXTERNAL_SEARCH_WAIT_IN_S = 3
+EXTERNAL_SEARCH_RETRY_AFTER_IN_S = 2
+
+# Number of movies to recalculate the relevancy for at a time, on databases that can't do it in SQL
+RELEVANCY_CHUNK_SIZE = 10000
+
+# Periodic tasks run by celery beat. Relevancy depends on the current year, so stale scores are
+# recalculated daily, which only touches movies calculated before the start of the year. The numbers
+# on the stats page are recounted every few minutes.
+CELERYBEAT_SCHEDULE = {
+    'recompute-relevancy': {
+        'task': 'recompute-relevancy',
+        'schedule': timedelta(days=1),
+    },
+    'refresh-stats': {
+        'task': 'refresh-stats',
+        'schedule': timedelta(minutes=5),
+    },
+}
+
+# The stats page shows the statistics last counted by the refresh-stats task, read from the database
+# at most every STATS_CACHE_TTL_IN_S seconds, including signups for the last STATS_SIGNUP_DAYS days
+STATS_CACHE_TTL_IN_S = 60
+STATS_SIGNUP_DAYS = 14
+
+# Search results are ranked by taking the SEARCH_RANKING_CANDIDATES most relevant movies matching the
+# query, and sorting them by the weighted sum of the scores given by SEARCH_RANKING_SCORERS, as pairs of
+# the import path of the scorer and it's weight. See marvin.ranking. Rankings taking longer than
+# SEARCH_RANKING_BUDGET_IN_MS are logged.
+SEARCH_RANKING_CANDIDATES = 100
+SEARCH_RANKING_SCORERS = [
+    ('marvin.ranking.title_similarity', 0.6),
+    ('marvin.ranking.relative_relevancy', 0.4),
+]
+SEARCH_RANKING_BUDGET_IN_MS = 5
+
+# Responses of hot read endpoints are cached, see marvin.httpcache. Keep at most RESPONSE_CACHE_SIZE
+# responses and resource versions when using the local cache backend, for RESPONSE_CACHE_TTL_IN_S
+# seconds. With the local backend, changes made by one process are only seen by the others after this.
+RESPONSE_CACHE_SIZE = 10000
+RESPONSE_CACHE_TTL_IN_S = 60
+
+# Every request is timed, along with the SQL statements it executes and the serialization of the
+# response, see marvin.instrumentation. The timings are logged, aggregated in histograms with the upper
+# bounds INSTRUMENTATION_BUCKETS_IN_S served at /metrics if METRICS_ENABLED is set, and added as a
+# Server-Timing header when debugging or if INSTRUMENTATION_SERVER_TIMING is set. /metrics is public,
+# so only enable it if it isn't reachable from outside, e.g. when it's blocked by a reverse proxy.
+INSTRUMENTATION_ENABLED = True
+METRICS_ENABLED = False
+INSTRUMENTATION_SERVER_TIMING = False
+INSTRUMENTATION_BUCKETS_IN_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# SQL statements taking at least SLOW_QUERY_THRESHOLD_IN_MS are logged to the marvin.slowqueries logger,
+# and to a file at SLOW_QUERY_LOG_PATH rotated every SLOW_QUERY_LOG_MAX_BYTES if set, see
+# marvin.slowqueries. The plans of at most SLOW_QUERY_EXPLAINS_PER_MINUTE slow SELECTs are logged too,
+# explaining each statement at most once every SLOW_QUERY_EXPLAIN_INTERVAL_IN_S. Set the threshold to
+# None to disable.
+SLOW_QUERY_THRESHOLD_IN_MS = 500
+SLOW_QUERY_LOG_PATH = None
+SLOW_QUERY_LOG_MAX_BYTES = 10*1024*1024
+SLOW_QUERY_LOG_BACKUP_COUNT = 5
+SLOW_QUERY_EXPLAINS_PER_MINUTE = 10
+SLOW_QUERY_EXPLAIN_INTERVAL_IN_S = 3600
+SLOW_QUERY_QUEUE_SIZE = 1000
+
+# Requests with a valid token from the profiling_token command in the PROFILING_HEADER header, and a
+# PROFILING_SAMPLE_RATE share of all the others, are profiled by sampling their stack every
+# PROFILING_INTERVAL_IN_S seconds, see marvin.profiling. The stacks are saved in PROFILING_OUTPUT_DIR,
+# profiling is disabled if it's not set. Tokens are valid for PROFILING_TOKEN_MAX_AGE_IN_S seconds.
+PROFILING_OUTPUT_DIR = None
+PROFILING_SAMPLE_RATE = 0.0
+PROFILING_INTERVAL_IN_S = 0.005
+PROFILING_HEADER = 'X-Marvin-Profile'
+PROFILING_TOKEN_MAX_AGE_IN_S = 24*3600
@@ -0,0 +1,224 @@
+"""
+    marvin.slowqueries
+    ~~~~~~~~~~~~~~~~~~
+
+    Finds the SQL statements that are slow in production, and why.
+
+    Every statement taking longer than ``SLOW_QUERY_THRESHOLD_IN_MS`` is recorded, along with the
+    resource that executed it (see :mod:`marvin.instrumentation`), or ``None`` outside of requests,
+    and the shape of its parameters, ie. their types instead of their values, which might be
+    private.
+
+    The records are written by a background thread, so the request that was slow doesn't get any
+    slower, as a JSON object per line to the ``marvin.slowqueries`` logger, and to a rotating log at
+    ``SLOW_QUERY_LOG_PATH`` if set. Before writing, the thread asks the database to ``EXPLAIN`` the
+    plan of slow ``SELECT`` statements, so missing indexes are easy to spot. The statements are
+    explained with their actual parameters, which might show up in the plan, so literals are replaced
+    by ``?`` in it (see :func:`redact_literals`). To keep this from adding to the load of a database
+    that's already struggling, at most ``SLOW_QUERY_EXPLAINS_PER_MINUTE`` statements are explained,
+    and each statement only once every ``SLOW_QUERY_EXPLAIN_INTERVAL_IN_S``.
+    If the thread falls behind, records are dropped rather than queued without bounds.
+
+"""
+from . import db
+from .cache import LocalCache
+from .instrumentation import get_resource_name
+
+from flask import current_app, has_app_context, has_request_context
+from logging import getLogger
+from logging.handlers import RotatingFileHandler
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from threading import Lock, Thread
+
+import re
+import time
+import ujson
+
+try:
+    from queue import Queue, Full
+except ImportError: # pragma: no cover
+    from Queue import Queue, Full
+
+_logger = getLogger('marvin.slowqueries')
+
+_handlers_lock = Lock()
+_log_lock = Lock()
+
+#: The file handlers added to the logger, by path, so that each file is only written to once
+_file_handlers = {}
+
+#: Quoted strings, like ``'bob@example.com'::text``, with quotes escaped by doubling them
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+#: Numbers operated on in conditions, like ``(id = 42)``, but not the ``cost=0.00..8.27`` of a plan
+_NUMBER_LITERAL = re.compile(r"(\s(?:=|<>|!=|<=|>=|<|>|\+|-|\*|/|%)\s|\()-?\d+(?:\.\d+)?(?=[\s),:]|$)")
+
+
+def get_slow_query_log():
+    """ Get the slow query log of the current app, creating it if necessary. """
+    log = current_app.extensions.get('marvin_slow_query_log')
+    if log is None:
+        with _log_lock:
+            log = current_app.extensions.get('marvin_slow_query_log')
+            if log is None:
+                config = current_app.config
+                _add_file_handler(config['SLOW_QUERY_LOG_PATH'], config['SLOW_QUERY_LOG_MAX_BYTES'],
+                    config['SLOW_QUERY_LOG_BACKUP_COUNT'])
+                log = SlowQueryLog(db.engine,
+                    explains_per_minute=config['SLOW_QUERY_EXPLAINS_PER_MINUTE'],
+                    explain_interval=config['SLOW_QUERY_EXPLAIN_INTERVAL_IN_S'],
+                    queue_size=config['SLOW_QUERY_QUEUE_SIZE'])
+                current_app.extensions['marvin_slow_query_log'] = log
+    return log
+
+
+class SlowQueryLog(object):
+    """ Writes records of slow statements from a background thread, explaining them first if allowed.
+
+    :param engine: The engine to explain statements with.
+    :param explains_per_minute: Maximum number of statements to explain per minute.
+    :param explain_interval: Minimum number of seconds between explaining the same statement.
+    :param queue_size: Maximum number of records waiting to be written, more are dropped.
+    :param clock: Function returning the current time in seconds.
+    """
+
+    def __init__(self, engine, explains_per_minute=10, explain_interval=3600, queue_size=1000, clock=time.time):
+        self.engine = engine
+        self.explains_per_minute = explains_per_minute
+        self.explain_interval = explain_interval
+        self.clock = clock
+        #: Number of records dropped because the queue was full
+        self.dropped = 0
+        self._queue = Queue(queue_size)
+        self._recently_explained = LocalCache(1000, clock=clock)
+        self._next_explain = 0
+        thread = Thread(target=self._run, name='slow-query-log')
+        thread.daemon = True
+        thread.start()
+
+
+    def record(self, statement, parameters, executemany, duration, resource):
+        """ Queue a record of a slow statement for writing. Never blocks. """
+        try:
+            self._queue.put_nowait({
+                'statement': statement,
+                'parameters': parameters,
+                'executemany': executemany,
+                'duration_ms': round(duration*1000, 2),
+                'resource': resource,
+                'time': self.clock(),
+            })
+        except Full:
+            self.dropped += 1
+
+
+    def join(self):
+        """ Block until all the queued records have been written. """
+        self._queue.join()
+
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                self._write(record)
+            except Exception: # pylint: disable=broad-except
+                _logger.exception('Failed to write slow query record')
+            finally:
+                self._queue.task_done()
+
+
+    def _write(self, record):
+        parameters = record.pop('parameters')
+        executemany = record.pop('executemany')
+        record['parameter_shape'] = get_parameter_shape(parameters, executemany)
+        if self._may_explain(record['statement']):
+            record['plan'] = self._explain(record['statement'], parameters[0] if executemany else parameters)
+        _logger.warning(ujson.dumps(record))
+
+
+    def _may_explain(self, statement):
+        """ Whether to explain `statement` now, counting it against the limits if so. """
+        if not statement.lstrip()[:6].upper() == 'SELECT':
+            # Explaining anything else might change data on some databases
+            return False
+        now = self.clock()
+        if now < self._next_explain or self._recently_explained.get(statement):
+            return False
+        self._next_explain = now + 60.0/self.explains_per_minute
+        self._recently_explained.set(statement, True, self.explain_interval)
+        return True
+
+
+    def _explain(self, statement, parameters):
+        """ Get the plan of `statement` as a list of lines, or the error explaining it. """
+        prefix = 'EXPLAIN QUERY PLAN ' if self.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(prefix + statement, parameters)
+            return [redact_literals(' '.join(str(column) for column in row)) for row in cursor.fetchall()]
+        except Exception as error: # pylint: disable=broad-except
+            # The error might quote the parameters too
+            return [redact_literals('Failed to explain: %s' % error)]
+        finally:
+            connection.close()
+
+
+def get_parameter_shape(parameters, executemany=False):
+    """ Describe `parameters` by their types, without their values. """
+    if executemany:
+        return {
+            'rows': len(parameters),
+            'row': get_parameter_shape(parameters[0]) if parameters else None,
+        }
+    if isinstance(parameters, dict):
+        return dict((key, type(value).__name__) for key, value in parameters.items())
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+def redact_literals(text):
+    """ Replace the string and number literals in a line of a plan with ``?``. """
+    text = _STRING_LITERAL.sub("'?'", text)
+    return _NUMBER_LITERAL.sub(r'\1?', text)
+
+
+def _add_file_handler(log_path, max_bytes, backup_count):
+    if log_path is None:
+        return
+    with _handlers_lock:
+        if log_path not in _file_handlers:
+            handler = RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count)
+            _logger.addHandler(handler)
+            _file_handlers[log_path] = handler
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    if has_app_context() and current_app.config['SLOW_QUERY_THRESHOLD_IN_MS'] is not None:
+        conn.info.setdefault('marvin_slow_query_start', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    starts = conn.info.get('marvin_slow_query_start')
+    if not starts or not has_app_context():
+        return
+    duration = time.time() - starts.pop()
+    threshold = current_app.config['SLOW_QUERY_THRESHOLD_IN_MS']
+    if threshold is not None and duration*1000 >= threshold:
+        resource = get_resource_name() if has_request_context() else None
+        get_slow_query_log().record(statement, parameters, executemany, duration, resource)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # The statement never finished, so forget when it started
+    starts = context.connection.info.get('marvin_slow_query_start') if context.connection else None
+    if starts:
+        starts.pop()
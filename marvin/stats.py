@@ -0,0 +1,112 @@
+"""
+    marvin.stats
+    ~~~~~~~~~~~~
+
+    Aggregate statistics about the database, for the stats page.
+
+    Counting the rows of the big tables is a full scan on PostgreSQL, which is way too slow to do on
+    every view of the stats page. Instead :func:`refresh_stats` makes all the counts in one go and
+    stores them in the small :class:`Statistic <marvin.models.Statistic>` table, and is run every few
+    minutes by the ``refresh-stats`` task. :func:`get_stats` reads them from there, and keeps them in
+    the cache for ``STATS_CACHE_TTL_IN_S`` seconds, so the stats page never touches the big tables.
+
+"""
+from . import db
+from .cache import get_cache
+from .models import Entry, Movie, Statistic, Stream, User
+
+from datetime import datetime, timedelta
+from flask import current_app
+from logging import getLogger
+from sqlalchemy import func
+
+_logger = getLogger('marvin.stats')
+
+#: The key of the stats in the cache
+_CACHE_KEY = 'stats'
+
+
+def refresh_stats():
+    """ Recount all the statistics, replacing the stored ones.
+
+    :returns: The number of statistics stored.
+    """
+    now = datetime.utcnow()
+    counts = _count_all(now)
+    statistic_table = Statistic.__table__
+    db.session.execute(statistic_table.delete())
+    db.session.execute(statistic_table.insert(), [{
+        'key': key,
+        'value': value,
+        'computed_at': now,
+    } for key, value in counts.items()])
+    db.session.commit()
+    _get_stats_cache().delete(_CACHE_KEY)
+    _logger.info("Refreshed %d statistics", len(counts))
+    return len(counts)
+
+
+def get_stats():
+    """ Get the latest statistics, as a dict with the following keys:
+
+    * ``movies``: Number of movies.
+    * ``users``: Number of users.
+    * ``streams``: Number of streams, by whether they're ``published`` or a ``draft``.
+    * ``entries``: Number of entries, by content type.
+    * ``signups``: Number of users signed up, by day (as YYYY-MM-DD in UTC), for the last ``STATS_SIGNUP_DAYS`` days.
+    * ``computed_at``: When the statistics were computed, or None if they haven't been yet.
+    """
+    cache = _get_stats_cache()
+    stats = cache.get(_CACHE_KEY)
+    if stats is None:
+        stats = _parse_statistics(Statistic.query.all())
+        cache.set(_CACHE_KEY, stats, current_app.config['STATS_CACHE_TTL_IN_S'])
+    return stats
+
+
+def _count_all(now):
+    """ Make all the counts, as a dict of statistic key to value. """
+    counts = {
+        'movies': db.session.query(func.count(Movie.id)).scalar(),
+        'users': db.session.query(func.count(User.id)).scalar(),
+        'streams:published': 0,
+        'streams:draft': 0,
+    }
+    for public, count in db.session.query(Stream.public, func.count(Stream.id)).group_by(Stream.public):
+        counts['streams:published' if public else 'streams:draft'] += count
+    entries = db.session.query(Entry.content_type, func.count(Entry.id)).group_by(Entry.content_type)
+    for content_type, count in entries:
+        counts['entries:%s' % content_type] = count
+    first_day = (now - timedelta(days=current_app.config['STATS_SIGNUP_DAYS'] - 1)).replace(hour=0, minute=0,
+        second=0, microsecond=0)
+    signup_day = func.date(User.user_created_datetime)
+    signups = (db.session.query(signup_day, func.count(User.id))
+        .filter(User.user_created_datetime >= first_day)
+        .group_by(signup_day))
+    for day, count in signups:
+        # Dates are strings on SQLite
+        counts['signups:%s' % str(day)[:10]] = count
+    return counts
+
+
+def _parse_statistics(statistics):
+    stats = {
+        'movies': 0,
+        'users': 0,
+        'streams': {},
+        'entries': {},
+        'signups': {},
+        'computed_at': None,
+    }
+    for statistic in statistics:
+        kind, _, name = statistic.key.partition(':')
+        if name:
+            stats[kind][name] = statistic.value
+        else:
+            stats[kind] = statistic.value
+        stats['computed_at'] = statistic.computed_at
+    return stats
+
+
+def _get_stats_cache():
+    return get_cache('stats', 1)
@@ -10,14 +10,23 @@
 # pylint: disable=no-self-use
 
 from . import db, make_celery
-from .models import Movie
+from .httpcache import invalidate
+from .models import Movie, compute_relevancy
+from .omdb import get_omdb_client
+from .relevancy import recompute_relevancy
+from .search import finish_external_search, forget_external_search
+from .stats import refresh_stats
+from .utils import RateLimiter
 
 from collections import namedtuple
+from datetime import datetime
+from flask import current_app
 from logging import getLogger
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import bindparam
 import functools
 import re
 import requests
-import textwrap
 
 _logger = getLogger('marvin.tasks')
 
@@ -31,18 +40,54 @@ def external_search(query):
     locally.
     """
     omdb = OMDBFetcher()
-    omdb.search_and_store(query)
+    try:
+        omdb.search_and_store(query)
+    except Exception: # pylint: disable=broad-except
+        # Let the next search for this query try again, instead of waiting for it to expire
+        forget_external_search(query)
+        raise
+    finish_external_search(query)
 
 
 @task(name='update-meta')
 def update_meta(external_ids=None):
-    """ Update the metadata from OMDb for the given IDs, or for all movies if not defined. """
-    if external_ids is None:
-        movies = Movie.query.all()
-    else:
-        movies = Movie.query.filter(Movie.external_id.in_(external_ids)).all()
-    for movie in movies:
-        update_meta_for_movie.delay(movie.external_id)
+    """ Update the metadata from OMDb for the given IDs, or for all movies if not defined.
+
+    Movies are processed in chunks of ``OMDB_REFRESH_CHUNK_SIZE``. The metadata for a chunk is fetched
+    in parallel from OMDb, and written back with a single bulk update.
+    """
+    config = current_app.config
+    fetcher = OMDbBatchFetcher(config['OMDB_CONCURRENCY'], config['OMDB_REQUESTS_PER_SECOND'])
+    try:
+        for movies in _get_movie_chunks(external_ids, config['OMDB_REFRESH_CHUNK_SIZE']):
+            omdb_objects = fetcher.fetch([movie.external_id for movie in movies])
+            rows = []
+            for movie, omdb in zip(movies, omdb_objects):
+                if omdb:
+                    try:
+                        rows.append(_get_bind_values(get_movie_updates(movie, omdb)))
+                    except (AttributeError, TypeError, ValueError):
+                        # Don't let one odd OMDb object stop the rest of the refresh
+                        _logger.exception("Invalid OMDb object for movie '%s': %r", movie.external_id, omdb)
+            if rows:
+                db.session.execute(_get_bulk_movie_update(), rows)
+                invalidate('movies', *['movie:%d' % row['movie_id_'] for row in rows])
+            db.session.commit()
+            _logger.info("Updated metadata for %d of %d movies", len(rows), len(movies))
+    finally:
+        fetcher.close()
+
+
+@task(name='recompute-relevancy')
+def recompute_stale_relevancy():
+    """ Recalculate the relevancy of movies where it's stale, see :mod:`marvin.relevancy`. Run by celery beat. """
+    recompute_relevancy(chunk_size=current_app.config['RELEVANCY_CHUNK_SIZE'])
+
+
+@task(name='refresh-stats')
+def refresh_statistics():
+    """ Recount the statistics shown on the stats page, see :mod:`marvin.stats`. Run by celery beat. """
+    refresh_stats()
 
 
 @task(name='update-meta-for-movie')
@@ -53,18 +98,11 @@ def update_meta_for_movie(external_id):
     """
     omdb = get_omdb_object(external_id)
     movie = Movie.query.filter(Movie.external_id == external_id).one()
-    Mapper = namedtuple('Mapper', ['omdb_property', 'movie_property', 'parser']) # pylint: disable=invalid-name
-    mappers = [
-        Mapper('Poster', 'cover_img', str),
-        Mapper('Runtime', 'duration_in_s', parse_runtime_to_seconds),
-        Mapper('Metascore', 'metascore', int),
-        Mapper('imdbRating', 'imdb_rating', float),
-        Mapper('imdbVotes', 'number_of_imdb_votes', lambda s: int(s.replace(',', '')))
-    ]
-    for mapper in mappers:
+    for mapper in OMDB_MAPPERS:
         save_omdb_property_to_movie(movie, omdb, mapper)
     _logger.info("Updating relevancy for movie '%s'", movie.title)
     movie.update_relevancy()
+    invalidate('movie:%d' % movie.id, 'movies')
     db.session.commit()
 
 
@@ -76,6 +114,57 @@ def save_omdb_property_to_movie(movie, omdb_results, mapper):
         setattr(movie, mapper.movie_property, prop)
 
 
+def get_movie_updates(movie, omdb_results):
+    """ Get the new values for all the properties updated from OMDb, including relevancy.
+
+    :param movie: The current values for the movie, as a row with the movie's id, year and all the
+        properties in :data:`OMDB_MAPPERS`.
+    :param omdb_results: The OMDb object for the movie.
+    """
+    values = dict((mapper.movie_property, getattr(movie, mapper.movie_property)) for mapper in OMDB_MAPPERS)
+    for mapper in OMDB_MAPPERS:
+        prop_raw = omdb_results.get(mapper.omdb_property, 'N/A')
+        if prop_raw != 'N/A':
+            values[mapper.movie_property] = mapper.parser(prop_raw)
+    now = datetime.now()
+    values['relevancy'] = compute_relevancy(values['imdb_rating'], values['metascore'],
+        values['number_of_imdb_votes'], movie.year, now.year)
+    values['relevancy_computed_at'] = now
+    values['movie_id'] = movie.id
+    return values
+
+
+def _get_movie_chunks(external_ids, chunk_size):
+    """ Yield lists of at most `chunk_size` movies that can be looked up in OMDb, as lightweight rows. """
+    columns = [Movie.id, Movie.external_id, Movie.year] + [getattr(Movie, mapper.movie_property)
+        for mapper in OMDB_MAPPERS]
+    base_query = db.session.query(*columns).filter(Movie.external_id.like('imdb:%'))
+    if external_ids is not None:
+        base_query = base_query.filter(Movie.external_id.in_(external_ids))
+    last_id = 0
+    while True:
+        # Page by id instead of keeping a cursor open, since we commit between the chunks
+        movies = base_query.filter(Movie.id > last_id).order_by(Movie.id.asc()).limit(chunk_size).all()
+        if not movies:
+            return
+        yield movies
+        last_id = movies[-1].id
+
+
+def _get_bind_values(values):
+    """ Name the values for the bind params of :func:`_get_bulk_movie_update`. """
+    return dict((name + '_', value) for name, value in values.items())
+
+
+def _get_bulk_movie_update():
+    """ An UPDATE statement setting all properties from :func:`get_movie_updates` for a movie. """
+    movie_table = Movie.__table__
+    properties = [mapper.movie_property for mapper in OMDB_MAPPERS] + ['relevancy', 'relevancy_computed_at']
+    # The bind params can't share names with the columns
+    values = dict((prop, bindparam(prop + '_')) for prop in properties)
+    return movie_table.update().where(movie_table.c.id == bindparam('movie_id_')).values(**values)
+
+
 def parse_runtime_to_seconds(runtime):
     """ Parses number of seconds from a runtime string. """
     first_match = re.match(r'^[\d]{1,3} min$', runtime)
@@ -103,6 +192,58 @@ def parse_runtime_to_seconds(runtime):
     return 0
 
 
+Mapper = namedtuple('Mapper', ['omdb_property', 'movie_property', 'parser']) # pylint: disable=invalid-name
+
+#: How to save the properties of OMDb objects to movies
+OMDB_MAPPERS = [
+    Mapper('Poster', 'cover_img', str),
+    Mapper('Runtime', 'duration_in_s', parse_runtime_to_seconds),
+    Mapper('Metascore', 'metascore', int),
+    Mapper('imdbRating', 'imdb_rating', float),
+    Mapper('imdbVotes', 'number_of_imdb_votes', lambda s: int(s.replace(',', ''))),
+]
+
+
+class OMDbBatchFetcher(object):
+    """ Fetch many objects from OMDb in parallel.
+
+    :param concurrency: Maximum number of requests to OMDb in flight at any time.
+    :param requests_per_second: Maximum number of requests to OMDb started per second.
+    """
+
+    def __init__(self, concurrency, requests_per_second):
+        self.pool = ThreadPool(concurrency)
+        self.rate_limiter = RateLimiter(requests_per_second)
+        # The worker threads don't have an app context, so get the client up front
+        self.client = get_omdb_client()
+
+
+    def fetch(self, external_ids):
+        """ Get the OMDb objects for the given IDs, in the same order. Failed lookups are None. """
+        return self.pool.map(self._fetch_one, external_ids)
+
+
+    def close(self):
+        """ Stop the worker threads. """
+        self.pool.close()
+        self.pool.join()
+
+
+    def _fetch_one(self, external_id):
+        _, movie_id = external_id.split(':', 1)
+        self.rate_limiter.wait()
+        try:
+            omdb = self.client.get({'i': movie_id})
+        except (requests.RequestException, ValueError):
+            # ValueError if the response isn't valid JSON
+            _logger.exception("Querying OMDb for movie with id '%s' failed", movie_id)
+            return None
+        if omdb and omdb.get('Response') == 'False':
+            _logger.warning("OMDb didn't find movie with id '%s': %s", movie_id, omdb.get('Error'))
+            return None
+        return omdb
+
+
 def get_omdb_object(external_id):
     """ Fetch the object with the given IMDb ID from OMDb. Returns None on failures. """
     provider, movie_id = external_id.split(':', 1)
@@ -117,17 +258,8 @@ def get_omdb_object(external_id):
 
 
 def omdb_request(payload):
-    """ A proxy around OMDb with error handling. """
-    response = requests.get('http://omdbapi.com', params=payload)
-    if response.status_code != 200:
-        _logger.error(textwrap.dedent("""OMDb query for movie details returned non-200 status code.
-            URL:         %s
-            Status code: %d
-            Response:    %s
-        """), response.url, response.status_code, response.text)
-        return None
-    json_results = response.json()
-    return json_results
+    """ Query OMDb through the shared client, see :class:`marvin.omdb.OMDbClient`. """
+    return get_omdb_client().get(payload)
 
 
 class OMDBFetcher(object):
@@ -136,8 +268,6 @@ class OMDBFetcher(object):
         entities, so everything saved from this fetcher will be with a imdb: external_id.
     """
 
-    OMDB_URL = 'http://www.omdbapi.com/'
-
     def search_and_store(self, query):
         """ Get OMDb search results for `query`, store the results.
 
@@ -3,7 +3,9 @@
 from marvin import create_app, db
 from marvin.models import User
 
+from contextlib import contextmanager
 from os import path
+from sqlalchemy import event
 
 import os
 import ujson as json
@@ -153,6 +155,33 @@ class TestCaseWithTempDB(MarvinBaseTestCase):
         super(TestCaseWithTempDB, self)._post_teardown()
 
 
+    @contextmanager
+    def countQueries(self):
+        """ Record the SQL statements executed inside the block.
+
+        Yields a list that will be filled with the statements as they are executed.
+        """
+        with self.app.app_context():
+            engine = db.engine
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany): # pylint: disable=unused-argument
+            statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+
+    @contextmanager
+    def assertNumQueries(self, number):
+        """ Check that exactly `number` SQL statements are executed inside the block. """
+        with self.countQueries() as statements:
+            yield
+        self.assertEqual(len(statements), number, "Expected %d queries, but %d were executed:\n%s" %
+            (number, len(statements), '\n'.join(statements)))
+
+
     def addItems(self, *args):
         """ Adds all items passed to the database. """
         result_ids = []
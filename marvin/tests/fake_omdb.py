@@ -0,0 +1,71 @@
+"""
+    marvin.tests.fake_omdb
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    A local HTTP server pretending to be OMDb, for testing and benchmarking code talking to it.
+
+"""
+
+from threading import Lock, Thread
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request, Response
+
+import time
+import ujson
+
+
+class FakeOMDb(object):
+    """ Answers OMDb lookups by ID (``i``) and searches (``s``) from the `movies` dict, keyed by IMDb ID.
+
+    :param movies: The OMDb objects to serve, keyed by IMDb ID. Searches match the ``Title``. Strings
+        are served as they are instead of as JSON, to simulate broken responses.
+    :param latency: Seconds to wait before answering each request, to simulate the network.
+    :param failures: Number of requests to answer with HTTP 500 before answering properly.
+    """
+
+    def __init__(self, movies=None, latency=0, failures=0):
+        self.movies = movies or {}
+        self.latency = latency
+        self.failures = failures
+        self.request_count = 0
+        self._lock = Lock()
+        self._server = None
+
+
+    def start(self):
+        """ Start serving in a background thread. Returns the URL to query. """
+        self._server = make_server('127.0.0.1', 0, self._app, threaded=True)
+        thread = Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:%d/' % self._server.server_port
+
+
+    def stop(self):
+        """ Stop the server, and stop listening for connections. """
+        self._server.shutdown()
+        self._server.server_close()
+
+
+    @Request.application
+    def _app(self, request):
+        with self._lock:
+            self.request_count += 1
+            fail = self.request_count <= self.failures
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            return Response('Internal server error', status=500)
+        imdb_id = request.args.get('i')
+        query = request.args.get('s')
+        if imdb_id in self.movies:
+            result = self.movies[imdb_id]
+        elif query is not None:
+            matches = [dict(movie, imdbID=imdb_id) for imdb_id, movie in sorted(self.movies.items())
+                if isinstance(movie, dict) and query.lower() in movie.get('Title', '').lower()]
+            result = {'Search': matches} if matches else {'Response': 'False', 'Error': 'Movie not found!'}
+        else:
+            result = {'Response': 'False', 'Error': 'Incorrect IMDb ID'}
+        if not isinstance(result, dict):
+            return Response(result, mimetype='application/json')
+        return Response(ujson.dumps(result), mimetype='application/json')
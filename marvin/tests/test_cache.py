@@ -0,0 +1,91 @@
+from marvin.cache import DiskCache, LocalCache
+
+import shutil
+import tempfile
+import unittest
+
+
+class LocalCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = LocalCache(max_size=3, clock=lambda: self.now)
+
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('foo'))
+        self.cache.set('foo', 'bar')
+        self.assertEqual(self.cache.get('foo'), 'bar')
+        self.cache.delete('foo')
+        self.assertIsNone(self.cache.get('foo'))
+
+
+    def test_expiry(self):
+        self.cache.set('foo', 'bar', ttl=10)
+        self.now += 9
+        self.assertEqual(self.cache.get('foo'), 'bar')
+        self.now += 1
+        self.assertIsNone(self.cache.get('foo'))
+
+
+    def test_add(self):
+        self.assertTrue(self.cache.add('foo', 'bar', ttl=10))
+        self.assertFalse(self.cache.add('foo', 'baz', ttl=10))
+        self.assertEqual(self.cache.get('foo'), 'bar')
+        self.now += 10
+        self.assertTrue(self.cache.add('foo', 'baz'))
+        self.assertEqual(self.cache.get('foo'), 'baz')
+
+
+    def test_evicts_least_recently_used(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, key)
+        self.cache.get('a')
+        self.cache.set('d', 'd')
+        self.assertEqual(len(self.cache), 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 'a')
+
+
+    def test_clear(self):
+        self.cache.set('foo', 'bar')
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+
+class DiskCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.directory = tempfile.mkdtemp()
+        self.cache = DiskCache(self.directory, clock=lambda: self.now)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('foo'))
+        self.cache.set('foo', {'bar': [1, 2]})
+        self.assertEqual(self.cache.get('foo'), {'bar': [1, 2]})
+        # Other instances using the same directory see it too
+        self.assertEqual(DiskCache(self.directory).get('foo'), {'bar': [1, 2]})
+        self.cache.delete('foo')
+        self.assertIsNone(self.cache.get('foo'))
+
+
+    def test_expiry(self):
+        self.cache.set('foo', 'bar', ttl=10)
+        self.now += 9
+        self.assertEqual(self.cache.get('foo'), 'bar')
+        self.now += 1
+        self.assertIsNone(self.cache.get('foo'))
+
+
+    def test_clear(self):
+        self.cache.set('foo', 'bar')
+        self.cache.set('bar', 'baz')
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('foo'))
+        self.assertIsNone(self.cache.get('bar'))
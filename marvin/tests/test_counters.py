@@ -0,0 +1,106 @@
+from marvin import db
+from marvin.counters import reconcile_counters
+from marvin.models import Entry, Movie, Stream, User
+from marvin.tests import TestCaseWithTempDB, AuthenticatedUserMixin
+
+
+class CounterTest(TestCaseWithTempDB, AuthenticatedUserMixin):
+
+    def setUp(self):
+        self.authenticate()
+        movie = Movie(title='Titanic', external_id='imdb:tt0120338')
+        other_movie = Movie(title='Avatar', external_id='imdb:tt0499549')
+        stream = Stream(name='CinemaSins', movie=movie, creator=self.user, public=True)
+        private_stream = Stream(name='Uncompleted', movie=movie, creator=self.user)
+        entry = Entry(title='Iceberg', entry_point_in_ms=2500, content_type='text', content='{}', stream=stream)
+        self.movie_id, self.other_movie_id, self.stream_id, self.private_stream_id = self.addItems(movie,
+            other_movie, stream, private_stream, entry)[:4]
+
+
+    def assertCounts(self, movie_streams=None, user_streams=None, stream_entries=None):
+        with self.app.test_request_context():
+            if movie_streams is not None:
+                self.assertEqual(Movie.query.get(self.movie_id).number_of_streams, movie_streams)
+            if user_streams is not None:
+                user = User.query.filter_by(username='bob').one()
+                self.assertEqual(user.number_of_published_streams, user_streams)
+            if stream_entries is not None:
+                self.assertEqual(Stream.query.get(self.stream_id).number_of_entries, stream_entries)
+
+
+    def test_created(self):
+        self.assertCounts(movie_streams=1, user_streams=1, stream_entries=1)
+
+
+    def test_publish_and_unpublish(self):
+        response = self.client.post('/streams/%d/publish' % self.private_stream_id, headers=self.auth_header)
+        self.assert200(response)
+        self.assertCounts(movie_streams=2, user_streams=2)
+        response = self.client.post('/streams/%d/unpublish' % self.stream_id, headers=self.auth_header)
+        self.assert200(response)
+        self.assertCounts(movie_streams=1, user_streams=1)
+
+
+    def test_delete_unpublished_stream(self):
+        response = self.client.delete('/streams/%d' % self.private_stream_id, headers=self.auth_header)
+        self.assert200(response)
+        self.assertCounts(movie_streams=1, user_streams=1)
+
+
+    def test_delete_published_stream(self):
+        response = self.client.delete('/streams/%d' % self.stream_id, headers=self.auth_header)
+        self.assert200(response)
+        self.assertCounts(movie_streams=0, user_streams=0)
+
+
+    def test_entries(self):
+        entry = {
+            'title': 'Jack',
+            'entry_point_in_ms': 5000,
+            'content_type': 'text',
+            'content': '{"text": "I\'m flying"}',
+        }
+        response = self.client.post('/streams/%d/createEntry' % self.stream_id, data=entry, headers=self.auth_header)
+        entry_id = self.assert201(response)['entry']['href'].rsplit('/', 1)[1]
+        self.assertCounts(stream_entries=2)
+        response = self.client.delete('/entries/%s' % entry_id, headers=self.auth_header)
+        self.assert200(response)
+        self.assertCounts(stream_entries=1)
+
+
+    def test_move_stream(self):
+        with self.app.test_request_context():
+            Stream.query.get(self.stream_id).movie_id = self.other_movie_id
+            db.session.commit()
+            self.assertEqual(Movie.query.get(self.other_movie_id).number_of_streams, 1)
+        self.assertCounts(movie_streams=0, user_streams=1)
+
+
+    def test_counts_in_session_are_refreshed(self):
+        with self.app.test_request_context():
+            movie = Movie.query.get(self.movie_id)
+            self.assertEqual(movie.number_of_streams, 1)
+            Stream.query.get(self.private_stream_id).public = True
+            db.session.flush()
+            self.assertEqual(movie.number_of_streams, 2)
+            db.session.rollback()
+            self.assertEqual(movie.number_of_streams, 1)
+
+
+    def test_reconcile(self):
+        with self.app.test_request_context():
+            # Bulk changes bypass the ORM, and can leave the counts off
+            Entry.query.delete()
+            Movie.query.filter(Movie.id == self.other_movie_id).update({'number_of_streams': 5})
+            db.session.commit()
+            with self.assertNumQueries(3):
+                fixed = reconcile_counters()
+            self.assertEqual(fixed, {
+                'streams per movie': 1,
+                'published streams per user': 0,
+                'entries per stream': 1,
+            })
+            self.assertEqual(Movie.query.get(self.other_movie_id).number_of_streams, 0)
+        self.assertCounts(movie_streams=1, user_streams=1, stream_entries=0)
+        with self.app.test_request_context():
+            self.assertEqual(set(reconcile_counters().values()), set([0]))
@@ -1,3 +1,4 @@
+from marvin import db
 from marvin.models import Movie, Stream, Entry, User
 from marvin.tests import TestCaseWithTempDB, AuthenticatedUserMixin
 
@@ -183,3 +184,94 @@ class EntryDetailViewTest(TestCaseWithTempDB, AuthenticatedUserMixin):
         response = self.client.post('/streams/%d/createEntry' % self.stream_id, data=entry,
             headers=self.alices_auth_header)
         self.assert403(response)
+
+
+class MovieEntryWindowTest(TestCaseWithTempDB, AuthenticatedUserMixin):
+
+    def setUp(self):
+        self.authenticate()
+        movie = Movie(title='Avatar', external_id='imdb:tt0499549')
+        other_movie = Movie(title='Titanic', external_id='imdb:tt0120338')
+        alice = User(username='alice', email='alice@example.com', password='alicepw')
+        sins = Stream(name='CinemaSins', movie=movie, creator=self.user, public=True)
+        actors = Stream(name='Actors', movie=movie, creator=self.user, public=True)
+        drafts = Stream(name='Drafts', movie=movie, creator=alice)
+        other_stream = Stream(name='Icebergs', movie=other_movie, creator=self.user, public=True)
+        items = [movie, alice, sins, actors, drafts, other_stream]
+        for minute in range(10):
+            for stream in (sins, actors, drafts):
+                items.append(Entry(entry_point_in_ms=minute*60*1000, stream=stream, title='Title',
+                    content_type='text', content={'text': '%s at %d minutes' % (stream.name, minute)}))
+        ids = self.addItems(*items)
+        self.movie_id, _, self.sins_id, self.actors_id, self.drafts_id, self.other_stream_id = ids[:6]
+
+
+    def test_window(self):
+        response = self.client.get('/movies/%d/entries?streams=%d,%d&from_ms=%d&to_ms=%d' % (
+            self.movie_id, self.sins_id, self.actors_id, 2*60*1000, 5*60*1000))
+        json_response = self.assert200(response)
+        entries = json_response['entries']
+        # 3 minutes of entries from both streams, to_ms being exclusive
+        self.assertEqual(len(entries), 6)
+        self.assertEqual(entries[0]['entry_point_in_ms'], 2*60*1000)
+        self.assertEqual(entries[-1]['entry_point_in_ms'], 4*60*1000)
+        self.assertEqual(set(entry['stream']['name'] for entry in entries), set(['CinemaSins', 'Actors']))
+        self.assertTrue('from_ms=%d' % (5*60*1000) in json_response['_links']['next'])
+
+
+    def test_window_defaults_to_visible_streams(self):
+        response = self.client.get('/movies/%d/entries' % self.movie_id)
+        json_response = self.assert200(response)
+        self.assertEqual(len(json_response['entries']), 20)
+
+
+    def test_next_link_without_visible_streams(self):
+        with self.app.test_request_context():
+            movie = Movie.query.get(self.movie_id)
+            for stream in movie.streams:
+                stream.public = False
+            db.session.commit()
+        # Nothing to see without logging in, but the next window should still be valid
+        response = self.client.get('/movies/%d/entries' % self.movie_id)
+        json_response = self.assert200(response)
+        self.assertEqual(json_response['entries'], [])
+        next_link = json_response['_links']['next']
+        self.assertFalse('streams=' in next_link)
+        response = self.client.get(next_link.replace('http://localhost', ''))
+        self.assert200(response)
+
+
+    def test_next_link_keeps_requested_streams(self):
+        response = self.client.get('/movies/%d/entries?streams=%d&from_ms=0&to_ms=%d' % (
+            self.movie_id, self.sins_id, 2*60*1000))
+        json_response = self.assert200(response)
+        next_link = json_response['_links']['next']
+        self.assertTrue('streams=%d' % self.sins_id in next_link)
+        entries = self.assert200(self.client.get(next_link.replace('http://localhost', '')))['entries']
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(set(entry['stream']['name'] for entry in entries), set(['CinemaSins']))
+
+        # Without requested streams the next window picks the visible ones again
+        response = self.client.get('/movies/%d/entries' % self.movie_id)
+        json_response = self.assert200(response)
+        self.assertFalse('streams=' in json_response['_links']['next'])
+
+
+    def test_private_stream_restricted(self):
+        response = self.client.get('/movies/%d/entries?streams=%d' % (self.movie_id, self.drafts_id))
+        self.assert401(response)
+        response = self.client.get('/movies/%d/entries?streams=%d' % (self.movie_id, self.drafts_id),
+            headers=self.auth_header)
+        self.assert403(response)
+
+
+    def test_stream_from_other_movie(self):
+        response = self.client.get('/movies/%d/entries?streams=%d' % (self.movie_id, self.other_stream_id))
+        self.assertValidClientError(response)
+
+
+    def test_invalid_params(self):
+        for params in ['streams=a,b', 'streams=', 'from_ms=soon', 'from_ms=1000&to_ms=1000',
+                       'from_ms=0&to_ms=%d' % (24*3600*1000)]:
+            response = self.client.get('/movies/%d/entries?%s' % (self.movie_id, params))
+            self.assertValidClientError(response)
@@ -0,0 +1,140 @@
+from marvin.feed import EntryFeed
+from marvin.pubsub import LocalPubSub
+from marvin.models import Movie, Stream, Entry
+from marvin.tests import TestCaseWithTempDB, AuthenticatedUserMixin
+
+import unittest
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_item(entry_id, entry_point_in_ms):
+    return {
+        'id': entry_id,
+        'entry': {
+            'entry_point_in_ms': entry_point_in_ms,
+            'title': 'Entry %d' % entry_id,
+        },
+    }
+
+
+class EntryFeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.items = [make_item(i, i*1000) for i in range(1, 11)]
+        self.loads = []
+        self.clock = FakeClock()
+        self.pubsub = LocalPubSub()
+        self.feed = EntryFeed(self.load_entries, self.pubsub.subscribe('stream'), offset_ms=2000, page_size=3,
+            clock=self.clock)
+
+
+    def load_entries(self, after, limit):
+        self.loads.append(after)
+        items = sorted(self.items, key=lambda item: (item['entry']['entry_point_in_ms'], item['id']))
+        return [item for item in items if (item['entry']['entry_point_in_ms'], item['id']) > after][:limit]
+
+
+    def test_nothing_due(self):
+        self.assertEqual(self.feed.get_due_entries(timeout=0), [])
+        # Only the first page should have been loaded, skipping entries before the offset
+        self.assertEqual(self.loads, [(2000, 2**63 - 1)])
+
+
+    def test_entries_due_as_time_passes(self):
+        self.clock.now += 1.5
+        self.assertEqual([e['title'] for e in self.feed.get_due_entries(timeout=0)], ['Entry 3'])
+        self.clock.now += 3
+        self.assertEqual([e['title'] for e in self.feed.get_due_entries(timeout=0)],
+            ['Entry 4', 'Entry 5', 'Entry 6'])
+        self.assertEqual(self.feed.delivered_until_ms, 6500)
+        self.clock.now += 100
+        self.assertEqual(len(self.feed.get_due_entries(timeout=0)), 4)
+        self.assertEqual(self.feed.get_due_entries(timeout=0), [])
+
+
+    def test_due_entries_across_pages(self):
+        self.clock.now += 5.5
+        # The position is past the first page, so the entries due on the next one are read right away
+        self.assertEqual([e['title'] for e in self.feed.get_due_entries(timeout=0)],
+            ['Entry 3', 'Entry 4', 'Entry 5', 'Entry 6', 'Entry 7'])
+        self.assertEqual(self.feed.delivered_until_ms, 7500)
+
+
+    def test_published_entries(self):
+        self.pubsub.publish('stream', make_item(11, 2500))
+        self.pubsub.publish('stream', make_item(12, 1000))
+        self.clock.now += 0.5
+        # Entry 12 is before the offset, and should never be delivered
+        self.assertEqual([e['title'] for e in self.feed.get_due_entries(timeout=0.1)], ['Entry 11'])
+
+
+    def test_published_entries_not_duplicated(self):
+        self.items.append(make_item(11, 9500))
+        self.pubsub.publish('stream', make_item(11, 9500))
+        self.clock.now += 100
+        titles = [e['title'] for e in self.feed.get_due_entries(timeout=0.1)]
+        self.assertEqual(titles, ['Entry %d' % i for i in range(3, 10)] + ['Entry 11', 'Entry 10'])
+
+
+    def test_close(self):
+        self.feed.close()
+        self.pubsub.publish('stream', make_item(11, 2500))
+        self.assertEqual(self.feed.subscription.get(timeout=0), None)
+
+
+class StreamFeedViewTest(TestCaseWithTempDB, AuthenticatedUserMixin):
+
+    def setUp(self):
+        self.authenticate()
+        self.app.config['FEED_LONGPOLL_TIMEOUT_IN_S'] = 1
+        self.app.config['FEED_MAX_DURATION_IN_S'] = 0.3
+        self.app.config['FEED_HEARTBEAT_IN_S'] = 0.1
+        movie = Movie(title='Avatar', external_id='imdb:tt0499549')
+        stream = Stream(name='CinemaSins', movie=movie, creator=self.user, public=True)
+        private_stream = Stream(name='Drafts', movie=movie, creator=self.user)
+        entries = [Entry(entry_point_in_ms=i*60*1000, title='Minute %d' % i, content_type='text',
+            content={'text': 'Minute %d' % i}, stream=stream) for i in range(5)]
+        self.stream_id, self.private_stream_id = self.addItems(stream, private_stream, *entries)[:2]
+
+
+    def test_long_poll(self):
+        response = self.client.get('/streams/%d/feed?offset_ms=%d' % (self.stream_id, 60*1000 - 50))
+        json_response = self.assert200(response)
+        self.assertEqual([e['title'] for e in json_response['entries']], ['Minute 1'])
+        self.assertTrue('offset_ms=6' in json_response['_links']['next'])
+
+
+    def test_long_poll_timeout(self):
+        self.app.config['FEED_LONGPOLL_TIMEOUT_IN_S'] = 0.05
+        response = self.client.get('/streams/%d/feed?offset_ms=%d' % (self.stream_id, 4*60*1000))
+        json_response = self.assert200(response)
+        self.assertEqual(json_response['entries'], [])
+
+
+    def test_event_stream(self):
+        response = self.client.get('/streams/%d/feed?offset_ms=%d' % (self.stream_id, 2*60*1000 - 100),
+            headers={'Accept': 'text/event-stream'})
+        self.assert_status(response, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        data = response.data.decode('utf-8')
+        self.assertEqual(data.count('event: entry'), 1)
+        self.assertTrue('Minute 2' in data)
+        self.assertTrue('event: end' in data)
+
+
+    def test_private_restricted(self):
+        response = self.client.get('/streams/%d/feed' % self.private_stream_id)
+        self.assert401(response)
+
+
+    def test_invalid_offset(self):
+        response = self.client.get('/streams/%d/feed?offset_ms=later' % self.stream_id)
+        self.assertValidClientError(response)
@@ -0,0 +1,150 @@
+from marvin import db
+from marvin.cache import get_cache
+from marvin.httpcache import invalidate, invalidate_now
+from marvin.models import Movie, Stream
+from marvin.tests import TestCaseWithTempDB, AuthenticatedUserMixin
+
+from mock import Mock, patch
+from werkzeug.http import http_date
+
+import time
+
+
+class ResponseCacheTest(TestCaseWithTempDB, AuthenticatedUserMixin):
+
+    def setUp(self):
+        self.authenticate()
+        movie = Movie(title='Titanic', external_id='imdb:tt0120338')
+        stream = Stream(name='CinemaSins', movie=movie, creator=self.user, public=True)
+        private_stream = Stream(name='Uncompleted', movie=movie, creator=self.user)
+        self.movie_id, self.stream_id, self.private_stream_id = self.addItems(movie, stream, private_stream)
+
+
+    def test_etag(self):
+        response = self.client.get('/movies/%d' % self.movie_id)
+        self.assert200(response)
+        etag = response.headers['ETag']
+        self.assertTrue('Last-Modified' in response.headers)
+
+        response = self.client.get('/movies/%d' % self.movie_id, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        response = self.client.get('/movies/%d' % self.movie_id, headers={'If-None-Match': '"something-else"'})
+        self.assert200(response)
+
+
+    def test_if_modified_since(self):
+        response = self.client.get('/streams/%d' % self.stream_id)
+        last_modified = response.headers['Last-Modified']
+        response = self.client.get('/streams/%d' % self.stream_id, headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/streams/%d' % self.stream_id,
+            headers={'If-Modified-Since': http_date(time.time() - 3600)})
+        self.assert200(response)
+
+
+    def test_cached_responses_dont_query(self):
+        response = self.client.get('/movies')
+        json_response = self.assert200(response)
+        with self.assertNumQueries(0):
+            response = self.client.get('/movies')
+        self.assertEqual(self.assert200(response), json_response)
+
+
+    def test_publish_invalidates(self):
+        movie_etag = self.client.get('/movies/%d' % self.movie_id).headers['ETag']
+        front_page = self.assert200(self.client.get('/movies'))
+        self.assertEqual(front_page['movies'][0]['number_of_streams'], 1)
+
+        response = self.client.post('/streams/%d/publish' % self.private_stream_id, headers=self.auth_header)
+        self.assert200(response)
+
+        response = self.client.get('/movies/%d' % self.movie_id, headers={'If-None-Match': movie_etag})
+        self.assert200(response)
+        front_page = self.assert200(self.client.get('/movies'))
+        self.assertEqual(front_page['movies'][0]['number_of_streams'], 2)
+
+
+    def test_update_invalidates(self):
+        self.client.get('/streams/%d' % self.stream_id)
+        response = self.client.put('/streams/%d' % self.stream_id, data={'name': 'CinemaSaints'},
+            headers=self.auth_header)
+        self.assert200(response)
+        json_response = self.assert200(self.client.get('/streams/%d' % self.stream_id))
+        self.assertEqual(json_response['stream']['name'], 'CinemaSaints')
+
+
+    def test_responses_per_user(self):
+        # The creator sees the private stream on the movie, others don't
+        anonymous = self.assert200(self.client.get('/movies/%d' % self.movie_id))
+        creator = self.assert200(self.client.get('/movies/%d' % self.movie_id, headers=self.auth_header))
+        self.assertEqual(len(anonymous['movie']['streams']), 1)
+        self.assertEqual(len(creator['movie']['streams']), 2)
+
+
+    def test_errors_not_cached(self):
+        self.assert401(self.client.get('/streams/%d' % self.private_stream_id))
+        self.assert200(self.client.get('/streams/%d' % self.private_stream_id, headers=self.auth_header))
+        self.assert401(self.client.get('/streams/%d' % self.private_stream_id))
+
+
+    def test_conditional_requests_checked_by_view(self):
+        last_modified = http_date(time.time() + 3600)
+        headers = {'If-Modified-Since': last_modified}
+        self.assert401(self.client.get('/streams/%d' % self.private_stream_id, headers=headers))
+        self.assert404(self.client.get('/streams/54321', headers=headers))
+        with self.app.test_request_context():
+            self.assertIsNone(get_cache('resource-versions').get('stream:54321'))
+        # The creator can read it, and gets a 304 once it's been served
+        headers.update(self.auth_header)
+        response = self.client.get('/streams/%d' % self.private_stream_id, headers=headers)
+        self.assertEqual(response.status_code, 304)
+
+
+    def test_private_responses(self):
+        response = self.client.get('/movies/%d' % self.movie_id)
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        response = self.client.get('/movies/%d' % self.movie_id, headers=self.auth_header)
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+
+
+    def test_searches_not_cached(self):
+        with patch('marvin.tasks.external_search'):
+            response = self.client.get('/movies?q=titanic')
+        self.assertFalse('ETag' in response.headers)
+
+
+    def test_if_modified_since_changed_within_a_second(self):
+        # All versions are created in the same second
+        with patch('marvin.httpcache.time', Mock(**{'time.return_value': 1400000000.5})):
+            response = self.client.get('/streams/%d' % self.stream_id)
+            last_modified = response.headers['Last-Modified']
+            with self.app.test_request_context():
+                invalidate_now('stream:%d' % self.stream_id)
+            response = self.client.get('/streams/%d' % self.stream_id, headers={'If-Modified-Since': last_modified})
+        self.assert200(response)
+        self.assertNotEqual(response.headers['Last-Modified'], last_modified)
+
+
+    def test_invalidation_waits_for_commit(self):
+        etag = self.client.get('/movies/%d' % self.movie_id).headers['ETag']
+        with self.app.test_request_context():
+            invalidate('movie:%d' % self.movie_id)
+            db.session.rollback()
+        response = self.client.get('/movies/%d' % self.movie_id, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        with self.app.test_request_context():
+            invalidate('movie:%d' % self.movie_id)
+            db.session.commit()
+        response = self.client.get('/movies/%d' % self.movie_id, headers={'If-None-Match': etag})
+        self.assert200(response)
+
+
+    def test_invalidate_now(self):
+        etag = self.client.get('/movies').headers['ETag']
+        with self.app.test_request_context():
+            invalidate_now('movies')
+        response = self.client.get('/movies', headers={'If-None-Match': etag})
+        self.assert200(response)
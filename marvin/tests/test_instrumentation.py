@@ -0,0 +1,80 @@
+from marvin import create_app, db
+from marvin.models import Movie
+from marvin.tests import TestCaseWithTempDB
+
+from flask import g
+from mock import patch
+from sqlalchemy.exc import OperationalError
+
+
+class InstrumentationTest(TestCaseWithTempDB):
+
+    def setUp(self):
+        movie = Movie(title='Titanic', external_id='imdb:tt0120338')
+        self.movie_id = self.addItems(movie)[0]
+
+
+    def test_server_timing(self):
+        self.app.config['INSTRUMENTATION_SERVER_TIMING'] = True
+        with self.countQueries() as statements:
+            response = self.client.get('/movies/%d' % self.movie_id)
+        self.assert200(response)
+        server_timing = response.headers['Server-Timing']
+        self.assertTrue(server_timing.startswith('app;dur='))
+        self.assertTrue('db;dur=' in server_timing)
+        self.assertTrue('desc="%d queries"' % len(statements) in server_timing)
+        self.assertTrue('serialize;dur=' in server_timing)
+
+
+    def test_no_server_timing_by_default(self):
+        response = self.client.get('/movies/%d' % self.movie_id)
+        self.assertFalse('Server-Timing' in response.headers)
+
+
+    def test_log_line(self):
+        with patch('marvin.instrumentation._logger') as logger:
+            self.client.get('/movies/%d' % self.movie_id)
+        message = logger.info.call_args[0][0]
+        self.assertTrue('resource=MovieDetailView' in message)
+        self.assertTrue('status=200' in message)
+        metrics = logger.info.call_args[1]['extra']['request_metrics']
+        self.assertEqual(metrics['method'], 'GET')
+        self.assertEqual(metrics['path'], '/movies/%d' % self.movie_id)
+        self.assertTrue(metrics['queries'] >= 1)
+
+
+    def test_metrics_endpoint(self):
+        self.app.config['METRICS_ENABLED'] = True
+        for _ in range(3):
+            self.client.get('/movies/%d' % self.movie_id)
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        body = response.data.decode('utf-8')
+        self.assertTrue('# TYPE marvin_request_duration_seconds histogram' in body)
+        self.assertTrue('marvin_request_duration_seconds_count{resource="MovieDetailView",method="GET"} 3' in body)
+        self.assertTrue('marvin_request_duration_seconds_bucket{resource="MovieDetailView",method="GET",le="+Inf"} 3'
+            in body)
+        self.assertTrue('marvin_request_queries_total{resource="MovieDetailView",method="GET"}' in body)
+
+
+    def test_failed_statement_forgotten(self):
+        with self.app.test_request_context():
+            g.marvin_query_count = 0
+            connection = db.engine.connect()
+            try:
+                with self.assertRaises(OperationalError):
+                    connection.execute('SELECT * FROM nonexistent')
+                self.assertEqual(connection.info['marvin_query_start'], [])
+            finally:
+                connection.close()
+
+
+    def test_metrics_endpoint_disabled_by_default(self):
+        self.assert_status(self.client.get('/metrics'), 404)
+
+
+    def test_disabled(self):
+        # Only read when the app is created
+        app = create_app(INSTRUMENTATION_ENABLED=False, INSTRUMENTATION_SERVER_TIMING=True)
+        response = app.test_client().get('/promo')
+        self.assertFalse('Server-Timing' in response.headers)
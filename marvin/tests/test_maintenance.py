@@ -0,0 +1,88 @@
+from marvin import db
+from marvin.maintenance import delete_streams
+from marvin.models import Entry, Movie, MovieTitleTrigram, Stream, User
+from marvin.tests import TestCaseWithTempDB
+
+from datetime import datetime
+
+
+class DeleteStreamsTest(TestCaseWithTempDB):
+
+    def setUp(self):
+        # Hash the passwords with the app's settings
+        with self.app.test_request_context():
+            bob = User(username='bob', email='bob@example.com', password='bobspw')
+            alice = User(username='alice', email='alice@example.com', password='alicepw')
+            titanic = Movie(title='Titanic', external_id='imdb:tt0120338')
+            avatar = Movie(title='Avatar', external_id='imdb:tt0499549')
+            items = [bob, alice, titanic, avatar]
+            for name, movie, creator, added in [
+                    ('Old sins', titanic, bob, datetime(2013, 6, 1)),
+                    ('New sins', titanic, bob, datetime(2014, 6, 1)),
+                    ('Alices', titanic, alice, datetime(2014, 6, 1)),
+                    ('Blue people', avatar, bob, datetime(2014, 6, 1))]:
+                stream = Stream(name=name, movie=movie, creator=creator, public=True, datetime_added=added)
+                items.append(stream)
+                for i in range(3):
+                    items.append(Entry(title='Entry %d' % i, entry_point_in_ms=i*1000, content_type='text',
+                        content='{}', stream=stream))
+            ids = self.addItems(*items)
+            self.bob_id, self.alice_id, self.titanic_id, self.avatar_id = ids[:4]
+
+
+    def get_stream_names(self):
+        return set(stream.name for stream in Stream.query.all())
+
+
+    def test_delete_all(self):
+        with self.app.test_request_context():
+            counts = delete_streams(chunk_size=3)
+            self.assertEqual(counts, {'stream': 4, 'entry': 12})
+            self.assertEqual(Stream.query.count(), 0)
+            self.assertEqual(Entry.query.count(), 0)
+            self.assertEqual(Movie.query.count(), 2)
+            self.assertEqual(set(movie.number_of_streams for movie in Movie.query.all()), set([0]))
+
+
+    def test_dry_run(self):
+        with self.app.test_request_context():
+            counts = delete_streams(movie_ids=[self.titanic_id], wipe_movies=True, dry_run=True)
+            self.assertEqual(counts, {'stream': 3, 'entry': 9, 'movie': 1, 'movie_title_trigram': 5})
+            self.assertEqual(Stream.query.count(), 4)
+            self.assertEqual(Entry.query.count(), 12)
+
+
+    def test_scoped_by_user(self):
+        with self.app.test_request_context():
+            delete_streams(creator_ids=[self.alice_id])
+            self.assertEqual(self.get_stream_names(), set(['Old sins', 'New sins', 'Blue people']))
+            self.assertEqual(Entry.query.count(), 9)
+            self.assertEqual(Movie.query.get(self.titanic_id).number_of_streams, 2)
+            self.assertEqual(User.query.get(self.alice_id).number_of_published_streams, 0)
+            self.assertEqual(User.query.get(self.bob_id).number_of_published_streams, 3)
+
+
+    def test_scoped_by_date_and_movie(self):
+        with self.app.test_request_context():
+            delete_streams(movie_ids=[self.titanic_id], added_after=datetime(2014, 1, 1),
+                added_before=datetime(2015, 1, 1), chunk_size=1)
+            self.assertEqual(self.get_stream_names(), set(['Old sins', 'Blue people']))
+            self.assertEqual(Movie.query.get(self.titanic_id).number_of_streams, 1)
+
+
+    def test_wipe_movies(self):
+        with self.app.test_request_context():
+            delete_streams(movie_ids=[self.titanic_id], wipe_movies=True)
+            self.assertEqual([movie.title for movie in Movie.query.all()], ['Avatar'])
+            self.assertEqual(self.get_stream_names(), set(['Blue people']))
+            # The search index should be cleaned up too
+            trigrams = MovieTitleTrigram.query.all()
+            self.assertTrue(trigrams)
+            self.assertEqual(set(trigram.movie_id for trigram in trigrams), set([self.avatar_id]))
+
+
+    def test_wipe_movies_by_user(self):
+        with self.app.test_request_context():
+            self.assertRaises(ValueError, delete_streams, creator_ids=[self.bob_id], wipe_movies=True)
+            db.session.rollback()
+            self.assertEqual(Stream.query.count(), 4)
@@ -1,8 +1,13 @@
-from marvin.models import Movie, Stream
+from marvin import create_app, db
+from marvin.httpcache import invalidate
+from marvin.models import Movie, Stream, User
+from marvin.search import finish_external_search
 from marvin.tests import TestCaseWithTempDB, AuthenticatedUserMixin
 
 from mock import Mock, patch
 
+import time
+
 class AllMovieViewTest(TestCaseWithTempDB):
 
     def setUp(self):
@@ -15,6 +20,8 @@ class AllMovieViewTest(TestCaseWithTempDB):
             external_id='imdb:tt0120338',
         )
         self.addItems(mission_impossible, harry_potter_azkaban)
+        # The mocked external searches run in this process, so we can wait for them
+        self.app.config['CELERY_ALWAYS_EAGER'] = True
 
 
     def test_search(self):
@@ -30,21 +37,99 @@ class AllMovieViewTest(TestCaseWithTempDB):
         self.assertEqual(len(json_response['movies']), 1)
         self.assertEqual(json_response['movies'][0]['title'], 'Harry Potter and the Prisoner of Azkaban')
 
+    def test_repeated_searches_coalesced(self):
+        external_search = Mock()
+        with patch('marvin.tasks.external_search', external_search):
+            for query in ('mission+impossible', 'Mission++Impossible', 'mission+impossible+'):
+                self.assert200(self.client.get('/movies?q=%s' % query))
+        external_search.delay.assert_called_once_with('mission impossible')
+
+
     def test_search_results_empty_fetches_external(self):
-        # Search results for stuff we don't have should fetch more synchronously
+        # Search results for stuff we don't have should wait for the external search
 
         def create_movie(query): # pylint: disable=unused-argument
             movie = Movie(
-                title='Harry Potter',
-                external_id='imdb:tt0241527'
+                title='The Hobbit: An Unexpected Journey',
+                external_id='imdb:tt0903624'
             )
             self.addItems(movie)
 
-        external_search = Mock(side_effect=create_movie)
+        def search(query):
+            create_movie(query)
+            finish_external_search(query)
+
+        external_search = Mock(**{'delay.side_effect': search})
         with patch('marvin.tasks.external_search', external_search):
-            response = self.client.get('/movies?q=harry')
+            response = self.client.get('/movies?q=hobbit')
         json_response = self.assert200(response)
+        external_search.delay.assert_called_once_with('hobbit')
         self.assertEqual(len(json_response['movies']), 1)
+        self.assertEqual(json_response['movies'][0]['title'], 'The Hobbit: An Unexpected Journey')
+        self.assertFalse('Retry-After' in response.headers)
+
+
+    def test_slow_external_search(self):
+        # If the external search doesn't finish in time, we get a link to check on it later
+        self.app.config['EXTERNAL_SEARCH_WAIT_IN_S'] = 0.01
+        with patch('marvin.tasks.external_search', Mock()):
+            response = self.client.get('/movies?q=hobbit')
+        json_response = self.assert200(response)
+        self.assertEqual(json_response['movies'], [])
+        self.assertEqual(response.headers['Retry-After'], '2')
+        status_url = json_response['_links']['searchStatus']
+        self.assertEqual(status_url, 'http://localhost/movies/search?q=hobbit')
+        # The test client drops the query string of absolute URLs
+        status_url = status_url.replace('http://localhost', '')
+
+        response = self.client.get(status_url)
+        json_response = self.assert200(response)
+        self.assertEqual(json_response['search']['status'], 'pending')
+
+        # Once the search is done, the results can be fetched
+        with self.app.test_request_context():
+            finish_external_search('hobbit')
+        response = self.client.get(status_url)
+        json_response = self.assert200(response)
+        self.assertEqual(json_response['search']['status'], 'done')
+        self.assertTrue(json_response['search']['_links']['results'].endswith('/movies?q=hobbit'))
+
+
+    def test_external_search_in_worker_process(self):
+        # With the local backends we can't see a search run by a celery worker finish, so don't wait for it
+        self.app.config['CELERY_ALWAYS_EAGER'] = False
+        self.app.config['EXTERNAL_SEARCH_WAIT_IN_S'] = 5
+        worker_app = create_app()
+
+        def search(query):
+            # The worker has it's own local cache and pub/sub, like a separate process would
+            with worker_app.test_request_context():
+                finish_external_search(query)
+
+        external_search = Mock(**{'delay.side_effect': search})
+        start = time.time()
+        with patch('marvin.tasks.external_search', external_search):
+            response = self.client.get('/movies?q=hobbit')
+        self.assertTrue(time.time() - start < 5)
+        json_response = self.assert200(response)
+        self.assertEqual(json_response['movies'], [])
+        self.assertEqual(response.headers['Retry-After'], '2')
+        self.assertFalse('_links' in json_response)
+        external_search.delay.assert_called_once_with('hobbit')
+        # We can't tell whether it's done, but at least it doesn't seem pending forever
+        response = self.client.get('/movies/search?q=hobbit')
+        self.assertEqual(self.assert200(response)['search']['status'], 'unknown')
+
+
+    def test_search_status_unknown(self):
+        response = self.client.get('/movies/search?q=harry')
+        json_response = self.assert200(response)
+        self.assertEqual(json_response['search']['status'], 'unknown')
+
+
+    def test_search_status_requires_query(self):
+        response = self.client.get('/movies/search')
+        self.assert400(response)
 
 
 class LargeExistingDbTest(TestCaseWithTempDB, AuthenticatedUserMixin):
@@ -135,6 +220,24 @@ class MovieDetailWithStreams(TestCaseWithTempDB, AuthenticatedUserMixin):
         self.assertTrue(len(json_response['movie']['streams']), 2)
 
 
+    def test_number_of_queries_independent_of_streams(self):
+        # Warm the auth cache, so that authenticating only checks the password hash
+        self.client.get('/movies/%d' % self.movie_id, headers=self.auth_header)
+        with self.app.test_request_context():
+            movie = Movie.query.get(self.movie_id)
+            for i in range(5):
+                other_user = User(username='user%d' % i, email='user%d@example.com' % i, password_hash='x')
+                db.session.add(Stream(name='Stream %d' % i, movie=movie, creator=other_user, public=True))
+            invalidate('movie:%d' % self.movie_id)
+            db.session.commit()
+
+        # The password hash, the movie, and its streams with their creators
+        with self.assertNumQueries(3):
+            response = self.client.get('/movies/%d' % self.movie_id, headers=self.auth_header)
+        json_response = self.assert200(response)
+        self.assertEqual(len(json_response['movie']['streams']), 7)
+
+
 class MovieLimitsInSearch(TestCaseWithTempDB):
 
     def setUp(self):
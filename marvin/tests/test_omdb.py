@@ -0,0 +1,97 @@
+from marvin.cache import DiskCache, LocalCache
+from marvin.omdb import get_cache_key, OMDbClient
+from marvin.tests.fake_omdb import FakeOMDb
+
+import requests
+import shutil
+import tempfile
+import unittest
+
+
+class OMDbClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.omdb = FakeOMDb({
+            'tt0499549': {'Title': 'Avatar', 'Year': '2009', 'Type': 'movie', 'Response': 'True'},
+            'tt0120338': {'Title': 'Titanic', 'Year': '1997', 'Type': 'movie', 'Response': 'True'},
+        })
+        self.url = self.omdb.start()
+        self.now = 1000
+        self.cache = LocalCache(clock=lambda: self.now)
+        self.client = OMDbClient(self.url, backoff=0, caches=[self.cache], ttls={'s': 60, 'i': 600})
+
+
+    def tearDown(self):
+        self.omdb.stop()
+
+
+    def test_lookup(self):
+        result = self.client.get({'i': 'tt0499549'})
+        self.assertEqual(result['Title'], 'Avatar')
+
+
+    def test_repeated_queries_are_cached(self):
+        first = self.client.get({'s': 'avatar'})
+        second = self.client.get({'s': '  Avatar '})
+        self.assertEqual(first, second)
+        self.assertEqual(len(first['Search']), 1)
+        self.assertEqual(self.omdb.request_count, 1)
+
+
+    def test_cache_expires(self):
+        self.client.get({'s': 'titanic'})
+        self.client.get({'i': 'tt0120338'})
+        self.now += 61
+        self.client.get({'s': 'titanic'})
+        self.client.get({'i': 'tt0120338'})
+        # Only the search expired
+        self.assertEqual(self.omdb.request_count, 3)
+
+
+    def test_uncached_query_types(self):
+        self.client.get({'t': 'avatar'})
+        self.client.get({'t': 'avatar'})
+        self.assertEqual(self.omdb.request_count, 2)
+
+
+    def test_retries_server_errors(self):
+        self.omdb.failures = 2
+        result = self.client.get({'i': 'tt0499549'})
+        self.assertEqual(result['Title'], 'Avatar')
+        self.assertEqual(self.omdb.request_count, 3)
+
+
+    def test_gives_up_after_retries(self):
+        self.omdb.failures = 3
+        self.assertEqual(self.client.get({'i': 'tt0499549'}), None)
+        self.assertEqual(self.omdb.request_count, 3)
+        # Failures aren't cached
+        self.assertEqual(self.client.get({'i': 'tt0499549'})['Title'], 'Avatar')
+
+
+    def test_connection_errors(self):
+        self.omdb.stop()
+        client = OMDbClient(self.url, backoff=0, timeout=1)
+        self.assertRaises(requests.ConnectionError, client.get, {'i': 'tt0499549'})
+        # Restart so tearDown doesn't fail
+        self.omdb.start()
+
+
+    def test_persistent_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            client = OMDbClient(self.url, caches=[LocalCache(), DiskCache(directory)], ttls={'i': 600})
+            client.get({'i': 'tt0499549'})
+            # A new client, like after a restart, finds it on disk
+            client = OMDbClient(self.url, caches=[LocalCache(), DiskCache(directory)], ttls={'i': 600})
+            self.assertEqual(client.get({'i': 'tt0499549'})['Title'], 'Avatar')
+            self.assertEqual(self.omdb.request_count, 1)
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_cache_key_normalization(self):
+        self.assertEqual(get_cache_key({'s': 'The  Matrix '}), get_cache_key({'S': 'the matrix'}))
+        self.assertEqual(get_cache_key({'s': 'avatar', 'y': '2009'}), get_cache_key({'y': '2009', 's': 'avatar'}))
+        self.assertNotEqual(get_cache_key({'s': 'avatar'}), get_cache_key({'i': 'avatar'}))
+        self.assertEqual(get_cache_key({'s': 'avatar', 'y': 2009}), get_cache_key({'s': 'avatar', 'y': '2009'}))
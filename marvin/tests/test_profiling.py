@@ -0,0 +1,81 @@
+from marvin.models import Movie
+from marvin.profiling import Sampler, init_app, make_profiling_token
+from marvin.tests import TestCaseWithTempDB
+
+from mock import patch
+from os import path
+from threading import Event, Thread
+
+import shutil
+import tempfile
+import unittest
+
+
+class ProfilingTest(TestCaseWithTempDB):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        # Only read when the app is created
+        self.app.config['PROFILING_OUTPUT_DIR'] = self.output_dir
+        init_app(self.app)
+        with self.app.test_request_context():
+            self.token = make_profiling_token()
+        self.movie_id = self.addItems(Movie(title='Titanic', external_id='imdb:tt0120338'))[0]
+
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+
+    def get_profile(self, headers=None):
+        with patch('marvin.profiling.Sampler') as sampler:
+            sampler.return_value.stop.return_value = {'app.main;app.view': 3}
+            self.client.get('/movies/%d' % self.movie_id, headers=headers or {})
+        profile_path = path.join(self.output_dir, 'MovieDetailView.GET.collapsed')
+        if not path.exists(profile_path):
+            return None
+        with open(profile_path) as profile_fh:
+            return profile_fh.read()
+
+
+    def test_signed_header(self):
+        profile = self.get_profile({'X-Marvin-Profile': self.token})
+        self.assertEqual(profile, 'app.main;app.view 3\n')
+        # Appended to by later requests
+        profile = self.get_profile({'X-Marvin-Profile': self.token})
+        self.assertEqual(profile, 'app.main;app.view 3\n'*2)
+
+
+    def test_invalid_header(self):
+        self.assertEqual(self.get_profile({'X-Marvin-Profile': self.token + 'x'}), None)
+
+
+    def test_not_profiled_by_default(self):
+        self.assertEqual(self.get_profile(), None)
+
+
+    def test_sample_rate(self):
+        self.app.config['PROFILING_SAMPLE_RATE'] = 1.0
+        self.assertEqual(self.get_profile(), 'app.main;app.view 3\n')
+
+
+class SamplerTest(unittest.TestCase):
+
+    def test_samples_thread(self):
+        started = Event()
+        finished = Event()
+        def wait_for_finish():
+            started.set()
+            finished.wait()
+        thread = Thread(target=wait_for_finish)
+        thread.start()
+        started.wait()
+        sampler = Sampler(thread.ident, 0.001)
+        while not sampler.counts:
+            finished.wait(0.01)
+        counts = sampler.stop()
+        finished.set()
+        thread.join()
+        stack = list(counts)[0]
+        self.assertTrue('marvin.tests.test_profiling.wait_for_finish' in stack.split(';'))
+        self.assertTrue(all(count >= 1 for count in counts.values()))
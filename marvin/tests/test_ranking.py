@@ -0,0 +1,85 @@
+from marvin.models import Movie
+from marvin.ranking import get_ranking_timings, rank_movies, relative_relevancy, title_similarity
+from marvin.tests import TestCaseWithTempDB
+
+from collections import namedtuple
+from mock import patch
+
+import unittest
+
+FakeMovie = namedtuple('FakeMovie', ['title', 'relevancy'])
+
+
+class ScorerTest(unittest.TestCase):
+
+    def test_title_similarity(self):
+        movies = [FakeMovie('Avatar', 0), FakeMovie('The Last Airbender: Avatar', 0), FakeMovie('Dances', 0)]
+        scores = title_similarity(' avatar', movies)
+        self.assertEqual(scores[0], 1.0)
+        self.assertTrue(0 < scores[1] < 1)
+        self.assertEqual(scores[2], 0.0)
+
+
+    def test_relative_relevancy(self):
+        movies = [FakeMovie('a', 50), FakeMovie('b', 100), FakeMovie('c', 0)]
+        self.assertEqual(relative_relevancy('a', movies), [0.5, 1.0, 0.0])
+        self.assertEqual(relative_relevancy('a', [FakeMovie('a', 0)]*2), [0.0, 0.0])
+
+
+class RankingTest(TestCaseWithTempDB):
+
+    def test_rank_movies(self):
+        movies = [FakeMovie('Avatar: The Legend of Korra', 300), FakeMovie('Avatar', 100), FakeMovie('Avatars', 10)]
+        with self.app.test_request_context():
+            ranked = rank_movies('avatar', movies)
+            self.assertEqual(ranked[0].title, 'Avatar')
+            timings = get_ranking_timings()
+        self.assertEqual(timings['count'], 1)
+        self.assertTrue(timings['max_ms'] >= 0)
+
+
+    def test_ties_keep_order(self):
+        movies = [FakeMovie('Alien %d' % i, 0) for i in range(5)]
+        with self.app.test_request_context():
+            self.assertEqual(rank_movies('alien', movies), movies)
+
+
+    def test_no_scorers(self):
+        self.app.config['SEARCH_RANKING_SCORERS'] = []
+        movies = [FakeMovie('Avatar 2', 200), FakeMovie('Avatar', 100)]
+        with self.app.test_request_context():
+            self.assertEqual(rank_movies('avatar', movies), movies)
+
+
+    def test_pluggable_scorers(self):
+        self.app.config['SEARCH_RANKING_SCORERS'] = [('marvin.tests.test_ranking.shortest_title', 1)]
+        movies = [FakeMovie('Avatar 2', 200), FakeMovie('Avatar 10', 300), FakeMovie('Ava', 100)]
+        with self.app.test_request_context():
+            self.assertEqual([movie.title for movie in rank_movies('ava', movies)], ['Ava', 'Avatar 2', 'Avatar 10'])
+
+
+    def test_over_budget(self):
+        self.app.config['SEARCH_RANKING_BUDGET_IN_MS'] = -1
+        with self.app.test_request_context():
+            with patch('marvin.ranking._logger') as logger:
+                rank_movies('avatar', [FakeMovie('Avatar', 1)])
+            self.assertEqual(logger.warning.call_count, 1)
+            self.assertEqual(get_ranking_timings()['over_budget'], 1)
+
+
+    def test_exact_match_first_in_search(self):
+        self.addItems(
+            Movie(title='Alien vs. Predator', external_id='imdb:tt0370263', relevancy=200),
+            Movie(title='Aliens', external_id='imdb:tt0090605', relevancy=150),
+            Movie(title='Alien', external_id='imdb:tt0078748', relevancy=120),
+        )
+        with patch('marvin.tasks.external_search'):
+            response = self.client.get('/movies?q=alien')
+        json_response = self.assert200(response)
+        self.assertEqual([movie['title'] for movie in json_response['movies']],
+            ['Alien', 'Aliens', 'Alien vs. Predator'])
+
+
+def shortest_title(search_query, movies): # pylint: disable=unused-argument
+    longest = max(len(movie.title) for movie in movies)
+    return [1 - len(movie.title)/float(longest) for movie in movies]
@@ -0,0 +1,148 @@
+from marvin import db
+from marvin.models import Movie, compute_relevancy
+from marvin.relevancy import (_recompute_in_sql, compute_relevancy_array, get_relevancy_expression, get_stale_filter,
+    recompute_relevancy)
+from marvin.tests import TestCaseWithTempDB
+
+from datetime import datetime, timedelta
+from sqlalchemy.dialects import mysql
+
+import math
+import random
+import unittest
+
+try:
+    import numpy
+except ImportError: # pragma: no cover
+    numpy = None # pylint: disable=invalid-name
+
+
+class RelevancyTest(TestCaseWithTempDB):
+
+    def setUp(self):
+        now = datetime.now()
+        self.addItems(
+            Movie(title='Never computed', external_id='imdb:tt1', imdb_rating=8.2, metascore=66,
+                number_of_imdb_votes=206398, year=2013),
+            Movie(title='Computed last year', external_id='imdb:tt2', imdb_rating=5.0, metascore=40,
+                number_of_imdb_votes=1200, year=1999, relevancy=1,
+                relevancy_computed_at=datetime(now.year - 1, 12, 31)),
+            Movie(title='Fresh', external_id='imdb:tt3', imdb_rating=7.0, metascore=70,
+                number_of_imdb_votes=30000, relevancy=1, relevancy_computed_at=now - timedelta(seconds=1)),
+        )
+
+
+    def get_movies(self):
+        return dict((movie.external_id, movie) for movie in Movie.query.all())
+
+
+    def expected_relevancy(self, movie):
+        return compute_relevancy(movie.imdb_rating, movie.metascore, movie.number_of_imdb_votes, movie.year)
+
+
+    def test_recompute_stale(self):
+        with self.app.test_request_context():
+            self.assertEqual(Movie.query.filter(get_stale_filter(datetime.now())).count(), 2)
+            self.assertEqual(recompute_relevancy(chunk_size=1), 2)
+            movies = self.get_movies()
+            for external_id in ('imdb:tt1', 'imdb:tt2'):
+                movie = movies[external_id]
+                self.assertAlmostEqual(movie.relevancy, self.expected_relevancy(movie))
+                self.assertEqual(movie.relevancy_computed_at.year, datetime.now().year)
+            self.assertEqual(movies['imdb:tt3'].relevancy, 1)
+            # Nothing is stale anymore
+            self.assertEqual(recompute_relevancy(), 0)
+
+
+    def test_recompute_all(self):
+        with self.app.test_request_context():
+            self.assertEqual(recompute_relevancy(only_stale=False), 3)
+            for movie in self.get_movies().values():
+                self.assertAlmostEqual(movie.relevancy, self.expected_relevancy(movie))
+
+
+    def test_recompute_methods_agree(self):
+        methods = ['python'] + (['numpy'] if numpy is not None else [])
+        with self.app.test_request_context():
+            for method in methods:
+                self.assertEqual(recompute_relevancy(only_stale=False, method=method, chunk_size=2), 3)
+                for movie in self.get_movies().values():
+                    self.assertAlmostEqual(movie.relevancy, self.expected_relevancy(movie))
+
+
+    def test_sql_matches_python(self):
+        # Vote counts that aren't a multiple of 1000 show whether the division is rounded down
+        self.addItems(Movie(title='Few votes', external_id='imdb:tt4', imdb_rating=6.1, metascore=51,
+            number_of_imdb_votes=1999, year=2005))
+        with self.app.test_request_context():
+            if db.engine.dialect.name == 'sqlite':
+                # SQLite lacks the math functions, so provide them to run the same SQL
+                connection = db.session.connection().connection
+                connection.create_function('power', 2, math.pow)
+                connection.create_function('floor', 1, math.floor)
+            elif db.engine.dialect.name not in ('postgresql', 'mysql'):
+                self.skipTest("The database can't calculate relevancy in SQL")
+            self.assertEqual(_recompute_in_sql(None, datetime.now()), 4)
+            db.session.commit()
+            for movie in self.get_movies().values():
+                self.assertAlmostEqual(movie.relevancy, self.expected_relevancy(movie), places=4)
+
+
+    def test_sql_rounds_votes_down_on_mysql(self):
+        expression = get_relevancy_expression(2014).compile(dialect=mysql.dialect())
+        self.assertTrue('floor(' in str(expression).lower())
+
+
+    def test_update_relevancy_marks_fresh(self):
+        with self.app.test_request_context():
+            movie = Movie.query.filter(Movie.external_id == 'imdb:tt1').one()
+            movie.update_relevancy()
+            db.session.commit()
+            self.assertEqual(Movie.query.filter(get_stale_filter(datetime.now())).count(), 1)
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class RelevancyArrayTest(unittest.TestCase):
+    """ Check that the vectorized relevancy matches compute_relevancy for all kinds of movies. """
+
+    def check(self, movies, current_year=2014):
+        columns = list(zip(*movies))
+        scores = compute_relevancy_array(columns[0], columns[1], columns[2], columns[3], current_year)
+        self.assertEqual(len(scores), len(movies))
+        for movie, score in zip(movies, scores):
+            expected = compute_relevancy(*movie, current_year=current_year)
+            self.assertAlmostEqual(score, expected, places=7, msg='%r: %r != %r' % (movie, score, expected))
+
+
+    def test_random_movies(self):
+        rand = random.Random(42)
+        movies = []
+        for _ in range(5000):
+            movies.append((
+                round(rand.uniform(0, 10), 1),
+                rand.randint(0, 100),
+                rand.choice([0, rand.randint(0, 999), rand.randint(0, 100000), 25000, 24999, 25001]),
+                rand.choice([None, rand.randint(1880, 2050)]),
+            ))
+        self.check(movies)
+
+
+    def test_edge_cases(self):
+        self.check([
+            (0.0, 0, 0, None),
+            (10.0, 100, 10**9, 1880),
+            (7.5, 50, 999, 2014),
+            (7.5, 50, 1000, 2014),
+            # Released in the future
+            (7.5, 50, 1000, 2050),
+        ])
+
+
+    def test_other_years(self):
+        movies = [(8.0, 80, 20000, 2000), (5.0, 10, 30000, None)]
+        for current_year in (1990, 2000, 2100):
+            self.check(movies, current_year)
+
+
+    def test_empty(self):
+        self.assertEqual(len(compute_relevancy_array([], [], [], [], 2014)), 0)
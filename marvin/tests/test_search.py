@@ -0,0 +1,155 @@
+from marvin import db
+from marvin.models import Movie, MovieTitleTrigram
+from marvin.search import (can_track_external_searches, finish_external_search, forget_external_search,
+    get_external_search_counts, get_external_search_status, get_trigrams, normalize_query, rebuild_index,
+    schedule_external_search, search_movies, wait_for_external_search)
+from marvin.tests import TestCaseWithTempDB
+
+from mock import Mock, patch
+from threading import Timer
+
+import unittest
+
+
+class TrigramTest(unittest.TestCase):
+
+    def test_get_trigrams(self):
+        self.assertEqual(get_trigrams('Avatar'), set(['ava', 'vat', 'ata', 'tar']))
+
+
+    def test_get_trigrams_short(self):
+        self.assertEqual(get_trigrams('Up'), set())
+
+
+class SearchIndexTest(TestCaseWithTempDB):
+
+    def setUp(self):
+        avatar = Movie(title='Avatar', external_id='imdb:tt0499549', relevancy=40)
+        titanic = Movie(title='Titanic', external_id='imdb:tt0120338', relevancy=30)
+        self.avatar_id, self.titanic_id = self.addItems(avatar, titanic)
+
+
+    def _get_indexed_trigrams(self, movie_id):
+        trigrams = MovieTitleTrigram.query.filter(MovieTitleTrigram.movie_id == movie_id)
+        return set(trigram.trigram for trigram in trigrams)
+
+
+    def test_index_maintained_on_insert(self):
+        with self.app.test_request_context():
+            self.assertEqual(self._get_indexed_trigrams(self.avatar_id), get_trigrams('Avatar'))
+
+
+    def test_index_maintained_on_update(self):
+        with self.app.test_request_context():
+            movie = Movie.query.get(self.avatar_id)
+            movie.title = 'Avatar 2'
+            db.session.commit()
+            self.assertEqual(self._get_indexed_trigrams(self.avatar_id), get_trigrams('Avatar 2'))
+            self.assertEqual([m.title for m in search_movies('avatar 2')], ['Avatar 2'])
+
+
+    def test_index_maintained_on_delete(self):
+        with self.app.test_request_context():
+            db.session.delete(Movie.query.get(self.avatar_id))
+            db.session.commit()
+            self.assertEqual(self._get_indexed_trigrams(self.avatar_id), set())
+
+
+    def test_search(self):
+        with self.app.test_request_context():
+            self.assertEqual([m.title for m in search_movies('ATA')], ['Avatar'])
+            self.assertEqual([m.title for m in search_movies('t')], ['Avatar', 'Titanic'])
+            self.assertEqual(search_movies('tanic ava').all(), [])
+
+
+    def test_rebuild_index(self):
+        with self.app.test_request_context():
+            MovieTitleTrigram.query.delete()
+            db.session.commit()
+            rebuild_index(chunk_size=1)
+            self.assertEqual(self._get_indexed_trigrams(self.titanic_id), get_trigrams('Titanic'))
+            self.assertEqual([m.title for m in search_movies('titan')], ['Titanic'])
+
+
+class ExternalSearchCoalescingTest(TestCaseWithTempDB):
+
+    def setUp(self):
+        # The mocked external searches run in this process, so we can see them finish
+        self.app.config['CELERY_ALWAYS_EAGER'] = True
+
+
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query('  The   Matrix '), 'the matrix')
+
+
+    def test_duplicates_suppressed(self):
+        external_search = Mock()
+        with patch('marvin.tasks.external_search', external_search), self.app.test_request_context():
+            self.assertTrue(schedule_external_search('The Matrix'))
+            self.assertFalse(schedule_external_search('the  matrix'))
+            self.assertTrue(schedule_external_search('avatar'))
+            counts = get_external_search_counts()
+        self.assertEqual(external_search.delay.call_count, 2)
+        external_search.delay.assert_any_call('the matrix')
+        self.assertEqual(counts['enqueued'], 2)
+        self.assertEqual(counts['suppressed'], 1)
+
+
+    def test_wait_for_finished_search(self):
+        def search(query):
+            finish_external_search(query)
+        external_search = Mock(**{'delay.side_effect': search})
+        with patch('marvin.tasks.external_search', external_search), self.app.test_request_context():
+            self.assertEqual(get_external_search_status('avatar'), 'unknown')
+            schedule_external_search('Avatar')
+            self.assertEqual(get_external_search_status('avatar'), 'done')
+            self.assertTrue(wait_for_external_search('avatar', timeout=0))
+
+
+    def test_wait_times_out(self):
+        with patch('marvin.tasks.external_search', Mock()), self.app.test_request_context():
+            schedule_external_search('avatar')
+            self.assertEqual(get_external_search_status('avatar'), 'pending')
+            self.assertFalse(wait_for_external_search('avatar', timeout=0.01))
+            self.assertEqual(get_external_search_counts()['timed_out'], 1)
+
+
+    def test_wait_notified_when_finished(self):
+        with patch('marvin.tasks.external_search', Mock()), self.app.test_request_context():
+            schedule_external_search('avatar')
+            timer = Timer(0.05, self._finish_search, ['avatar'])
+            timer.start()
+            self.assertTrue(wait_for_external_search('avatar', timeout=5))
+            timer.join()
+
+
+    def _finish_search(self, query):
+        with self.app.test_request_context():
+            finish_external_search(query)
+
+
+    def test_untrackable_with_local_backends(self):
+        self.app.config['CELERY_ALWAYS_EAGER'] = False
+        with self.app.test_request_context():
+            self.assertFalse(can_track_external_searches())
+            self.app.config['CACHE_BACKEND'] = 'redis'
+            self.app.config['PUBSUB_BACKEND'] = 'redis'
+            self.assertTrue(can_track_external_searches())
+
+
+    def test_forget(self):
+        external_search = Mock()
+        with patch('marvin.tasks.external_search', external_search), self.app.test_request_context():
+            schedule_external_search('avatar')
+            forget_external_search('Avatar')
+            schedule_external_search('avatar')
+        self.assertEqual(external_search.delay.call_count, 2)
+
+
+    def test_expires(self):
+        self.app.config['EXTERNAL_SEARCH_COALESCE_TTL_IN_S'] = 0
+        external_search = Mock()
+        with patch('marvin.tasks.external_search', external_search), self.app.test_request_context():
+            schedule_external_search('avatar')
+            schedule_external_search('avatar')
+        self.assertEqual(external_search.delay.call_count, 2)
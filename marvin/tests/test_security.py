@@ -1,8 +1,22 @@
+from marvin import db
+from marvin.cache import get_cache
+from marvin.models import Movie, Stream, User
 from marvin.tests import TestCaseWithTempDB, AuthenticatedUserMixin
-from marvin.security import get_auth_token_from_header, before_request_authentication
+from marvin.security import (get_auth_token_from_header, before_request_authentication, generate_pw_hash,
+    is_correct_pw, calibrate_scrypt_params, needs_rehash)
 
 from flask import g
-from werkzeug.exceptions import BadRequest
+from mock import Mock, patch
+from threading import BoundedSemaphore
+from werkzeug.exceptions import BadRequest, Unauthorized
+
+import time
+
+
+def _slow_hash(password, salt, N, p, r): # pylint: disable=unused-argument,invalid-name
+    time.sleep(1)
+    return b'hash'
+
 
 class AuthorizationTest(TestCaseWithTempDB):
 
@@ -48,3 +62,181 @@ class GoodAuthTest(TestCaseWithTempDB, AuthenticatedUserMixin):
             before_request_authentication()
             self.assertTrue(g.user.is_authenticated())
             self.assertEqual(g.user.username, 'bob')
+
+
+class AuthCacheTest(TestCaseWithTempDB, AuthenticatedUserMixin):
+
+    def setUp(self):
+        self.authenticate()
+
+
+    def _authenticate_request(self):
+        with self.app.test_request_context(headers=self.auth_header):
+            before_request_authentication()
+            return g.user.username
+
+
+    def test_cached_auth_only_checks_password_hash(self):
+        self._authenticate_request()
+        # The local cache can't be invalidated by other processes, so only the password hash is queried
+        with self.assertNumQueries(1):
+            self.assertEqual(self._authenticate_request(), 'bob')
+
+
+    def test_password_changed_by_other_process(self):
+        self._authenticate_request()
+        with self.app.test_request_context():
+            # Bypass the ORM events, like another process would with its own cache
+            db.session.execute(User.__table__.update().values(password_hash=generate_pw_hash('newpassword')))
+            db.session.commit()
+        with self.app.test_request_context(headers=self.auth_header):
+            with self.assertRaises(Unauthorized):
+                before_request_authentication()
+
+
+    def test_user_deleted_by_other_process(self):
+        self._authenticate_request()
+        with self.app.test_request_context():
+            db.session.execute(User.__table__.delete())
+            db.session.commit()
+        with self.app.test_request_context(headers=self.auth_header):
+            with self.assertRaises(Unauthorized):
+                before_request_authentication()
+
+
+    def test_cached_user_usable_in_session(self):
+        self._authenticate_request()
+        with self.app.test_request_context(headers=self.auth_header):
+            before_request_authentication()
+            movie = Movie(title='Avatar', external_id='imdb:tt0499549')
+            db.session.add(Stream(name='CinemaSins', movie=movie, creator=g.user))
+            db.session.commit()
+            self.assertEqual(Stream.query.one().creator.username, 'bob')
+
+
+    def test_password_change_invalidates_cache(self):
+        self._authenticate_request()
+        with self.app.test_request_context():
+            user = User.query.filter(User.username == 'bob').one()
+            user.password_hash = generate_pw_hash('newpassword')
+            db.session.commit()
+        with self.app.test_request_context(headers=self.auth_header):
+            with self.assertRaises(Unauthorized):
+                before_request_authentication()
+
+
+    def test_uncached_when_committed(self):
+        self._authenticate_request()
+        with self.app.test_request_context():
+            cache = get_cache('auth', self.app.config['AUTH_CACHE_SIZE'])
+            user = User.query.filter(User.username == 'bob').one()
+            user_key = 'user:%d' % user.id
+            user.password_hash = generate_pw_hash('newpassword')
+            db.session.flush()
+            # Evicting before the commit would let concurrent requests cache the old user again
+            self.assertIsNotNone(cache.get(user_key))
+            db.session.rollback()
+            self.assertIsNotNone(cache.get(user_key))
+            user.password_hash = generate_pw_hash('newpassword')
+            db.session.commit()
+            self.assertIsNone(cache.get(user_key))
+
+
+class PasswordHashingTest(TestCaseWithTempDB):
+
+    def test_hash_roundtrip_inline(self):
+        self.app.config['PASSWORD_HASHING_POOL_SIZE'] = 0
+        with self.app.test_request_context():
+            pw_hash = generate_pw_hash('secret')
+            self.assertTrue(is_correct_pw('secret', pw_hash))
+            self.assertFalse(is_correct_pw('wrong', pw_hash))
+
+
+    def test_hash_outside_app_context(self):
+        user = User(username='bob', email='bob@example.com', password='bobspw')
+        self.assertTrue(user.password_hash.startswith('scrypt:1024:8:1$'))
+        self.assertTrue(is_correct_pw('bobspw', user.password_hash))
+
+
+    def test_hashing_saturated(self):
+        with self.app.test_request_context():
+            user = User(username='bob', email='bob@example.com', password='bobspw')
+            db.session.add(user)
+            db.session.commit()
+
+        slots = BoundedSemaphore(1)
+        slots.acquire()
+        data = {
+            'identifier': 'bob',
+            'password': 'bobspw',
+        }
+        # pylint: disable=multiple-statements
+        with patch('marvin.security._HAS_SCRYPT', True), \
+                patch('marvin.security._get_hashing_pool', Mock(return_value=(Mock(), slots))):
+            response = self.client.post('/login', data=data)
+        self.assert_status(response, 503)
+
+
+    def test_hashing_timeout(self):
+        from marvin import security
+        with self.app.test_request_context():
+            db.session.add(User(username='bob', email='bob@example.com', password='bobspw'))
+            db.session.commit()
+        self.app.config['PASSWORD_HASHING_POOL_SIZE'] = 1
+        self.app.config['PASSWORD_HASHING_TIMEOUT_IN_S'] = 0.05
+        data = {
+            'identifier': 'bob',
+            'password': 'bobspw',
+        }
+        # A fresh pool forks its workers with the slow hash in place
+        # pylint: disable=protected-access
+        with patch.multiple('marvin.security', scrypt=Mock(hash=_slow_hash), _HAS_SCRYPT=True,
+                _hashing_pool=None, _hashing_slots=None, _hashing_pool_pid=None):
+            try:
+                response = self.client.post('/login', data=data)
+            finally:
+                security._hashing_pool.terminate()
+        self.assert_status(response, 503)
+
+
+class ScryptParamsTest(TestCaseWithTempDB):
+
+    def test_calibrate(self):
+        clock = [0.0]
+        def fake_hash(password, salt, N, p, r): # pylint: disable=unused-argument,invalid-name
+            # Pretend a hash takes 1 ms per 1024 N
+            clock[0] += N/1024/1000.0
+        with self.app.test_request_context():
+            self.assertEqual(calibrate_scrypt_params(0.0165, 2**30, fake_hash, lambda: clock[0]), (2**14, 8, 1))
+            # Memory limit at 128*N*p bytes
+            self.assertEqual(calibrate_scrypt_params(10, 128*2**12*8, fake_hash, lambda: clock[0]), (2**12, 8, 1))
+
+
+    def test_needs_rehash(self):
+        with self.app.test_request_context():
+            self.assertFalse(needs_rehash('scrypt:1024:8:1$salt$hash'))
+            self.assertTrue(needs_rehash('scrypt:512:8:1$salt$hash'))
+            # Never downgrade
+            self.assertFalse(needs_rehash('scrypt:2048:8:1$salt$hash'))
+            self.assertFalse(needs_rehash('scrypt:1024:16:1$salt$hash'))
+
+
+    def test_rehash_on_login(self):
+        self.app.config['PASSWORD_HASHING_POOL_SIZE'] = 0
+        with self.app.test_request_context():
+            db.session.add(User(username='bob', email='bob@example.com', password='bobspw'))
+            db.session.commit()
+        self.app.config['SCRYPT_PARAMS'] = (2048, 8, 1)
+        response = self.client.post('/login', data={'identifier': 'bob', 'password': 'bobspw'})
+        self.assert200(response)
+        with self.app.test_request_context():
+            user = User.query.filter(User.username == 'bob').one()
+            self.assertTrue(user.password_hash.startswith('scrypt:2048:8:1$'))
+            self.assertTrue(is_correct_pw('bobspw', user.password_hash))
+            password_hash = user.password_hash
+        # Logging in through a process with weaker params leaves the hash alone
+        self.app.config['SCRYPT_PARAMS'] = (1024, 8, 1)
+        response = self.client.post('/login', data={'identifier': 'bob', 'password': 'bobspw'})
+        self.assert200(response)
+        with self.app.test_request_context():
+            self.assertEqual(User.query.filter(User.username == 'bob').one().password_hash, password_hash)
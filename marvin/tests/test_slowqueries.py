@@ -0,0 +1,141 @@
+from marvin import db
+from marvin.models import Movie
+from marvin.slowqueries import SlowQueryLog, get_parameter_shape, get_slow_query_log, redact_literals
+from marvin.tests import TestCaseWithTempDB
+
+from mock import patch
+from sqlalchemy.exc import OperationalError
+from threading import Event
+
+import ujson as json
+import unittest
+
+
+class SlowQueryLogTest(TestCaseWithTempDB):
+
+    def setUp(self):
+        movie = Movie(title='Titanic', external_id='imdb:tt0120338')
+        self.movie_id = self.addItems(movie)[0]
+        # Log everything
+        self.app.config['SLOW_QUERY_THRESHOLD_IN_MS'] = 0
+
+
+    def get_records(self, logger):
+        with self.app.app_context():
+            get_slow_query_log().join()
+        return [json.loads(call[0][0]) for call in logger.warning.call_args_list]
+
+
+    def test_request(self):
+        with patch('marvin.slowqueries._logger') as logger:
+            self.client.get('/movies/%d' % self.movie_id)
+            records = self.get_records(logger)
+        movie_queries = [record for record in records if 'FROM movie' in record['statement']]
+        self.assertTrue(movie_queries)
+        record = movie_queries[0]
+        self.assertEqual(record['resource'], 'MovieDetailView')
+        self.assertTrue(record['duration_ms'] >= 0)
+        self.assertEqual(list(record['parameter_shape']), ['int'])
+        self.assertTrue(record['plan'])
+
+
+    def test_outside_request(self):
+        with patch('marvin.slowqueries._logger') as logger:
+            with self.app.app_context():
+                Movie.query.get(self.movie_id)
+            records = self.get_records(logger)
+        self.assertTrue(records)
+        self.assertEqual(set(record['resource'] for record in records), set([None]))
+
+
+    def test_disabled(self):
+        self.app.config['SLOW_QUERY_THRESHOLD_IN_MS'] = None
+        with self.app.app_context():
+            Movie.query.get(self.movie_id)
+            self.assertFalse('marvin_slow_query_log' in self.app.extensions)
+
+
+    def test_only_explains_selects(self):
+        with patch('marvin.slowqueries._logger') as logger:
+            with self.app.app_context():
+                movie = Movie.query.get(self.movie_id)
+                movie.title = 'Titanic 2'
+                db.session.commit()
+            records = self.get_records(logger)
+        update = [record for record in records if record['statement'].startswith('UPDATE')][0]
+        self.assertFalse('plan' in update)
+
+
+    def test_failed_statement_forgotten(self):
+        with self.app.app_context():
+            connection = db.engine.connect()
+            try:
+                with self.assertRaises(OperationalError):
+                    connection.execute('SELECT * FROM nonexistent')
+                self.assertEqual(connection.info['marvin_slow_query_start'], [])
+            finally:
+                connection.close()
+
+
+class ExplainRateLimitTest(TestCaseWithTempDB):
+
+    def setUp(self):
+        self.now = 1000.0
+        with self.app.app_context():
+            self.log = SlowQueryLog(db.engine, explains_per_minute=2, explain_interval=3600, clock=lambda: self.now)
+
+
+    def explained(self, statement):
+        with patch('marvin.slowqueries._logger') as logger:
+            self.log.record(statement, (), False, 1.0, None)
+            self.log.join()
+        return 'plan' in json.loads(logger.warning.call_args[0][0])
+
+
+    def test_rate_limit(self):
+        self.assertTrue(self.explained('SELECT 1'))
+        # Too soon after the last one
+        self.assertFalse(self.explained('SELECT 2'))
+        self.now += 30
+        self.assertTrue(self.explained('SELECT 2'))
+
+
+    def test_same_statement(self):
+        self.assertTrue(self.explained('SELECT 1'))
+        self.now += 60
+        self.assertFalse(self.explained('SELECT 1'))
+        self.now += 3600
+        self.assertTrue(self.explained('SELECT 1'))
+
+
+    def test_drops_when_full(self):
+        log = SlowQueryLog(None, queue_size=1)
+        unblock = Event()
+        # Block the worker on the first record, so that the second fills the queue
+        with patch.object(log, '_write', side_effect=lambda record: unblock.wait()):
+            for _ in range(10):
+                log.record('SELECT 1', (), False, 1.0, None)
+            unblock.set()
+            log.join()
+        self.assertTrue(log.dropped >= 8)
+
+
+class RedactLiteralsTest(unittest.TestCase):
+
+    def test_redact(self):
+        self.assertEqual(redact_literals("Index Cond: ((email)::text = 'bob@example.com'::text)"),
+            "Index Cond: ((email)::text = '?'::text)")
+        self.assertEqual(redact_literals("Filter: ((title ~~ '%it''s%'::text) AND (relevancy >= 1.5))"),
+            "Filter: ((title ~~ '?'::text) AND (relevancy >= ?))")
+        # The costs of the plan are kept
+        self.assertEqual(redact_literals('Index Scan using movie_pkey on movie  (cost=0.15..8.17 rows=1 width=4)'),
+            'Index Scan using movie_pkey on movie  (cost=0.15..8.17 rows=1 width=4)')
+
+
+class ParameterShapeTest(unittest.TestCase):
+
+    def test_shapes(self):
+        self.assertEqual(get_parameter_shape((1, 'secret', None)), ['int', 'str', 'NoneType'])
+        self.assertEqual(get_parameter_shape({'email': 'bob@example.com'}), {'email': 'str'})
+        self.assertEqual(get_parameter_shape([(1, 'a'), (2, 'b')], executemany=True),
+            {'rows': 2, 'row': ['int', 'str']})
@@ -1,7 +1,11 @@
+from marvin import db
+from marvin.models import Statistic, Stream, User
+from marvin.stats import refresh_stats
 from marvin.tests import fixtures
 from marvin.tests import TestCaseWithTempDB
 
 from contextlib import contextmanager
+from datetime import datetime
 from flask import template_rendered
 
 
@@ -25,15 +29,61 @@ class StatsViewTest(TestCaseWithTempDB):
 
     def setUp(self):
         fixtures.load(self.app, fixtures.COMPLETE)
+        with self.app.test_request_context():
+            refresh_stats()
 
 
-    def test_correct_stats(self):
+    def get_stats(self):
         with rendered_context(self.app) as context:
             response = self.client.get('/')
-            stats = context['stats']
+            self.assert200(response, mimetype='text/html; charset=utf-8')
+            return context['stats']
+
 
-        self.assert200(response, mimetype='text/html; charset=utf-8')
+    def test_correct_stats(self):
+        stats = self.get_stats()
         self.assertEqual(stats['Number of movies'], 2)
         self.assertEqual(stats['Number of streams'], 3)
         self.assertEqual(stats['Number of entries'], 9)
         self.assertEqual(stats['Number of users'], 2)
+
+
+    def test_aggregates(self):
+        with self.app.test_request_context():
+            # auto_now doesn't set the signup time in every environment, so set it here
+            db.session.execute(User.__table__.update().values(user_created_datetime=datetime.utcnow()))
+            db.session.commit()
+            refresh_stats()
+        stats = self.get_stats()
+        self.assertEqual(stats['Published streams'], 0)
+        self.assertEqual(stats['Draft streams'], 3)
+        self.assertEqual(stats['Entries of type text'], 9)
+        self.assertEqual(stats['Signups on %s' % datetime.utcnow().strftime('%Y-%m-%d')], 2)
+
+
+    def test_big_tables_not_counted(self):
+        with self.assertNumQueries(1):
+            self.get_stats()
+        # Served from the cache the next time
+        with self.assertNumQueries(0):
+            self.get_stats()
+
+
+    def test_refresh(self):
+        self.get_stats()
+        with self.app.test_request_context():
+            Stream.query.first().public = True
+            db.session.commit()
+        self.assertEqual(self.get_stats()['Published streams'], 0)
+        with self.app.test_request_context():
+            refresh_stats()
+        self.assertEqual(self.get_stats()['Published streams'], 1)
+
+
+    def test_not_counted_yet(self):
+        with self.app.test_request_context():
+            Statistic.query.delete()
+            db.session.commit()
+        stats = self.get_stats()
+        self.assertEqual(stats['Number of movies'], 0)
+        self.assertEqual(stats['Counted at (UTC)'], 'Not counted yet')
@@ -1,3 +1,4 @@
+from marvin import db
 from marvin.models import Stream, Movie, Entry, User
 from marvin.tests import TestCaseWithTempDB, AuthenticatedUserMixin
 
@@ -8,7 +9,6 @@ class StreamDetailViewTest(TestCaseWithTempDB, AuthenticatedUserMixin):
         movie = Movie(
             title='Titanic',
             external_id='imdb:tt1245526',
-            number_of_streams=1,
         )
 
         stream = Stream(
@@ -275,6 +275,120 @@ class StreamEntryFetchTest(TestCaseWithTempDB, AuthenticatedUserMixin):
         self.assertTrue(json_response['entries'][0], last_starttime + 60*1000)
 
 
+    def _get_next_path(self, json_response):
+        next_link = json_response['_links']['next']
+        return next_link[next_link.index('/streams/'):]
+
+
+    def test_follow_next_links(self):
+        # Add some entries sharing the same entry point, to check that ties are handled
+        with self.app.test_request_context():
+            stream = Stream.query.get(self.stream_id)
+            for i in range(3):
+                db.session.add(Entry(entry_point_in_ms=5*60*1000, title='Tie %d' % i, content_type='text',
+                    content='{"text":"Tied"}', stream=stream))
+            db.session.commit()
+
+        seen_entries = []
+        path = '/streams/%d/entries?limit=2' % self.stream_id
+        for _ in range(12):
+            json_response = self.assert200(self.client.get(path))
+            self.assertTrue(len(json_response['entries']) <= 2)
+            seen_entries.extend(entry['href'] for entry in json_response['entries'])
+            path = self._get_next_path(json_response)
+        self.assertEqual(len(seen_entries), 23)
+        self.assertEqual(len(set(seen_entries)), 23)
+
+        # Following the last link should yield nothing until new entries are added
+        json_response = self.assert200(self.client.get(path))
+        self.assertEqual(json_response['entries'], [])
+        self.assertEqual(self._get_next_path(json_response), path)
+
+
+    def test_invalid_params(self):
+        for params in ['limit=ten', 'limit=0', 'starttime_gt=soon', 'cursor=deadbeef']:
+            response = self.client.get('/streams/%d/entries?%s' % (self.stream_id, params))
+            self.assertValidClientError(response)
+
+
+    def test_limit_capped(self):
+        self.app.config['MAX_ENTRIES_PER_PAGE'] = 10
+        response = self.client.get('/streams/%d/entries?limit=1000' % self.stream_id)
+        json_response = self.assert200(response)
+        self.assertEqual(len(json_response['entries']), 10)
+
+
     def test_get_entries_for_nonexistent_stream(self):
         response = self.client.get('/streams/76543/entries')
         self.assert404(response)
+
+
+    def _get_entries_etag(self, query=''):
+        response = self.client.get('/streams/%d/entries%s' % (self.stream_id, query))
+        self.assert200(response)
+        return response.headers['ETag']
+
+
+    def _assertNotModified(self, etag):
+        response = self.client.get('/streams/%d/entries' % self.stream_id, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+
+    def _assertModified(self, etag):
+        response = self.client.get('/streams/%d/entries' % self.stream_id, headers={'If-None-Match': etag})
+        self.assert200(response)
+
+
+    def test_not_modified(self):
+        etag = self._get_entries_etag()
+        # Only the stream should be loaded
+        with self.assertNumQueries(1):
+            self._assertNotModified(etag)
+        self._assertModified('"something-else"')
+
+
+    def test_etag_depends_on_params(self):
+        self.assertNotEqual(self._get_entries_etag(), self._get_entries_etag('?limit=5'))
+
+
+    def test_entry_changes_modify(self):
+        etag = self._get_entries_etag()
+        with self.app.test_request_context():
+            entry = Entry(entry_point_in_ms=0, title='New', content_type='text', content='{"text":"New"}',
+                stream=Stream.query.get(self.stream_id))
+            db.session.add(entry)
+            db.session.commit()
+            entry_id = entry.id
+        self._assertModified(etag)
+
+        etag = self._get_entries_etag()
+        with self.app.test_request_context():
+            Entry.query.get(entry_id).title = 'Updated'
+            db.session.commit()
+        self._assertModified(etag)
+
+        etag = self._get_entries_etag()
+        with self.app.test_request_context():
+            db.session.delete(Entry.query.get(entry_id))
+            db.session.commit()
+        self._assertModified(etag)
+
+
+    def test_stream_changes_modify(self):
+        etag = self._get_entries_etag()
+        with self.app.test_request_context():
+            Stream.query.get(self.stream_id).description = 'Not part of the entries'
+            db.session.commit()
+        self._assertNotModified(etag)
+
+        with self.app.test_request_context():
+            Stream.query.get(self.stream_id).name = 'Renamed'
+            db.session.commit()
+        self._assertModified(etag)
+
+        etag = self._get_entries_etag()
+        response = self.client.post('/streams/%d/unpublish' % self.stream_id, headers=self.auth_header)
+        self.assert200(response)
+        response = self.client.post('/streams/%d/publish' % self.stream_id, headers=self.auth_header)
+        self.assert200(response)
+        self._assertModified(etag)
@@ -1,5 +1,7 @@
 from marvin.models import Movie
+from marvin.omdb import OMDbClient
 from marvin.tests import TestCaseWithTempDB
+from marvin.tests.fake_omdb import FakeOMDb
 
 from mock import Mock, patch
 
@@ -48,11 +50,11 @@ class OMDBFetchTest(TestCaseWithTempDB):
             'status_code': 200,
         }
         response = Mock(**attrs)
-        requests = Mock(**{'get.return_value': response})
+        client = OMDbClient('http://omdb', session=Mock(**{'get.return_value': response}))
 
         # pylint: disable=multiple-statements
-        patch_requests = patch('marvin.tasks.requests', requests)
-        with patch_requests, self.app.test_request_context():
+        patch_client = patch('marvin.tasks.get_omdb_client', Mock(return_value=client))
+        with patch_client, self.app.test_request_context():
             self.external_search('ava')
         with self.app.test_request_context():
             # we expect the 'series'-type to be ignored
@@ -92,8 +94,8 @@ class OMDBFetchTest(TestCaseWithTempDB):
             'status_code': 200,
         }
         response = Mock(**attrs)
-        requests = Mock(**{'get.return_value': response})
-        with patch('marvin.tasks.requests', requests):
+        client = OMDbClient('http://omdb', session=Mock(**{'get.return_value': response}))
+        with patch('marvin.tasks.get_omdb_client', Mock(return_value=client)):
             self.update_meta('imdb:tt1170358')
         with self.app.test_request_context():
             movie = Movie.query.get(movie_id)
@@ -115,3 +117,70 @@ class OMDBFetchTest(TestCaseWithTempDB):
         for runtime, expected in tests:
             parsed = self.parse_runtime_to_seconds(runtime)
             self.assertEqual(parsed, expected)
+
+
+class BulkMetadataRefreshTest(TestCaseWithTempDB):
+
+    def setUp(self):
+        from marvin import tasks
+        # Run the task directly in our app, so that it picks up the config changes below
+        self.update_meta = tasks.update_meta.run
+        movies = [Movie(title='Movie %d' % i, external_id='imdb:tt%07d' % i, year=2010) for i in range(7)]
+        movies.append(Movie(title='Not on IMDb', external_id='other:123', year=2010))
+        self.addItems(*movies)
+        omdb_movies = dict(('tt%07d' % i, {
+            'Poster': 'http://example.com/%d.jpg' % i,
+            'Runtime': '%d min' % (90 + i),
+            'Metascore': 'N/A',
+            'imdbRating': '7.%d' % i,
+            'imdbVotes': '1,00%d' % i,
+            'Response': 'True',
+        }) for i in range(6))
+        self.omdb = FakeOMDb(omdb_movies)
+        self.app.config['OMDB_URL'] = self.omdb.start()
+        self.app.config['OMDB_REFRESH_CHUNK_SIZE'] = 3
+        self.app.config['OMDB_CONCURRENCY'] = 4
+        self.app.config['OMDB_REQUESTS_PER_SECOND'] = 1000
+
+
+    def tearDown(self):
+        self.omdb.stop()
+
+
+    def test_update_all(self):
+        with self.app.test_request_context():
+            self.update_meta()
+            movies = dict((movie.external_id, movie) for movie in Movie.query.all())
+            # Only imdb movies are looked up
+            self.assertEqual(self.omdb.request_count, 7)
+            movie = movies['imdb:tt0000004']
+            self.assertEqual(movie.cover_img, 'http://example.com/4.jpg')
+            self.assertEqual(movie.duration_in_s, 94*60)
+            self.assertEqual(movie.imdb_rating, 7.4)
+            self.assertEqual(movie.number_of_imdb_votes, 1004)
+            self.assertEqual(movie.metascore, 0)
+            self.assertTrue(movie.relevancy > 0)
+            # Movies OMDb doesn't know are left alone
+            self.assertEqual(movies['imdb:tt0000006'].imdb_rating, 0)
+            self.assertEqual(movies['imdb:tt0000006'].relevancy, 0)
+
+
+    def test_bad_payloads(self):
+        self.omdb.movies['tt0000001'] = dict(self.omdb.movies['tt0000001'], imdbVotes='lots')
+        self.omdb.movies['tt0000002'] = '<html>Service unavailable</html>'
+        with self.app.test_request_context():
+            self.update_meta()
+            ratings = dict((movie.external_id, movie.imdb_rating) for movie in Movie.query.all())
+        # The broken movies are skipped, without affecting the others in the same chunk
+        self.assertEqual(ratings['imdb:tt0000001'], 0)
+        self.assertEqual(ratings['imdb:tt0000002'], 0)
+        self.assertEqual(ratings['imdb:tt0000000'], 7.0)
+        self.assertEqual(ratings['imdb:tt0000005'], 7.5)
+
+
+    def test_update_some(self):
+        with self.app.test_request_context():
+            self.update_meta(['imdb:tt0000001', 'imdb:tt0000002'])
+            updated = Movie.query.filter(Movie.imdb_rating > 0).count()
+        self.assertEqual(self.omdb.request_count, 2)
+        self.assertEqual(updated, 2)
@@ -0,0 +1,65 @@
+from marvin.tests import TestCaseWithTempDB
+from marvin.utils import external_url, RateLimiter
+
+from flask import url_for
+
+import unittest
+
+
+class ExternalUrlTest(TestCaseWithTempDB):
+
+    def test_same_as_url_for(self):
+        with self.app.test_request_context():
+            for endpoint, values in [
+                    ('moviedetailview', {'movie_id': 1}),
+                    ('streamentryview', {'stream_id': 42}),
+                    ('entrydetailview', {'entry_id': 1234567}),
+                    ]:
+                self.assertEqual(external_url(endpoint, **values), url_for(endpoint, _external=True, **values))
+                # and again, now that the template is cached
+                self.assertEqual(external_url(endpoint, **values), url_for(endpoint, _external=True, **values))
+
+
+    def test_templates_per_host(self):
+        with self.app.test_request_context(base_url='http://example.com'):
+            self.assertEqual(external_url('moviedetailview', movie_id=3), 'http://example.com/movies/3')
+        with self.app.test_request_context(base_url='https://api.example.com/v1'):
+            self.assertEqual(external_url('moviedetailview', movie_id=3), 'https://api.example.com/v1/movies/3')
+
+
+    def test_templates_bounded(self):
+        self.app.config['URL_TEMPLATE_CACHE_SIZE'] = 10
+        for i in range(20):
+            with self.app.test_request_context(base_url='http://host%d.example.com' % i):
+                self.assertEqual(external_url('moviedetailview', movie_id=3), 'http://host%d.example.com/movies/3' % i)
+        self.assertEqual(len(self.app.extensions['marvin_url_templates']), 10)
+
+
+    def test_non_integer_values(self):
+        with self.app.test_request_context(base_url='http://example.com'):
+            self.assertEqual(external_url('moviedetailview', movie_id=3, foo='bar'),
+                'http://example.com/movies/3?foo=bar')
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.sleeps = []
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+        self.limiter = RateLimiter(4, clock=lambda: self.now, sleeper=sleep)
+
+
+    def test_spaces_out_calls(self):
+        for _ in range(3):
+            self.limiter.wait()
+        self.assertEqual(self.sleeps, [0.25, 0.25])
+
+
+    def test_doesnt_wait_when_idle(self):
+        self.limiter.wait()
+        self.now += 10
+        self.limiter.wait()
+        self.assertEqual(self.sleeps, [])
@@ -6,9 +6,14 @@
 
 """
 
-from flask import make_response, request
+from .cache import LocalCache
+from .instrumentation import record_timing
+
+from flask import current_app, has_request_context, make_response, request, url_for
 from flask.ext.restful import Api
 from logging import getLogger
+from threading import Lock
+from time import sleep, time
 from werkzeug.exceptions import HTTPException
 
 import textwrap
@@ -16,6 +21,10 @@ import ujson
 
 _logger = getLogger('marvin.utils')
 
+#: Values substituted for the URL arguments when compiling URL templates. Must be large enough
+#: to never collide with anything else in a URL.
+_URL_PLACEHOLDER_BASE = 918273645000
+
 
 class ApiBase(Api):
     """ Base API class used to add some extra functionality to Flask-RESTful. """
@@ -29,19 +38,105 @@ class ApiBase(Api):
 
     def handle_error(self, exception):
         """ Override handle_error to make sure the exception is handled by the correct logger. """
-        # Don't do any special logging of client side errors
-        if not (isinstance(exception, HTTPException) and (400 <= exception.code < 500)):
+        # Don't do any special logging of client side errors, or when we're deliberately shedding load
+        if not (isinstance(exception, HTTPException) and (400 <= exception.code < 500 or exception.code == 503)):
             generic_error_handler(exception)
         return super(ApiBase, self).handle_error(exception)
 
 
 def _fastjson(data, code, headers=None):
     """ Replace the default json serializer with one based on ujson. """
-    response = make_response(ujson.dumps(data), code)
+    start = time()
+    body = ujson.dumps(data)
+    record_timing('serialize', time() - start)
+    response = make_response(body, code)
     response.headers.extend(headers or {})
     return response
 
 
+def external_url(endpoint, **values):
+    """ Same as ``url_for(endpoint, _external=True, **values)``, but cheap to call repeatedly.
+
+    The first time an endpoint is built with a given set of arguments for a given host, the URL is
+    built once by Flask with placeholder values and turned into a format string, which is cached on
+    the app. Subsequent calls only do string interpolation. The values must be integers, which is all
+    marvin uses in URLs, anything else is passed on to ``url_for``.
+
+    The host comes from the request, so at most ``URL_TEMPLATE_CACHE_SIZE`` templates are kept, to keep
+    clients sending lots of different ``Host`` headers from growing the cache without bounds.
+    """
+    url_root = request.url_root if has_request_context() else current_app.config.get('SERVER_NAME')
+    url_templates = current_app.extensions.get('marvin_url_templates')
+    if url_templates is None:
+        url_templates = current_app.extensions.setdefault('marvin_url_templates',
+            LocalCache(current_app.config['URL_TEMPLATE_CACHE_SIZE']))
+    key = (url_root, endpoint, tuple(sorted(values)))
+    template = url_templates.get(key)
+    if template is None:
+        template = _compile_url_template(endpoint, values)
+        url_templates.set(key, template)
+    try:
+        return template % values
+    except TypeError:
+        return url_for(endpoint, _external=True, **values)
+
+
+def _compile_url_template(endpoint, argument_names):
+    placeholders = dict((name, _URL_PLACEHOLDER_BASE + i) for i, name in enumerate(sorted(argument_names)))
+    template = url_for(endpoint, _external=True, **placeholders).replace('%', '%%')
+    for name, placeholder in placeholders.items():
+        template = template.replace(str(placeholder), '%%(%s)d' % name)
+    return template
+
+
+def parse_int_arg(name, default, errors, min_value=None):
+    """ Get an integer from the request's query parameters.
+
+    :param name: Name of the query parameter.
+    :param default: The value to return if the parameter is missing or invalid.
+    :param errors: A dict the validation errors will be added to, keyed by `name`.
+    :param min_value: The smallest value that is accepted, if any.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        errors[name] = ['Must be an integer.']
+        return default
+    if min_value is not None and value < min_value:
+        errors[name] = ['Must be at least %d.' % min_value]
+        return default
+    return value
+
+
+class RateLimiter(object):
+    """ Limits how often something can happen, shared between threads.
+
+    :param rate: Maximum number of calls to :meth:`wait` that return per second.
+    :param clock: Function returning the current time in seconds.
+    :param sleeper: Function to sleep for a number of seconds.
+    """
+
+    def __init__(self, rate, clock=time, sleeper=sleep):
+        self.interval = 1.0/rate
+        self.clock = clock
+        self.sleeper = sleeper
+        self._next_slot = clock()
+        self._lock = Lock()
+
+
+    def wait(self):
+        """ Block until we're allowed to proceed. """
+        with self._lock:
+            now = self.clock()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            self.sleeper(slot - now)
+
+
 def error_handler(error):
     """ Handles errors outside the API, ie in blueprints. """
     generic_error_handler(error)
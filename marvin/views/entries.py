@@ -8,11 +8,16 @@
 # pylint: disable=no-self-use
 
 from .. import db
-from ..models import Entry, EntryForm, Stream
+from ..feed import get_stream_channel, make_feed_item
+from ..models import Entry, EntryForm, Movie, Stream
 from ..permissions import login_required
+from ..pubsub import get_pubsub
+from ..utils import external_url, parse_int_arg
 
+from flask import current_app, g, request
 from flask.ext.restful import Resource
 from flask.ext.principal import Permission, UserNeed
+from werkzeug.urls import url_encode
 
 class EntryDetailView(Resource):
     """ RUD interface to entries. """
@@ -78,6 +83,8 @@ class CreateEntryView(Resource):
                 entry.stream = stream
                 db.session.add(entry)
                 db.session.commit()
+                # Let anyone following the stream know about the new entry right away
+                get_pubsub().publish(get_stream_channel(stream.id), make_feed_item(entry))
                 return {
                     'msg': 'Entry created.',
                     'entry': entry.to_json(),
@@ -90,3 +97,90 @@ class CreateEntryView(Resource):
             return {
                 'msg': 'Only the creator can add entries to streams',
             }, 403
+
+
+class MovieEntryWindowView(Resource):
+    """ Read endpoint for entries in several streams of a movie within a time window. """
+
+    def get(self, movie_id):
+        """ Get entries appearing in the window ``[from_ms, to_ms)`` of the given streams.
+
+        Lets clients prefetch the upcoming entries of all the streams they follow in a single request.
+        Respect the following request parameters:
+
+        * ``streams``: Comma-separated stream IDs. Defaults to all streams of the movie visible to the user.
+        * ``from_ms``: Start of the window, inclusive. Defaults to 0.
+        * ``to_ms``: End of the window, exclusive. Defaults to the largest window allowed, which is
+          ``MAX_ENTRY_WINDOW_IN_MS``.
+        """
+        movie = Movie.query.get_or_404(movie_id)
+        max_window = current_app.config['MAX_ENTRY_WINDOW_IN_MS']
+        errors = {}
+        from_ms = parse_int_arg('from_ms', 0, errors, min_value=0)
+        to_ms = parse_int_arg('to_ms', from_ms + max_window, errors, min_value=from_ms + 1)
+        if to_ms - from_ms > max_window:
+            errors['to_ms'] = ['The window can be at most %d ms.' % max_window]
+        stream_ids = _parse_stream_ids_arg(errors)
+        if errors:
+            return {
+                'msg': 'Some of the query parameters did not pass validation.',
+                'errors': errors,
+            }, 400
+
+        streams_query = movie.streams
+        if stream_ids is not None:
+            streams_query = streams_query.filter(Stream.id.in_(stream_ids))
+        streams = streams_query.all()
+        if stream_ids is not None:
+            unknown_ids = set(stream_ids) - set(stream.id for stream in streams)
+            if unknown_ids:
+                return {
+                    'msg': 'Some of the given streams do not belong to this movie.',
+                    'errors': {
+                        'streams': ['Unknown streams: %s' % ', '.join(str(i) for i in sorted(unknown_ids))],
+                    },
+                }, 400
+            if not all(stream.public or Permission(UserNeed(stream.creator_id)) for stream in streams):
+                return {
+                    'msg': 'Some of the given streams are not public yet.',
+                }, 403 if g.user else 401
+        else:
+            streams = [s for s in streams if s.public or Permission(UserNeed(s.creator_id))]
+
+        entries = []
+        if streams:
+            entries = (Entry.query
+                .filter(Entry.stream_id.in_([stream.id for stream in streams]),
+                    Entry.entry_point_in_ms >= from_ms,
+                    Entry.entry_point_in_ms < to_ms)
+                .order_by(Entry.entry_point_in_ms.asc(), Entry.id.asc())
+                .all())
+        next_params = {
+            'from_ms': to_ms,
+            'to_ms': to_ms + (to_ms - from_ms),
+        }
+        if stream_ids is not None:
+            # Without it the next window defaults to the visible streams again, which might be none
+            next_params['streams'] = ','.join(str(stream_id) for stream_id in stream_ids)
+        return {
+            'entries': [entry.to_json() for entry in entries],
+            '_links': {
+                'next': '%s?%s' % (external_url('movieentrywindowview', movie_id=movie.id), url_encode(next_params)),
+            },
+        }
+
+
+def _parse_stream_ids_arg(errors):
+    """ Get the list of stream IDs from the streams param, or None if not given. """
+    value = request.args.get('streams')
+    if value is None:
+        return None
+    try:
+        stream_ids = [int(stream_id) for stream_id in value.split(',') if stream_id.strip()]
+    except ValueError:
+        errors['streams'] = ['Must be a comma-separated list of stream IDs.']
+        return None
+    if not stream_ids:
+        errors['streams'] = ['At least one stream ID must be given.']
+        return None
+    return stream_ids
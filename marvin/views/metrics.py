@@ -0,0 +1,20 @@
+"""
+    marvin.views.metrics
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Request metrics of this process, for Prometheus to scrape. Not found unless ``METRICS_ENABLED`` is set.
+
+"""
+from ..instrumentation import get_metrics, render_prometheus_metrics
+
+from flask import Blueprint, Response, abort, current_app
+
+mod = Blueprint(__name__, 'marvin.metrics')
+
+@mod.route('/metrics')
+def metrics_main():
+    """ Show the request metrics, see :mod:`marvin.instrumentation`. """
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+    body = render_prometheus_metrics(get_metrics(), current_app.config['INSTRUMENTATION_BUCKETS_IN_S'])
+    return Response(body, content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -7,11 +7,17 @@
 """
 # pylint: disable=no-self-use
 
+from ..httpcache import cached_response
 from ..models import Movie
+from ..ranking import rank_movies
+from ..search import (can_track_external_searches, get_external_search_status, schedule_external_search,
+    search_movies, wait_for_external_search)
+from ..utils import external_url
 
-from flask import request
+from flask import current_app, request
 from flask.ext.restful import Resource
 from logging import getLogger
+from werkzeug.urls import url_encode
 
 _logger = getLogger('marvin.views.movies')
 
@@ -19,6 +25,7 @@ _logger = getLogger('marvin.views.movies')
 class MovieDetailView(Resource):
     """ Read interface to movies. """
 
+    @cached_response(lambda movie_id: ['movie:%d' % movie_id])
     def get(self, movie_id):
         """ Get the movie with the given ID. """
         movie = Movie.query.get_or_404(movie_id)
@@ -36,35 +43,43 @@ class AllMoviesView(Resource):
     """
 
 
+    @cached_response(lambda: None if request.args.get('q') else ['movies'])
     def get(self):
         """ Get a list of id -> movie title pairs of all movies registered. """
-        # Import the task here since it will cause circular imports if it's done on the top
-        from marvin.tasks import external_search
-
         search_query = request.args.get('q')
         limit = 15
 
         # Return results from our own db
         if search_query:
-            search_words = search_query.split()
-            final_search_query = '%'.join(search_words)
-            movie_query = (Movie.query
-                .filter(Movie.title.ilike('%' + final_search_query + '%'))
-                .order_by(Movie.relevancy.desc())
-                .limit(limit))
+            movie_query = search_movies(search_query, max(limit, current_app.config['SEARCH_RANKING_CANDIDATES']))
             _logger.info("Got search query for '%s'", search_query)
-            movies = movie_query.all()
+            movies = rank_movies(search_query, movie_query.all())[:limit]
             if movies:
                 _logger.info("Query for '%s' returned %d results", search_query, len(movies))
                 # Good, we found something, return that, and look for more asynchronously
-                external_search.delay(search_query)
+                schedule_external_search(search_query)
             else:
-                # Crap, database is empty, let's look for some more stuff synchronously, so that we don't
-                # give any empty responses
+                # Crap, database is empty, let's look for some more stuff, but only wait for it for a
+                # little while, so that a slow OMDb can't tie up our workers
                 _logger.info("No movies found locally for query '%s', searching external resources...", search_query)
-                external_search(search_query)
-                movies = movie_query.all()
-                _logger.info("Synchronous search for '%s' resulted in %d new movies", search_query, len(movies))
+                schedule_external_search(search_query)
+                retry_after = {'Retry-After': str(current_app.config['EXTERNAL_SEARCH_RETRY_AFTER_IN_S'])}
+                if not can_track_external_searches():
+                    # We'd never see the search finish, so don't keep the client waiting for nothing
+                    return {
+                        'movies': [],
+                    }, 200, retry_after
+                if not wait_for_external_search(search_query, current_app.config['EXTERNAL_SEARCH_WAIT_IN_S']):
+                    _logger.info("External search for '%s' didn't finish in time", search_query)
+                    return {
+                        'movies': [],
+                        '_links': {
+                            'searchStatus': '%s?%s' % (external_url('searchstatusview'),
+                                url_encode({'q': search_query})),
+                        },
+                    }, 200, retry_after
+                movies = rank_movies(search_query, movie_query.all())[:limit]
+                _logger.info("External search for '%s' resulted in %d new movies", search_query, len(movies))
         else:
             movies = (Movie.query
                 .filter(Movie.number_of_streams >= 1)
@@ -75,3 +90,31 @@ class AllMoviesView(Resource):
         return {
             'movies': [movie.to_json(include_streams=False) for movie in movies],
         }
+
+
+class SearchStatusView(Resource):
+    """ Read interface to the status of external searches, for clients waiting for search results. """
+
+    def get(self):
+        """ Get the status of the external search for the query given as `q`.
+
+        The status is one of ``pending``, ``done`` or ``unknown``, the latter if the query hasn't been
+        searched for recently. Once the search is done, the results can be fetched from the movies.
+        """
+        search_query = request.args.get('q')
+        if not search_query:
+            return {
+                'msg': 'Some of the query parameters did not pass validation.',
+                'errors': {
+                    'q': 'The search query is required.',
+                },
+            }, 400
+        return {
+            'search': {
+                'query': search_query,
+                'status': get_external_search_status(search_query),
+                '_links': {
+                    'results': '%s?%s' % (external_url('allmoviesview'), url_encode({'q': search_query})),
+                },
+            },
+        }
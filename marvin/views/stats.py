@@ -5,19 +5,39 @@
     Show some key numbers about the current marvin database.
 
 """
-from ..models import Movie, Stream, Entry, User
+from ..ranking import get_ranking_timings
+from ..search import get_external_search_counts
+from ..stats import get_stats
 
+from collections import OrderedDict
 from flask import Blueprint, render_template
 
 mod = Blueprint(__name__, 'marvin.stats')
 
 @mod.route('/')
 def stats_main():
-    """ Show some key numbers. """
-    stats = {
-        'Number of movies': Movie.query.count(),
-        'Number of streams': Stream.query.count(),
-        'Number of entries': Entry.query.count(),
-        'Number of users': User.query.count(),
-    }
+    """ Show some key numbers.
+
+    The database numbers are counted periodically, see :mod:`marvin.stats`, the others are live.
+    """
+    counts = get_stats()
+    external_searches = get_external_search_counts()
+    ranking = get_ranking_timings()
+    stats = OrderedDict([
+        ('Number of movies', counts['movies']),
+        ('Number of streams', sum(counts['streams'].values())),
+        ('Published streams', counts['streams'].get('published', 0)),
+        ('Draft streams', counts['streams'].get('draft', 0)),
+        ('Number of entries', sum(counts['entries'].values())),
+    ])
+    for content_type, count in sorted(counts['entries'].items()):
+        stats['Entries of type %s' % content_type] = count
+    stats['Number of users'] = counts['users']
+    for day, count in sorted(counts['signups'].items(), reverse=True):
+        stats['Signups on %s' % day] = count
+    stats['Counted at (UTC)'] = counts['computed_at'] or 'Not counted yet'
+    stats['External searches enqueued by this process'] = external_searches['enqueued']
+    stats['External searches suppressed by this process'] = external_searches['suppressed']
+    stats['Average search ranking time in ms'] = ranking['total_ms']/ranking['count'] if ranking['count'] else 0
+    stats['Search rankings over budget'] = ranking['over_budget']
     return render_template('stats.html', stats=stats)
@@ -9,12 +9,22 @@
 
 from .. import db
 from ..models import Stream, StreamForm, Entry, Movie
+from ..feed import EntryFeed, get_stream_channel, make_feed_item
+from ..httpcache import cached_response, get_etag, invalidate, is_fresh, not_modified
 from ..permissions import login_required
+from ..pubsub import get_pubsub
+from ..utils import external_url, parse_int_arg
 
-from flask import g, request
+from flask import current_app, g, request, Response, stream_with_context
 from flask.ext.principal import UserNeed, Permission
 from flask.ext.restful import Resource
+from itsdangerous import BadData, URLSafeSerializer
 from logging import getLogger
+from sqlalchemy import or_
+from time import time
+from werkzeug.urls import url_encode
+
+import ujson
 
 _logger = getLogger('marvin.views.streams')
 
@@ -22,6 +32,7 @@ _logger = getLogger('marvin.views.streams')
 class StreamDetailView(Resource):
     """ RUD interface to streams. """
 
+    @cached_response(lambda stream_id: ['stream:%d' % stream_id])
     def get(self, stream_id):
         """ Get the stream with the given ID. """
         stream = Stream.query.get_or_404(stream_id)
@@ -47,6 +58,7 @@ class StreamDetailView(Resource):
             form = StreamForm(obj=stream)
             if form.validate_on_submit():
                 form.populate_obj(stream)
+                invalidate('stream:%d' % stream.id, 'movie:%d' % stream.movie_id)
                 return {
                     'msg': 'Stream updated.',
                     'stream': stream.to_json(),
@@ -67,10 +79,8 @@ class StreamDetailView(Resource):
         stream = Stream.query.get_or_404(stream_id)
         delete_permission = Permission(UserNeed(stream.creator_id))
         if delete_permission.can():
-            movie = stream.movie
-            movie.number_of_streams -= 1
             db.session.delete(stream)
-            db.session.add(movie)
+            invalidate('stream:%d' % stream.id, 'movie:%d' % stream.movie_id, 'movies')
             return {'msg': 'Stream deleted.'}
         else:
             return {
@@ -92,6 +102,8 @@ class CreateStreamView(Resource):
             stream.movie = movie
             db.session.add(stream)
             db.session.add(movie)
+            # The creator sees the new stream on the movie right away
+            invalidate('movie:%d' % movie.id)
             db.session.commit()
             return {
                 'msg': 'Stream created',
@@ -111,33 +123,177 @@ class StreamEntryView(Resource):
 
         Respect the following request parameters:
 
-        * ``limit``: Restrict number of entries returned to this amount.
+        * ``limit``: Restrict number of entries returned to this amount. Capped at ``MAX_ENTRIES_PER_PAGE``.
         * ``starttime_gt``: Only return entries that enter after this time, in ms.
+        * ``cursor``: Only return entries after the last one of a previous response. Taken from the
+          ``next`` link of that response, overrides ``starttime_gt``.
+
+        Responses have an ETag derived from the entries version of the stream, so clients polling for
+        new entries get a 304 without us loading any entries if nothing changed.
         """
         stream = Stream.query.get_or_404(stream_id)
         is_owner = Permission(UserNeed(stream.creator_id))
         if stream.public or is_owner:
-            max_number_of_entries = request.args.get('limit', 100)
-            starttime_gt = request.args.get('starttime_gt', -1)
-            entries = (stream.entries
-                .filter(Entry.entry_point_in_ms > starttime_gt)
-                .order_by(Entry.entry_point_in_ms.asc())
-                .limit(max_number_of_entries))
+            etag = get_etag('stream-entries', str(stream.id), str(stream.entries_version))
+            headers = {
+                'ETag': '"%s"' % etag,
+                'Cache-Control': 'no-cache',
+            }
+            if is_fresh(etag):
+                return not_modified(headers)
+            errors = {}
+            limit = parse_int_arg('limit', 100, errors, min_value=1)
+            starttime_gt = parse_int_arg('starttime_gt', -1, errors)
+            cursor = _parse_cursor_arg(errors)
+            if errors:
+                return {
+                    'msg': 'Some of the query parameters did not pass validation.',
+                    'errors': errors,
+                }, 400
+            limit = min(limit, current_app.config['MAX_ENTRIES_PER_PAGE'])
+            entries_query = stream.entries
+            if cursor:
+                # Entries can share entry points, so break ties on the id. The first criterion
+                # is redundant, but lets the database do a range scan on the index.
+                last_entry_point, last_id = cursor
+                entries_query = entries_query.filter(Entry.entry_point_in_ms >= last_entry_point,
+                    or_(Entry.entry_point_in_ms > last_entry_point, Entry.id > last_id))
+            else:
+                entries_query = entries_query.filter(Entry.entry_point_in_ms > starttime_gt)
+            entries = (entries_query
+                .order_by(Entry.entry_point_in_ms.asc(), Entry.id.asc())
+                .limit(limit)
+                .all())
+            if entries:
+                cursor = (entries[-1].entry_point_in_ms, entries[-1].id)
+            next_params = {'limit': limit}
+            if cursor:
+                next_params['cursor'] = _get_cursor_serializer().dumps(cursor)
+            else:
+                next_params['starttime_gt'] = starttime_gt
             return {
                 'entries': [entry.to_json() for entry in entries],
-            }
+                '_links': {
+                    'next': '%s?%s' % (external_url('streamentryview', stream_id=stream.id), url_encode(next_params)),
+                },
+            }, 200, headers
         else:
             return {
                 'msg': 'This stream is not public yet.',
             }, 403 if g.user else 401
 
 
+def _get_cursor_serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='entry-cursor')
+
+
+def _parse_cursor_arg(errors):
+    """ Get the (entry_point_in_ms, id) of the last entry seen from the cursor param, if any. """
+    token = request.args.get('cursor')
+    if token is None:
+        return None
+    try:
+        last_entry_point, last_id = _get_cursor_serializer().loads(token)
+        return (int(last_entry_point), int(last_id))
+    except (BadData, TypeError, ValueError):
+        errors['cursor'] = ['Invalid cursor, use the next link from a previous response.']
+        return None
+
+
+class StreamFeedView(Resource):
+    """ Push endpoint for entries in a stream, following the viewer's playback position. """
+
+    def get(self, stream_id):
+        """ Get entries of the given stream as their entry points are reached during playback.
+
+        Respect the following request parameters:
+
+        * ``offset_ms``: The viewer's current playback position, in ms.
+
+        Clients accepting ``text/event-stream`` get server-sent events, an ``entry`` event for each
+        entry when it's due, and an ``end`` event with the playback position to reconnect with when
+        the connection is closed after ``FEED_MAX_DURATION_IN_S``. Other clients get a long-poll
+        response, returned as soon as any entries are due, or empty after ``FEED_LONGPOLL_TIMEOUT_IN_S``.
+        """
+        stream = Stream.query.get_or_404(stream_id)
+        is_owner = Permission(UserNeed(stream.creator_id))
+        if not (stream.public or is_owner):
+            return {
+                'msg': 'This stream is not public yet.',
+            }, 403 if g.user else 401
+        errors = {}
+        offset_ms = parse_int_arg('offset_ms', 0, errors, min_value=0)
+        if errors:
+            return {
+                'msg': 'Some of the query parameters did not pass validation.',
+                'errors': errors,
+            }, 400
+
+        subscription = get_pubsub().subscribe(get_stream_channel(stream.id))
+        feed = EntryFeed(_get_feed_entry_loader(stream.id), subscription, offset_ms)
+        config = current_app.config
+        if request.accept_mimetypes.best == 'text/event-stream':
+            events = _generate_feed_events(feed, config['FEED_HEARTBEAT_IN_S'], config['FEED_MAX_DURATION_IN_S'])
+            return Response(stream_with_context(events), mimetype='text/event-stream', headers={
+                'Cache-Control': 'no-cache',
+                # Tell nginx not to buffer the events
+                'X-Accel-Buffering': 'no',
+            })
+        try:
+            entries = feed.get_due_entries(timeout=config['FEED_LONGPOLL_TIMEOUT_IN_S'])
+        finally:
+            feed.close()
+        next_params = {'offset_ms': int(feed.delivered_until_ms)}
+        return {
+            'entries': entries,
+            '_links': {
+                'next': '%s?%s' % (external_url('streamfeedview', stream_id=stream.id), url_encode(next_params)),
+            },
+        }
+
+
+def _get_feed_entry_loader(stream_id):
+    """ Get a function the feed can use to read entries from the database. """
+    def load_entries(after, limit):
+        """ Load `limit` entries following the ``(entry_point_in_ms, id)`` given. """
+        last_entry_point, last_id = after
+        entries = (Entry.query
+            .filter(Entry.stream_id == stream_id,
+                Entry.entry_point_in_ms >= last_entry_point,
+                or_(Entry.entry_point_in_ms > last_entry_point, Entry.id > last_id))
+            .order_by(Entry.entry_point_in_ms.asc(), Entry.id.asc())
+            .limit(limit)
+            .all())
+        items = [make_feed_item(entry) for entry in entries]
+        # Don't hold on to a database connection while waiting for the entries to become due. Ending
+        # the transaction releases it, without detaching the user and stream from the session.
+        db.session.commit()
+        return items
+    return load_entries
+
+
+def _generate_feed_events(feed, heartbeat, max_duration):
+    """ Yield server-sent events for the entries of the feed as they become due. """
+    deadline = time() + max_duration
+    try:
+        while time() < deadline:
+            entries = feed.get_due_entries(timeout=min(heartbeat, deadline - time()))
+            for entry in entries:
+                yield 'event: entry\ndata: %s\n\n' % ujson.dumps(entry)
+            if not entries:
+                # Comments are ignored by clients, but keeps proxies from closing the connection
+                yield ': keep-alive\n\n'
+        yield 'event: end\ndata: %s\n\n' % ujson.dumps({'offset_ms': int(feed.delivered_until_ms)})
+    finally:
+        feed.close()
+
+
 class PublishStreamView(Resource):
     """ Publish the given stream. """
 
     @login_required
     def post(self, stream_id):
-        """ Publish the stream, increase movie's stream count. """
+        """ Publish the stream. """
         stream = Stream.query.get_or_404(stream_id)
         if stream.public:
             return {
@@ -146,7 +302,7 @@ class PublishStreamView(Resource):
         is_owner = Permission(UserNeed(stream.creator_id))
         if is_owner:
             stream.public = True
-            stream.movie.number_of_streams += 1
+            invalidate('stream:%d' % stream.id, 'movie:%d' % stream.movie_id, 'movies')
             db.session.commit()
             return {
                 'msg': 'Congratulations! The stream "%s" was published successfully.' % stream.name,
@@ -162,7 +318,7 @@ class UnpublishStreamView(Resource):
 
     @login_required
     def post(self, stream_id):
-        """ Unpublish the stream, decrease movie's stream count. """
+        """ Unpublish the stream. """
         stream = Stream.query.get_or_404(stream_id)
         if not stream.public:
             return {
@@ -171,7 +327,7 @@ class UnpublishStreamView(Resource):
         is_owner = Permission(UserNeed(stream.creator_id))
         if is_owner:
             stream.public = False
-            stream.movie.number_of_streams -= 1
+            invalidate('stream:%d' % stream.id, 'movie:%d' % stream.movie_id, 'movies')
             db.session.commit()
             return {
                 'msg': 'The stream "%s" was removed from public view successfully.' % stream.name,
@@ -10,9 +10,9 @@
 from .. import db
 from ..models import User, UserForm, UserLoginForm
 from ..permissions import login_required
-from ..security import is_correct_pw
+from ..security import generate_pw_hash, is_correct_pw, needs_rehash
+from ..utils import external_url
 
-from flask import url_for
 from flask.ext.restful import Resource
 from flask.ext.principal import UserNeed, Permission
 
@@ -49,10 +49,13 @@ class LoginView(Resource):
                 or User.query.filter(User.email == form.identifier.data).first())
             if user:
                 if is_correct_pw(form.password.data, user.password_hash):
+                    if needs_rehash(user.password_hash):
+                        # Upgrade to the current scrypt params while we have the password at hand
+                        user.password_hash = generate_pw_hash(form.password.data)
                     return {
                         'auth_token': user.get_auth_token(),
                         'user': {
-                            'href': url_for('userdetailview', user_id=user.id, _external=True),
+                            'href': external_url('userdetailview', user_id=user.id),
                             'username': user.username,
                         }
                     }